@@ -1,16 +1,25 @@
 import rag.rag_service as RagService
+import rag.ingestion_service as IngestionService
+import rag.embedding_service as EmbeddingService
+import rag.retrieval_engine as RetrievalEngine
 import agents.synthesizeragent.main as SynthesizerAgent
-from typing import Any
-from guardrails import Guard
-from guardrails.hub import DetectPII
+import asyncio
+import logging
+import re
+import threading
+from typing import TYPE_CHECKING, Any, AsyncIterator, Iterator
 import logfire
-from pydantic_evals import Case, Dataset
-from pydantic_evals.evaluators import EqualsExpected, Contains
 from agents.coordinatoragent.models.coordinator_agent_request import CoordinatorAgentRequest
+from agents.coordinatoragent.models.pii_scan_result import PiiScanResult
 from agents.synthesizeragent.models.synthesizer_agent_request import SynthesizerAgentRequest
+from agents.synthesizeragent.models.llm_policy import LlmPolicy
+import observability
 from util import Util
 from pathlib import Path
 
+if TYPE_CHECKING:
+    from guardrails import Guard
+
 ENABLE_TRACE_TO_LOGFIRE = True
 MODEL_GOOGLE_GEMINI = "google-gla:gemini-2.5-pro"
 
@@ -25,119 +34,293 @@ ERROR_INVALID_INPUT = "Please enter a valid input."
 
 if ENABLE_TRACE_TO_LOGFIRE:
     logfire.configure(service_name='second_brain', send_to_logfire=False)
-    logfire.instrument_pydantic_ai()
-    logfire.instrument_httpx(capture_all=True)
+observability.configure_logging()
+logger = logging.getLogger(__name__)
+
+# The heavyweights (instrumentation, guard, models, chroma) are initialized on first use or by warmup()
+_instrumented = False
+_instrument_lock = threading.Lock()
+_mask_pii_guard: "Guard | None" = None
+_mask_pii_guard_lock = threading.Lock()
+_warmup_thread: threading.Thread | None = None
+_warmup_lock = threading.Lock()
+
+
+def instrument() -> None:
+    """Instrument pydantic-ai and httpx once, before the first agent run (it imports pydantic-ai)."""
+    global _instrumented
+    if _instrumented or not ENABLE_TRACE_TO_LOGFIRE:
+        return
+    with _instrument_lock:
+        if not _instrumented:
+            logfire.instrument_pydantic_ai()
+            logfire.instrument_httpx(capture_all=True)
+            _instrumented = True
+
+
+def get_pii_guard() -> "Guard":
+    """Guard that detects and masks the PII in a single pass, loading the presidio models takes seconds."""
+    global _mask_pii_guard
+    if _mask_pii_guard is None:
+        with _mask_pii_guard_lock:
+            if _mask_pii_guard is None:
+                from guardrails import Guard
+                from guardrails.hub import DetectPII
+                _mask_pii_guard = Guard().use(
+                    DetectPII, ["EMAIL_ADDRESS", "PHONE_NUMBER"],
+                    on_fail="fix"
+                )
+    return _mask_pii_guard
+
+
+def warmup(tenant_id: str | None = None, background: bool = True) -> threading.Thread | None:
+    """Load the guard, the models, the chroma collection and the agent ahead of the first request.
+
+    Runs on a background thread (started once per process) by default, so the caller (e.g. the UI) is not
+    blocked. A request arriving meanwhile only waits for what it needs.
+    """
+    global _warmup_thread
+    if not background:
+        _warmup(tenant_id)
+        return None
+    with _warmup_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=_warmup, args=(tenant_id,), name="warmup", daemon=True)
+            _warmup_thread.start()
+        return _warmup_thread
+
+
+@logfire.instrument("CoordinatorAgent.warmup")
+def _warmup(tenant_id: str | None) -> None:
+    instrument()
+    get_pii_guard()
+    EmbeddingService.get_model()
+    if RetrievalEngine.RERANK_ENABLED:
+        RetrievalEngine.get_reranker()
+    knowledge_collection = RagService.get_knowledge_collection(tenant_id)
+    knowledge_collection.retrieval_engine.get_chunk_count(knowledge_collection.store,
+                                                          knowledge_collection.get_version())
+    SynthesizerAgent.get_agent()
+    SynthesizerAgent.get_response_cache()
+
 
-# Setup Guard
-validate_pii_guard = Guard().use(
-    DetectPII, ["EMAIL_ADDRESS", "PHONE_NUMBER"]
-)
+# Cheap pre-filter, an input without '@' and without a run of digits cannot hold an email address or phone number
+PII_HINT_PATTERN = re.compile(r"@|\d(?:[\s().+/-]*\d){4,}")
 
-mask_pii_guard = Guard().use(
-    DetectPII, ["EMAIL_ADDRESS", "PHONE_NUMBER"],
-    on_fail="fix"
-)
+
+def scan_sensitive_data(user_input: str) -> PiiScanResult:
+    """Detect and mask the PII of the input with a single analyzer pass."""
+    prefiltered = PII_HINT_PATTERN.search(user_input) is None
+    with observability.record_latency(observability.guard_latency, prefiltered=prefiltered):
+        if prefiltered:
+            return PiiScanResult(is_sensitive_data_exists=False, masked_input=user_input)
+        masked_input = get_pii_guard().validate(user_input).validated_output
+    if masked_input is None:
+        # The guard could not produce a masked output, fail closed without keeping the raw input
+        observability.pii_detections.add(1)
+        return PiiScanResult(is_sensitive_data_exists=True, masked_input="")
+    # The guard only rewrites the input when it found PII
+    is_sensitive_data_exists = masked_input != user_input
+    if is_sensitive_data_exists:
+        observability.pii_detections.add(1)
+    return PiiScanResult(is_sensitive_data_exists=is_sensitive_data_exists, masked_input=masked_input)
 
 
 def validate_sensitive_data(user_input: str) -> bool:
-    try:
-        validate_pii_guard.validate(user_input)
-        return False
-    except Exception as e:
-        return True
+    return scan_sensitive_data(user_input).is_sensitive_data_exists
 
 
 def mask_sensitive_data(user_input: str) -> str | None:
-    return mask_pii_guard.validate(user_input).validated_output
+    return scan_sensitive_data(user_input).masked_input
+
+
+DOCS_PATH = Path(__file__).resolve().parent.parent.parent.joinpath('docs')
+
 
 @logfire.instrument("CoordinatorAgent.ingest_data_from_docs")
-def ingest_data_from_docs() -> None:
-    RagService.delete_ingested_data()
-    RagService.ingest_data_from_file_or_folder(str(Path(__file__).resolve().parent.parent.parent.joinpath('docs')))
+def ingest_data_from_docs(tenant_id: str | None = None) -> None:
+    # Ingestion is incremental, only the files changed since the last ingestion are re-embedded
+    RagService.ingest_data_from_file_or_folder(str(DOCS_PATH), tenant_id)
 
 
-@logfire.instrument("CoordinatorAgent.get_response")
-def get_response(request: CoordinatorAgentRequest) -> Any:
+def submit_docs_ingestion(tenant_id: str | None = None) -> str:
+    """Queue the ingestion of the docs folder in the background and return the job id."""
+    return IngestionService.get_ingestion_service().submit(str(DOCS_PATH), tenant_id).job_id
+
+
+# The input is not checked for PII yet, it is not recorded on the span
+@logfire.instrument("CoordinatorAgent.get_response_async", extract_args=False)
+async def get_response_async(request: CoordinatorAgentRequest) -> Any:
+    instrument()
     user_input = None
-    ingested_data = None
 
     if not request.user_input or request.user_input.strip() == "":
-        SynthesizerAgent.store_conversation_to_memory(user_input if user_input else request.user_input, ERROR_INVALID_INPUT)
+        await Util.run_blocking(SynthesizerAgent.store_conversation_to_memory,
+                                user_input if user_input else request.user_input, ERROR_INVALID_INPUT,
+                                request.user_id)
         return ERROR_INVALID_INPUT
 
     try:
-        is_sensitive_data_exists = validate_sensitive_data(request.user_input)
-        if is_sensitive_data_exists:
-            user_input = mask_sensitive_data(request.user_input)
-        else:
-            user_input = request.user_input
-            # Get existing ingested data for the user
-            ingested_data = RagService.get_ingested_data(user_input)
-
-        print(f"3. Synthesizer agent is triggered with below details\n"
-              f"user_input={user_input}\n"
-              f"is_sensitive_data_exists={is_sensitive_data_exists}\n"
-              f"ingested_data={ingested_data}")
-        synthesizer_agent_request = get_synthesizer_agent_request(is_sensitive_data_exists, ingested_data,
-                                                                  user_input)
-        return SynthesizerAgent.get_synthesized_response(synthesizer_agent_request)
+        synthesizer_agent_request = await prepare_synthesizer_agent_request(request)
+        user_input = synthesizer_agent_request.user_query
+        return await SynthesizerAgent.get_synthesized_response_async(synthesizer_agent_request)
     except FileNotFoundError as fnfe:
-        print("FileNotFound Error occurred:", fnfe)
-        SynthesizerAgent.store_conversation_to_memory(user_input if user_input else request.user_input, str(fnfe))
+        logger.error("FileNotFound Error occurred: %s", fnfe)
+        await Util.run_blocking(SynthesizerAgent.store_conversation_to_memory,
+                                user_input if user_input else request.user_input, str(fnfe),
+                                request.user_id)
         return str(fnfe)
-    except Exception as ex:
-        print("Error occurred:", ex)
-        SynthesizerAgent.store_conversation_to_memory(user_input if user_input else request.user_input, ERROR_PROBLEM_OCCURRED)
+    except Exception:
+        logger.exception("Error occurred while processing the request")
+        await Util.run_blocking(SynthesizerAgent.store_conversation_to_memory,
+                                user_input if user_input else request.user_input, ERROR_PROBLEM_OCCURRED,
+                                request.user_id)
         return ERROR_PROBLEM_OCCURRED
 
+
+async def stream_response_async(request: CoordinatorAgentRequest) -> AsyncIterator[str]:
+    """Same flow as get_response_async, but the synthesized response is streamed as text deltas."""
+    instrument()
+    user_input = None
+
+    if not request.user_input or request.user_input.strip() == "":
+        await Util.run_blocking(SynthesizerAgent.store_conversation_to_memory,
+                                user_input if user_input else request.user_input, ERROR_INVALID_INPUT,
+                                request.user_id)
+        yield ERROR_INVALID_INPUT
+        return
+
+    streamed = False
+    try:
+        synthesizer_agent_request = await prepare_synthesizer_agent_request(request)
+        user_input = synthesizer_agent_request.user_query
+        async for delta in SynthesizerAgent.stream_synthesized_response(synthesizer_agent_request):
+            streamed = True
+            yield delta
+    except FileNotFoundError as fnfe:
+        logger.error("FileNotFound Error occurred: %s", fnfe)
+        await Util.run_blocking(SynthesizerAgent.store_conversation_to_memory,
+                                user_input if user_input else request.user_input, str(fnfe),
+                                request.user_id)
+        yield str(fnfe)
+    except Exception:
+        logger.exception("Error occurred while processing the request")
+        await Util.run_blocking(SynthesizerAgent.store_conversation_to_memory,
+                                user_input if user_input else request.user_input, ERROR_PROBLEM_OCCURRED,
+                                request.user_id)
+        # Part of the response may already be shown, start the error message on its own paragraph
+        yield f"\n\n{ERROR_PROBLEM_OCCURRED}" if streamed else ERROR_PROBLEM_OCCURRED
+
+
+def stream_response(request: CoordinatorAgentRequest) -> Iterator[str]:
+    return Util.iterate_in_thread(stream_response_async(request))
+
+
+@logfire.instrument("CoordinatorAgent.prepare_synthesizer_agent_request", extract_args=False)
+async def prepare_synthesizer_agent_request(request: CoordinatorAgentRequest) -> SynthesizerAgentRequest:
+    ingested_data = None
+    memory_context = None
+    # PII guard, retrieval and the memory are independent, so they run concurrently on the blocking thread pool.
+    # The retrieval keeps nothing of the raw input until it is committed, it is dropped with the memory when the
+    # input turns out to be sensitive.
+    pii_scan_result, retrieval, user_memory_context = await asyncio.gather(
+        Util.run_blocking(scan_sensitive_data, request.user_input),
+        Util.run_blocking(retrieve_ingested_data, request),
+        Util.run_blocking(SynthesizerAgent.get_memory_context, request.user_id),
+    )
+    is_sensitive_data_exists = pii_scan_result.is_sensitive_data_exists
+    if is_sensitive_data_exists:
+        user_input = pii_scan_result.masked_input
+    else:
+        user_input = request.user_input
+        # Get existing ingested data for the user
+        retrieval.commit()
+        ingested_data = retrieval.context
+        # A question that does not follow the conversation is answered without the memory, so that its cached
+        # response is shared with every user
+        memory_context = None if retrieval.standalone else user_memory_context
+
+    logger.debug("Synthesizer agent is triggered with user_input=%s, is_sensitive_data_exists=%s, ingested_data=%s",
+                 user_input, is_sensitive_data_exists, ingested_data)
+    return get_synthesizer_agent_request(is_sensitive_data_exists, ingested_data, user_input, request.user_id,
+                                         request.tenant_id, request.llm_policy, memory_context)
+
+
+def retrieve_ingested_data(request: CoordinatorAgentRequest) -> RetrievalEngine.Retrieval:
+    # The previous user messages keep follow-up questions on the topic of the conversation, the user id keeps
+    # the retrieval state of the conversation
+    history = SynthesizerAgent.get_agent_memory(request.user_id).get_recent_user_messages(
+        RetrievalEngine.HISTORY_TURNS)
+    return RagService.retrieve_ingested_data(request.user_input, request.tenant_id, request.user_id, history)
+
+
+@logfire.instrument("CoordinatorAgent.get_response", extract_args=False)
+def get_response(request: CoordinatorAgentRequest) -> Any:
+    return asyncio.run(get_response_async(request))
+
 def get_synthesizer_agent_request(is_sensitive_data_exists: bool , ingested_data: str | None,
-                                  user_input: str | None) -> SynthesizerAgentRequest:
+                                  user_input: str | None, user_id: str | None = None,
+                                  tenant_id: str | None = None,
+                                  llm_policy: LlmPolicy | None = None,
+                                  memory_context: str | None = None) -> SynthesizerAgentRequest:
     return SynthesizerAgentRequest(
         user_query=user_input,
         is_sensitive_data_exists=is_sensitive_data_exists,
-        ingestion_context=ingested_data)
+        ingestion_context=ingested_data,
+        memory_context=memory_context,
+        user_id=user_id,
+        tenant_id=tenant_id,
+        llm_policy=llm_policy)
 
 
-dataset = Dataset(
-    cases=[
-        Case(
-            name="Test whether Agent detects PII information",
-            inputs=CoordinatorAgentRequest(
-                user_input="My email is test@gmail.com",
-                user_id="abc",
-            ),
-            expected_output=Util.ERROR_GUARD_PII,
-            evaluators=(EqualsExpected(),),
-        )
-    ]
-)
-
-retrieval_dataset = Dataset(
-    cases=[
-        Case(
-            name="Retrieve answers from Agent for the questions related to EduTrack",
-            inputs=CoordinatorAgentRequest(
-                user_input="What is EduTrack used for?",
-                user_id="abc",
-            ),
-            expected_output="should contain educational",
-            evaluators=[Contains("educational")],
-        ),
-        Case(
-            name="Retrieve answer for general question",
-            inputs=CoordinatorAgentRequest(
-                user_input="Who is the prime minister of India",
-                user_id="abc",
+def get_eval_datasets():
+    # pydantic_evals is only imported to run the evaluations
+    from pydantic_evals import Case, Dataset
+    from pydantic_evals.evaluators import EqualsExpected, Contains
+
+    dataset = Dataset(
+        cases=[
+            Case(
+                name="Test whether Agent detects PII information",
+                inputs=CoordinatorAgentRequest(
+                    user_input="My email is test@gmail.com",
+                    user_id="abc",
+                ),
+                expected_output=Util.ERROR_GUARD_PII,
+                evaluators=(EqualsExpected(),),
+            )
+        ]
+    )
+
+    retrieval_dataset = Dataset(
+        cases=[
+            Case(
+                name="Retrieve answers from Agent for the questions related to EduTrack",
+                inputs=CoordinatorAgentRequest(
+                    user_input="What is EduTrack used for?",
+                    user_id="abc",
+                ),
+                expected_output="should contain educational",
+                evaluators=[Contains("educational")],
             ),
-            expected_output=Util.CANNOT_PROCESS_MESSAGE,
-            evaluators=[Contains(Util.CANNOT_PROCESS_MESSAGE)],
-        )
-    ]
-)
+            Case(
+                name="Retrieve answer for general question",
+                inputs=CoordinatorAgentRequest(
+                    user_input="Who is the prime minister of India",
+                    user_id="abc",
+                ),
+                expected_output=Util.CANNOT_PROCESS_MESSAGE,
+                evaluators=[Contains(Util.CANNOT_PROCESS_MESSAGE)],
+            )
+        ]
+    )
+    return dataset, retrieval_dataset
+
 
 if __name__ == "__main__":
-    report = dataset.evaluate_sync(get_response)
-    retrieval_report = retrieval_dataset.evaluate_sync(get_response)
+    dataset, retrieval_dataset = get_eval_datasets()
+    report = dataset.evaluate_sync(get_response_async)
+    retrieval_report = retrieval_dataset.evaluate_sync(get_response_async)
     combined_report = report
     combined_report.cases.extend(retrieval_report.cases)
     combined_report.print(include_expected_output=True, include_input=True, include_output=True, width=300)
@@ -1,5 +1,10 @@
 from pydantic import BaseModel
+from agents.synthesizeragent.models.llm_policy import LlmPolicy
 
 class CoordinatorAgentRequest(BaseModel):
     user_input: str
-    user_id:str
\ No newline at end of file
+    user_id:str
+    # Knowledge collection the request is answered from, the shared collection when not set
+    tenant_id: str | None = None
+    # Passed on to the synthesizer, the configured defaults when not set
+    llm_policy: LlmPolicy | None = None
@@ -0,0 +1,5 @@
+from pydantic import BaseModel
+
+class PiiScanResult(BaseModel):
+    is_sensitive_data_exists: bool
+    masked_input: str
@@ -1,36 +1,63 @@
 import datetime
-import json
+import heapq
 import os
+import threading
+from collections import deque
 from typing import Any, Optional, Dict, List
+import numpy as np
+from agents.memory.conversation_store import ConversationStore
+from agents.memory.working_memory import WorkingMemory
+import rag.embedding_service as EmbeddingService
+from util import Util
+
+DEFAULT_USER_ID = "default"
+# Number of the most recent conversations included in the context for the LLM
+RECENT_CONVERSATIONS_IN_CONTEXT = 3
+# Embed every conversation so that it can also be searched semantically
+SEMANTIC_SEARCH_ENABLED = os.getenv("MEMORY_SEMANTIC_SEARCH_ENABLED", "false").lower() == "true"
+MEMORY_DB_PATH = os.getenv("MEMORY_DB_PATH",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversations.db'))
+# Where the conversations were kept before the store, imported for the default user into an empty store
+LEGACY_CONVERSATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conversations.json')
+
+_default_store: Optional[ConversationStore] = None
+_default_store_lock = threading.Lock()
+
+
+def get_default_store() -> ConversationStore:
+    """Conversation store shared by all the AgentMemory instances of the process."""
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                _default_store = ConversationStore(MEMORY_DB_PATH, LEGACY_CONVERSATIONS_FILE, DEFAULT_USER_ID)
+    return _default_store
 
 
 class AgentMemory:
-    def __init__(self, memory_size: int=10):
+    def __init__(self, memory_size: int=10, user_id: str=DEFAULT_USER_ID, store: Optional[ConversationStore]=None,
+                 semantic_search: bool=SEMANTIC_SEARCH_ENABLED, working_memory_token_budget: Optional[int]=None):
         current_dir = os.path.dirname(os.path.abspath(__file__))
         self.storage_dir = current_dir
         self.memory_size = memory_size
+        self.user_id = user_id
 
-        self.conversations_file = os.path.join(current_dir, 'conversations.json')
-        self.conversations = self._load_json(self.conversations_file, default=[])
+        # Conversations are appended to the store and read back lazily, only for this user
+        self.store = store if store is not None else get_default_store()
+        self.lock = threading.Lock()
 
-        # Working memory (stays in RAM)
-        self.working_memory = []
+        # Conversation embeddings of this user, loaded from the store on the first semantic search
+        self.semantic_search = semantic_search
+        self.embedding_ids: List[int] = []
+        self.embedding_matrix: Optional[np.ndarray] = None
+
+        # Working memory (stays in RAM), bounded by item count and optionally by tokens
+        self.working_memory = WorkingMemory(capacity=memory_size, token_budget=working_memory_token_budget)
         self.working_memory_capacity = memory_size
 
-    def _load_json(self, file_path: str, default:Any = None) -> list:
-        """Load data from JSON file or return default if file doesn't exist"""
-        if os.path.exists(file_path):
-            try:
-                with open(file_path, 'r') as f:
-                    return json.load(f)
-            except json.decoder.JSONDecodeError:
-                return default
-        return default
-
-    def _save_json(self, date:Any, file_path:str) -> None:
-        """Save data to JSON file """
-        with open(file_path, 'w') as f:
-            json.dump(date, f, indent=2)
+        # (user line, agent line) of the recent conversations, loaded from the store on first use then kept up to
+        # date on every add
+        self.recent_conversation_lines: Optional[deque] = None
 
     def add_conversation(self, user_message:str, agent_response:str,  metadata:Optional[Dict[str, Any]]=None) -> None:
         """Add conversation to memory."""
@@ -40,77 +67,94 @@ class AgentMemory:
             'timestamp': datetime.datetime.now().isoformat(),
             'metadata': metadata
         }
-        self.conversations.append(conversation)
-        self._save_json(self.conversations, self.conversations_file)
-        # Also update working memory
-        self.add_to_working_memory(f"User: {user_message}", importance=1.0)
-        self.add_to_working_memory(f"Agent: {agent_response}", importance=0.9)
+        embedding = None
+        if self.semantic_search:
+            embedding = np.asarray(
+                EmbeddingService.encode_documents([f"{user_message} {agent_response}"])[0], dtype=np.float32
+            ).tobytes()
+        # Stored and added to the recent lines under the same lock, a context generated in between would load the
+        # new conversation from the store and then get it a second time
+        with self.lock:
+            self.store.append(self.user_id, conversation, embedding)
+            # Also update working memory
+            user_line, agent_line = self._conversation_lines(conversation)
+            if self.recent_conversation_lines is not None:
+                self.recent_conversation_lines.append((user_line, agent_line))
+            self.add_to_working_memory(user_line, importance=1.0)
+            self.add_to_working_memory(agent_line, importance=0.9)
 
     def add_to_working_memory(self, content: str, importance: float = 1.0) -> None:
-        """Add an item to working memory with importance score."""
-        item = {
-            "content": content,
-            "importance": importance,
-            "timestamp": datetime.datetime.now().isoformat(),
-        }
-        self.working_memory.append(item)
+        """Add an item to working memory with importance score, evicting the least important item when full."""
+        self.working_memory.add(content, importance)
+
+    def search_conversations(self, query: str, limit: int = 3, semantic: bool = False) -> List[Dict[str, Any]]:
+        """Search past conversations, ranked by BM25 over the store's inverted index or by embedding similarity."""
+        if semantic and self.semantic_search:
+            return self._semantic_search_conversations(query, limit)
+        return self.store.search(self.user_id, query, limit)
+
+    def _semantic_search_conversations(self, query: str, limit: int) -> List[Dict[str, Any]]:
+        with self.lock:
+            # Only the embeddings stored since the last search are read from the store
+            last_id = self.embedding_ids[-1] if self.embedding_ids else 0
+            rows = self.store.get_embeddings(self.user_id, after_id=last_id)
+            if rows:
+                new_embeddings = np.stack([np.frombuffer(embedding, dtype=np.float32) for _, embedding in rows])
+                new_embeddings /= np.maximum(np.linalg.norm(new_embeddings, axis=1, keepdims=True), 1e-12)
+                self.embedding_ids.extend(conversation_id for conversation_id, _ in rows)
+                self.embedding_matrix = (new_embeddings if self.embedding_matrix is None
+                                         else np.vstack([self.embedding_matrix, new_embeddings]))
+            if self.embedding_matrix is None:
+                return []
+            embedding_ids = self.embedding_ids
+            embedding_matrix = self.embedding_matrix
+        query_embedding = np.asarray(EmbeddingService.encode_query(query), dtype=np.float32)
+        similarities = embedding_matrix @ (query_embedding / max(np.linalg.norm(query_embedding), 1e-12))
+        top = heapq.nlargest(limit, range(len(similarities)), key=similarities.__getitem__)
+        return self.store.get_by_ids([embedding_ids[index] for index in top])
 
-        # If over capacity, remove least important items
-        if len(self.working_memory) > self.working_memory_capacity:
-            self.working_memory.sort(key=lambda x: (x["importance"], x["timestamp"]))
-            self.working_memory = self.working_memory[1:]  # Remove least important
-
-    def search_conversations(self, query: str, limit: int = 3) -> List[Dict[str, Any]]:
-        """Simple keyword search for past conversations."""
-        query_terms = query.lower().split()
-        results = []
+    def get_recent_conversations(self, count: int = 5) -> List[Dict[str, Any]]:
+        """Get the most recent conversations."""
+        return self.store.get_recent(self.user_id, count)
 
-        for conv in self.conversations:
-            text = f"{conv['user_message']} {conv['agent_response']}".lower()
-            # Score based on number of matching terms
-            score = sum(1 for term in query_terms if term in text)
-            if score > 0:
-                results.append((conv, score))
+    def get_recent_user_messages(self, count: int = 3) -> List[str]:
+        """User messages of the most recent conversations, oldest first."""
+        return [conversation['user_message'] for conversation in self.get_recent_conversations(count)
+                if conversation['user_message']]
 
-        # Sort by score (descending) and return top matches
-        results.sort(key=lambda x: x[1], reverse=True)
-        return [item[0] for item in results[:limit]]
+    def generate_context_for_llm(self, token_budget: Optional[int] = None) -> str:
+        """Generate a context string for the LLM using relevant memory.
 
-    def get_recent_conversations(self, count: int = 5) -> List[Dict[str, Any]]:
-        """Get the most recent conversations."""
-        return (
-            self.conversations[-count:]
-            if len(self.conversations) >= count
-            else self.conversations
-        )
-
-    def generate_context_for_llm(self) -> str:
-        """Generate a context string for the LLM using relevant memory."""
-        # Get working memory
-        working_items = sorted(
-            self.working_memory,
-            key=lambda x: (x["importance"], x["timestamp"]),
-            reverse=True,
-        )
-        working_memory_text = "\n".join(
-            [f"- {item['content']}" for item in working_items]
-        )
-
-        # Get recent conversations
-        recent = self.get_recent_conversations(count=3)
-        recent_text = "\n".join(
-            [
-                f"User: {conv['user_message']}\nAgent: {conv['agent_response']}"
-                for conv in recent
-            ]
-        )
-
-        # Combine everything into a context string
-        context = f"""
-        ### Current Context (Working Memory):
-        {working_memory_text}
-        
-        ### Recent Conversation History:
-        {recent_text}
+        With a token budget, the recent conversations are kept first (newest first) and the working memory fills
+        the remaining budget. The working memory items already in the recent conversations are left out, every
+        turn is in the context once.
         """
-        return context.strip()
\ No newline at end of file
+        with self.lock:
+            if self.recent_conversation_lines is None:
+                self.recent_conversation_lines = deque(
+                    (self._conversation_lines(conv)
+                     for conv in self.get_recent_conversations(count=RECENT_CONVERSATIONS_IN_CONTEXT)),
+                    maxlen=RECENT_CONVERSATIONS_IN_CONTEXT,
+                )
+            recent_lines = list(self.recent_conversation_lines)
+            if token_budget is not None:
+                kept = []
+                for lines in reversed(recent_lines):
+                    tokens = Util.estimate_tokens("\n".join(lines))
+                    if tokens > token_budget:
+                        break
+                    kept.append(lines)
+                    token_budget -= tokens
+                recent_lines = kept[::-1]
+            working_memory_text = self.working_memory.render(
+                token_budget, exclude=frozenset(line for lines in recent_lines for line in lines))
+        recent_text = "\n".join(line for lines in recent_lines for line in lines)
+
+        # Combine everything into a context string, the working memory once it holds more than the recent turns
+        working_memory_section = (f"### Current Context (Working Memory):\n{working_memory_text}\n\n"
+                                  if working_memory_text else "")
+        return f"{working_memory_section}### Recent Conversation History:\n{recent_text}"
+
+    @staticmethod
+    def _conversation_lines(conversation: Dict[str, Any]) -> tuple[str, str]:
+        return f"User: {conversation['user_message']}", f"Agent: {conversation['agent_response']}"
@@ -0,0 +1,284 @@
+import datetime
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Optional
+import rag.bm25 as Bm25
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationStore:
+    """Append-only conversation log partitioned by user, stored in SQLite in WAL mode.
+
+    Every turn is a single indexed insert, so the write cost does not depend on the stored history, and reads
+    only touch the rows of the requesting user. WAL mode lets readers run alongside a writer, and the busy
+    timeout makes concurrent writers (threads or processes) wait for each other instead of failing.
+
+    The store also keeps a per user inverted index (term postings and collection statistics) updated in the
+    same transaction as the insert, which backs the BM25 keyword search, and optionally the embedding of every
+    conversation for semantic search.
+
+    `legacy_conversations_file` is the json file the conversations were kept in before the store, it is imported
+    once for `legacy_user_id` when the store is still empty.
+    """
+
+    def __init__(self, db_path: str, legacy_conversations_file: Optional[str] = None,
+                 legacy_user_id: Optional[str] = None):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA busy_timeout=5000")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                user_message TEXT,
+                agent_response TEXT,
+                timestamp TEXT NOT NULL,
+                metadata TEXT,
+                term_count INTEGER
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations (user_id, id)"
+        )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(conversations)")]
+        if "term_count" not in columns:
+            self.connection.execute("ALTER TABLE conversations ADD COLUMN term_count INTEGER")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS conversation_terms (
+                user_id TEXT NOT NULL,
+                term TEXT NOT NULL,
+                conversation_id INTEGER NOT NULL,
+                term_frequency INTEGER NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversation_terms_term ON conversation_terms (user_id, term)"
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS conversation_stats (
+                user_id TEXT PRIMARY KEY,
+                conversation_count INTEGER NOT NULL,
+                total_term_count INTEGER NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS conversation_embeddings (
+                conversation_id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                embedding BLOB NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversation_embeddings_user_id "
+            "ON conversation_embeddings (user_id, conversation_id)"
+        )
+        if legacy_conversations_file is not None and legacy_user_id is not None:
+            self._import_legacy_conversations(legacy_conversations_file, legacy_user_id)
+        self._index_pending_conversations()
+
+    def append(self, user_id: str, conversation: Dict[str, Any], embedding: Optional[bytes] = None) -> int:
+        """Append a conversation for the user, index it and return its id."""
+        term_frequencies, term_count = Bm25.term_frequencies(self._searchable_text(conversation))
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self.connection.execute(
+                    "INSERT INTO conversations (user_id, user_message, agent_response, timestamp, metadata, term_count) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        user_id,
+                        conversation['user_message'],
+                        conversation['agent_response'],
+                        conversation['timestamp'],
+                        json.dumps(conversation['metadata']) if conversation['metadata'] is not None else None,
+                        term_count,
+                    ),
+                )
+                conversation_id = cursor.lastrowid
+                self._index_conversation(user_id, conversation_id, term_frequencies, term_count)
+                if embedding is not None:
+                    self.connection.execute(
+                        "INSERT INTO conversation_embeddings (conversation_id, user_id, embedding) VALUES (?, ?, ?)",
+                        (conversation_id, user_id, embedding),
+                    )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            return conversation_id
+
+    def search(self, user_id: str, query: str, limit: int) -> List[Dict[str, Any]]:
+        """Top `limit` conversations of the user for the query, ranked by BM25."""
+        terms = list(dict.fromkeys(Bm25.tokenize(query)))
+        if not terms:
+            return []
+        with self.lock:
+            stats = self.connection.execute(
+                "SELECT conversation_count, total_term_count FROM conversation_stats WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if stats is None or stats[0] == 0:
+                return []
+            postings = self.connection.execute(
+                "SELECT t.term, t.conversation_id, t.term_frequency, c.term_count "
+                "FROM conversation_terms t JOIN conversations c ON c.id = t.conversation_id "
+                f"WHERE t.user_id = ? AND t.term IN ({','.join('?' * len(terms))})",
+                (user_id, *terms),
+            ).fetchall()
+        conversation_count, total_term_count = stats
+        average_length = total_term_count / conversation_count
+        postings_by_term = defaultdict(list)
+        for term, conversation_id, term_frequency, term_count in postings:
+            postings_by_term[term].append((conversation_id, term_frequency, term_count))
+        scores = defaultdict(float)
+        for term_postings in postings_by_term.values():
+            term_idf = Bm25.idf(len(term_postings), conversation_count)
+            for conversation_id, term_frequency, term_count in term_postings:
+                scores[conversation_id] += Bm25.term_score(term_frequency, term_idf, term_count, average_length)
+        # Newer conversations win ties
+        top = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+        return self.get_by_ids([conversation_id for conversation_id, _ in top])
+
+    def get_embeddings(self, user_id: str, after_id: int = 0) -> List[tuple]:
+        """(conversation id, embedding bytes) of the user, for the conversations after the given id."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT conversation_id, embedding FROM conversation_embeddings "
+                "WHERE user_id = ? AND conversation_id > ? ORDER BY conversation_id",
+                (user_id, after_id),
+            ).fetchall()
+
+    def get_by_ids(self, conversation_ids: List[int]) -> List[Dict[str, Any]]:
+        """Get the conversations in the order of the given ids."""
+        if not conversation_ids:
+            return []
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, user_message, agent_response, timestamp, metadata FROM conversations "
+                f"WHERE id IN ({','.join('?' * len(conversation_ids))})",
+                conversation_ids,
+            ).fetchall()
+        conversations = {row[0]: self._to_conversation(row) for row in rows}
+        return [conversations[conversation_id] for conversation_id in conversation_ids if conversation_id in conversations]
+
+    def get_recent(self, user_id: str, count: int) -> List[Dict[str, Any]]:
+        """Get the most recent conversations of the user, oldest first."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, user_message, agent_response, timestamp, metadata FROM conversations "
+                "WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, count),
+            ).fetchall()
+        return [self._to_conversation(row) for row in reversed(rows)]
+
+    def iter_conversations(self, user_id: str, batch_size: int = 500) -> Iterator[Dict[str, Any]]:
+        """Iterate over all the conversations of the user in insertion order, reading them in batches."""
+        last_id = 0
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT id, user_message, agent_response, timestamp, metadata FROM conversations "
+                    "WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?",
+                    (user_id, last_id, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._to_conversation(row)
+            last_id = rows[-1][0]
+
+    def count(self, user_id: str) -> int:
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM conversations WHERE user_id = ?", (user_id,)
+            ).fetchone()[0]
+
+    def _index_conversation(self, user_id: str, conversation_id: int, term_frequencies: dict, term_count: int) -> None:
+        self.connection.executemany(
+            "INSERT INTO conversation_terms (user_id, term, conversation_id, term_frequency) VALUES (?, ?, ?, ?)",
+            [(user_id, term, conversation_id, term_frequency) for term, term_frequency in term_frequencies.items()],
+        )
+        self.connection.execute(
+            "INSERT INTO conversation_stats (user_id, conversation_count, total_term_count) VALUES (?, 1, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET conversation_count = conversation_count + 1, "
+            "total_term_count = total_term_count + excluded.total_term_count",
+            (user_id, term_count),
+        )
+
+    def _import_legacy_conversations(self, file_path: str, user_id: str) -> None:
+        if not os.path.exists(file_path):
+            return
+        try:
+            with open(file_path, 'r') as f:
+                conversations = json.load(f)
+        except json.decoder.JSONDecodeError:
+            logger.warning("Could not import the conversations of %s, the file is not valid json", file_path)
+            return
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Only into an empty store, so that the import happens once even with several processes starting
+            if self.connection.execute("SELECT 1 FROM conversations LIMIT 1").fetchone() is None:
+                # term_count is left empty, the conversations are indexed with the other pending ones
+                self.connection.executemany(
+                    "INSERT INTO conversations (user_id, user_message, agent_response, timestamp, metadata) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (
+                            user_id,
+                            conversation.get('user_message'),
+                            conversation.get('agent_response'),
+                            conversation.get('timestamp') or datetime.datetime.now().isoformat(),
+                            json.dumps(conversation['metadata']) if conversation.get('metadata') is not None else None,
+                        )
+                        for conversation in conversations
+                    ],
+                )
+                logger.info("Imported %d conversations from %s", len(conversations), file_path)
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def _index_pending_conversations(self) -> None:
+        # Conversations stored before the index existed
+        while True:
+            # Read under the write lock, so that processes starting together don't index the same conversations
+            self.connection.execute("BEGIN IMMEDIATE")
+            rows = self.connection.execute(
+                "SELECT id, user_id, user_message, agent_response FROM conversations "
+                "WHERE term_count IS NULL ORDER BY id LIMIT 500"
+            ).fetchall()
+            if not rows:
+                self.connection.execute("COMMIT")
+                return
+            for conversation_id, user_id, user_message, agent_response in rows:
+                term_frequencies, term_count = Bm25.term_frequencies(
+                    self._searchable_text({'user_message': user_message, 'agent_response': agent_response})
+                )
+                self._index_conversation(user_id, conversation_id, term_frequencies, term_count)
+                self.connection.execute(
+                    "UPDATE conversations SET term_count = ? WHERE id = ?", (term_count, conversation_id)
+                )
+            self.connection.execute("COMMIT")
+
+    @staticmethod
+    def _searchable_text(conversation: Dict[str, Any]) -> str:
+        return f"{conversation['user_message'] or ''} {conversation['agent_response'] or ''}"
+
+    @staticmethod
+    def _to_conversation(row: tuple) -> Dict[str, Any]:
+        return {
+            'id': row[0],
+            'user_message': row[1],
+            'agent_response': row[2],
+            'timestamp': row[3],
+            'metadata': json.loads(row[4]) if row[4] is not None else None,
+        }
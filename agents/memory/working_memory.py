@@ -0,0 +1,80 @@
+import heapq
+import itertools
+import time
+from typing import List, Optional
+from util import Util
+
+
+class WorkingMemoryItem:
+    __slots__ = ("content", "importance", "timestamp", "sequence", "tokens", "line")
+
+    def __init__(self, content: str, importance: float, timestamp: float, sequence: int):
+        self.content = content
+        self.importance = importance
+        self.timestamp = timestamp
+        self.sequence = sequence
+        # Rendered once, reused by every context rendering
+        self.line = f"- {content}"
+        self.tokens = Util.estimate_tokens(self.line)
+
+    def __lt__(self, other: "WorkingMemoryItem") -> bool:
+        # Least important first, then oldest first
+        return (self.importance, self.timestamp, self.sequence) < (other.importance, other.timestamp, other.sequence)
+
+
+class WorkingMemory:
+    """Bounded working memory, the least important (then oldest) item is evicted from a min-heap.
+
+    The capacity is a number of items, a number of tokens, or both. The rendered text is cached and only
+    rebuilt after the content changed.
+    """
+
+    def __init__(self, capacity: Optional[int] = 10, token_budget: Optional[int] = None):
+        self.capacity = capacity
+        self.token_budget = token_budget
+        self.heap: List[WorkingMemoryItem] = []
+        self.total_tokens = 0
+        self.sequence = itertools.count()
+        # Rendered text per token budget and excluded contents, dropped whenever the content changes
+        self.rendered: dict[tuple[Optional[int], frozenset], str] = {}
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def add(self, content: str, importance: float = 1.0) -> None:
+        item = WorkingMemoryItem(content, importance, time.time(), next(self.sequence))
+        heapq.heappush(self.heap, item)
+        self.total_tokens += item.tokens
+        while len(self.heap) > 1 and self._over_capacity():
+            self.total_tokens -= heapq.heappop(self.heap).tokens
+        self.rendered.clear()
+
+    def items(self) -> List[WorkingMemoryItem]:
+        """Items from the most to the least important."""
+        return sorted(self.heap, reverse=True)
+
+    def render(self, token_budget: Optional[int] = None, exclude: frozenset = frozenset()) -> str:
+        """Render the items, most important first, keeping to the token budget when one is given.
+
+        The items whose content is in `exclude` are skipped.
+        """
+        cached = self.rendered.get((token_budget, exclude))
+        if cached is not None:
+            return cached
+        lines = []
+        used_tokens = 0
+        for item in self.items():
+            if item.content in exclude:
+                continue
+            if token_budget is not None and used_tokens + item.tokens > token_budget:
+                break
+            lines.append(item.line)
+            used_tokens += item.tokens
+        text = "\n".join(lines)
+        self.rendered[(token_budget, exclude)] = text
+        return text
+
+    def _over_capacity(self) -> bool:
+        if self.capacity is not None and len(self.heap) > self.capacity:
+            return True
+        return self.token_budget is not None and self.total_tokens > self.token_budget
@@ -0,0 +1,272 @@
+import asyncio
+import contextlib
+import logging
+import os
+import random
+import threading
+from collections import deque
+from typing import TYPE_CHECKING, Any, AsyncIterator
+import logfire
+import observability
+from agents.synthesizeragent.models.llm_policy import LlmPolicy
+
+if TYPE_CHECKING:
+    from pydantic_ai import Agent
+    from pydantic_ai.models import Model
+
+logger = logging.getLogger(__name__)
+
+# Model calls in flight across all the event loops of the process, the hedged and fallback requests included
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# Status codes worth another attempt, the other 4xx fail straight away
+RETRYABLE_STATUS_CODES = (408, 409, 425, 429, 500, 502, 503, 504)
+
+
+class LlmUnavailableError(Exception):
+    pass
+
+
+def _optional_float(name: str, default: str = "") -> float | None:
+    value = os.getenv(name, default)
+    return float(value) if value else None
+
+
+def get_default_policy() -> LlmPolicy:
+    return LlmPolicy(
+        model=os.getenv("LLM_MODEL") or None,
+        timeout_seconds=float(os.getenv("LLM_TIMEOUT_SECONDS", "30")),
+        deadline_seconds=float(os.getenv("LLM_DEADLINE_SECONDS", "60")),
+        max_attempts=int(os.getenv("LLM_MAX_ATTEMPTS", "3")),
+        backoff_base_seconds=float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5")),
+        backoff_max_seconds=float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "4")),
+        hedge_after_seconds=_optional_float("LLM_HEDGE_AFTER_SECONDS"),
+        fallback_model=os.getenv("LLM_FALLBACK_MODEL", "google-gla:gemini-2.5-flash") or None,
+        fallback_after_seconds=_optional_float("LLM_FALLBACK_AFTER_SECONDS"),
+    )
+
+
+class _ConcurrencyLimiter:
+    """Semaphore shared by the event loops of all the threads.
+
+    The sync entry points run their own loop (asyncio.run) and the streaming runs on a background thread, so an
+    asyncio.Semaphore, bound to a single loop, cannot be shared between them. A released slot is handed over to
+    the oldest waiter, on the waiter's loop.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self.lock = threading.Lock()
+
+    async def __aenter__(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.active < self.limit and not self.waiters:
+                self.active += 1
+                return
+            future = loop.create_future()
+            self.waiters.append((loop, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.lock:
+                with contextlib.suppress(ValueError):
+                    self.waiters.remove((loop, future))
+            # The slot was handed over just before the cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.release()
+
+    def release(self) -> None:
+        with self.lock:
+            while self.waiters:
+                loop, future = self.waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._hand_over, future)
+                    return
+                except RuntimeError:
+                    # The waiter's loop is closed
+                    continue
+            self.active -= 1
+
+    def _hand_over(self, future: asyncio.Future) -> None:
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+_limiter = _ConcurrencyLimiter(LLM_MAX_CONCURRENCY)
+_models: dict[str, "Model"] = {}
+_models_lock = threading.Lock()
+
+
+def get_model(name: str) -> "Model":
+    """Model instance per name, so that the provider and its http client are created once."""
+    model = _models.get(name)
+    if model is None:
+        with _models_lock:
+            model = _models.get(name)
+            if model is None:
+                from pydantic_ai.models import infer_model
+                model = infer_model(name)
+                _models[name] = model
+    return model
+
+
+def get_retry_reason(error: BaseException) -> str | None:
+    """Reason reported for a retryable error, None when another attempt would fail the same way."""
+    from pydantic_ai.exceptions import ModelAPIError, ModelHTTPError
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    if isinstance(error, ModelHTTPError):
+        return str(error.status_code) if error.status_code in RETRYABLE_STATUS_CODES else None
+    if isinstance(error, (ModelAPIError, ConnectionError)):
+        return type(error).__name__
+    try:
+        import httpx
+    except ImportError:
+        return None
+    return type(error).__name__ if isinstance(error, httpx.TransportError) else None
+
+
+def get_backoff(policy: LlmPolicy, attempt: int) -> float:
+    return random.uniform(0, min(policy.backoff_max_seconds, policy.backoff_base_seconds * 2 ** attempt))
+
+
+@logfire.instrument("LlmClient.run")
+async def run(agent: "Agent", user_prompt: str, deps: Any, policy: LlmPolicy,
+              default_model: str) -> str:
+    """Output of an agent run, with the deadline, retries, hedging and fallback of the policy.
+
+    Each attempt sends the request to the primary model, a hedged copy after hedge_after_seconds and the
+    fallback model after fallback_after_seconds, and takes the first answer. When the attempts are exhausted,
+    the fallback model gets a last attempt within what is left of the deadline.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + policy.deadline_seconds
+    primary = policy.model or default_model
+    last_error: BaseException | None = None
+    for attempt in range(policy.max_attempts):
+        launches = [(0.0, primary, "primary")]
+        if policy.hedge_after_seconds is not None:
+            launches.append((policy.hedge_after_seconds, primary, "hedge"))
+        if policy.fallback_model and policy.fallback_after_seconds is not None:
+            launches.append((policy.fallback_after_seconds, policy.fallback_model, "fallback"))
+        try:
+            return await _run_attempt(agent, user_prompt, deps, launches,
+                                      min(policy.timeout_seconds, deadline - loop.time()))
+        except Exception as e:
+            reason = get_retry_reason(e)
+            if reason is None:
+                raise
+            last_error = e
+            observability.llm_retries.add(1, {"reason": reason})
+            logger.warning("LLM attempt %d of %d failed (%s)", attempt + 1, policy.max_attempts, reason)
+        backoff = get_backoff(policy, attempt)
+        if attempt + 1 == policy.max_attempts or loop.time() + backoff >= deadline:
+            break
+        await asyncio.sleep(backoff)
+
+    if policy.fallback_model and deadline - loop.time() > 0:
+        observability.llm_fallbacks.add(1, {"reason": "failed"})
+        try:
+            return await _run_attempt(agent, user_prompt, deps, [(0.0, policy.fallback_model, "fallback")],
+                                      min(policy.timeout_seconds, deadline - loop.time()))
+        except Exception as e:
+            if get_retry_reason(e) is None:
+                raise
+            last_error = e
+    raise LlmUnavailableError(f"No answer from the LLM within the policy: {last_error!r}") from last_error
+
+
+async def _run_attempt(agent: "Agent", user_prompt: str, deps: Any, launches: list[tuple[float, str, str]],
+                       timeout: float) -> str:
+    """First answer of the launches (delay, model name, kind), the others are cancelled."""
+    if timeout <= 0:
+        raise TimeoutError()
+    started: set[str] = set()
+
+    async def launch(delay: float, model_name: str, kind: str) -> str:
+        if delay:
+            await asyncio.sleep(delay)
+            if kind == "hedge":
+                observability.llm_hedged_requests.add(1)
+            else:
+                observability.llm_fallbacks.add(1, {"reason": "slow"})
+        started.add(kind)
+        async with _limiter:
+            result = await agent.run(user_prompt, deps=deps, model=get_model(model_name))
+        return result.output
+
+    async with asyncio.timeout(timeout):
+        tasks = {asyncio.create_task(launch(*item)): item[2] for item in launches}
+        pending = set(tasks)
+        errors: list[BaseException] = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                errors.extend(task.exception() for task in done if task.exception() is not None)
+                answered = [task for task in done if task.exception() is None]
+                if answered:
+                    return answered[0].result()
+                # Every request sent so far failed, retrying beats waiting for the delayed ones
+                if all(tasks[task] not in started for task in pending):
+                    break
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+                # A cancelled run can end with an error of its task group instead of CancelledError
+                task.add_done_callback(lambda cancelled: cancelled.cancelled() or cancelled.exception())
+
+
+async def stream(agent: "Agent", user_prompt: str, deps: Any, policy: LlmPolicy,
+                 default_model: str) -> AsyncIterator[str]:
+    """Text deltas of an agent run, with the deadline, retries and fallback of the policy.
+
+    The attempts are retried, and finally sent to the fallback model, only until the first token. A stream that
+    fails after it raises, the deltas already shown cannot be taken back. Streams are not hedged.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + policy.deadline_seconds
+    models = [policy.model or default_model] * policy.max_attempts
+    if policy.fallback_model:
+        models.append(policy.fallback_model)
+    last_error: BaseException | None = None
+    for attempt, model_name in enumerate(models):
+        timeout = min(policy.timeout_seconds, deadline - loop.time())
+        if timeout <= 0:
+            break
+        if attempt == policy.max_attempts:
+            observability.llm_fallbacks.add(1, {"reason": "failed"})
+        async with contextlib.AsyncExitStack() as stack:
+            try:
+                async with asyncio.timeout(timeout):
+                    await stack.enter_async_context(_limiter)
+                    result = await stack.enter_async_context(
+                        agent.run_stream(user_prompt, deps=deps, model=get_model(model_name)))
+                    deltas = aiter(result.stream_text(delta=True))
+                    delta = await anext(deltas, None)
+            except Exception as e:
+                reason = get_retry_reason(e)
+                if reason is None:
+                    raise
+                last_error = e
+                observability.llm_retries.add(1, {"reason": reason})
+                logger.warning("LLM stream attempt %d of %d failed (%s)", attempt + 1, len(models), reason)
+            else:
+                while delta is not None:
+                    yield delta
+                    async with asyncio.timeout(policy.timeout_seconds):
+                        delta = await anext(deltas, None)
+                return
+        backoff = get_backoff(policy, attempt) if attempt + 1 < policy.max_attempts else 0.0
+        if loop.time() + backoff >= deadline:
+            break
+        await asyncio.sleep(backoff)
+    raise LlmUnavailableError(f"No answer from the LLM within the policy: {last_error!r}") from last_error
@@ -1,89 +1,276 @@
-from typing import Any
+from typing import TYPE_CHECKING, Any, AsyncIterator
 from agents.synthesizeragent.models.synthesizer_agent_request import SynthesizerAgentRequest
+from agents.synthesizeragent.models.llm_policy import LlmPolicy
 from util import Util
-from pydantic_ai import Agent
-from agents.memory.agent_memory import AgentMemory
+from agents.memory.agent_memory import AgentMemory, DEFAULT_USER_ID
+from agents.synthesizeragent.prompt_builder import PromptBuilder
+from agents.synthesizeragent.response_cache import SemanticResponseCache
+import agents.synthesizeragent.llm_client as LlmClient
+import rag.embedding_service as EmbeddingService
+import rag.rag_service as RagService
 import logfire
-from pydantic_evals import Case, Dataset
-from pydantic_evals.evaluators import Contains
+import observability
+from opentelemetry.metrics import Observation
 import os
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+if TYPE_CHECKING:
+    from pydantic_ai import Agent
+
+logger = logging.getLogger(__name__)
 
 MODEL_GOOGLE_GEMINI = "google-gla:gemini-2.5-pro"
 
-agent_memory = AgentMemory()
+prompt_builder = PromptBuilder(os.path.join(os.path.dirname(os.path.abspath(__file__)), "instructions.md"))
+_agent: "Agent[SynthesizerAgentRequest, str] | None" = None
+_agent_lock = threading.Lock()
+
+# One memory per active user, the least recently used ones are dropped (their conversations stay in the store)
+MAX_ACTIVE_MEMORIES = int(os.getenv("MAX_ACTIVE_MEMORIES", "1000"))
+# Tokens of the memory of the conversation included in the prompt
+MEMORY_CONTEXT_TOKEN_BUDGET = int(os.getenv("MEMORY_CONTEXT_TOKEN_BUDGET", "500"))
+agent_memories: OrderedDict[str, AgentMemory] = OrderedDict()
+agent_memories_lock = threading.Lock()
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+_response_cache: SemanticResponseCache | None = None
+_response_cache_lock = threading.Lock()
+
+# Timeouts, retries, hedging and fallback of the requests without their own policy (LLM_* environment variables)
+DEFAULT_LLM_POLICY = LlmClient.get_default_policy()
+
+@logfire.instrument("SynthesizerAgent.get_synthesized_response_async")
+async def get_synthesized_response_async(request: SynthesizerAgentRequest
+                                         ) -> Any:
+    if request.is_sensitive_data_exists:
+        await Util.run_blocking(store_conversation_to_memory, request.user_query, Util.ERROR_GUARD_PII,
+                                request.user_id)
+        return Util.ERROR_GUARD_PII
+    cached_response = await Util.run_blocking(lookup_cached_response, request)
+    if cached_response is not None:
+        await Util.run_blocking(store_conversation_to_memory, request.user_query, cached_response,
+                                request.user_id)
+        return cached_response
+    with observability.record_latency(observability.llm_latency, streamed=False):
+        output = await LlmClient.run(get_agent(), request.user_query, request, get_llm_policy(request),
+                                     MODEL_GOOGLE_GEMINI)
+    logger.debug("Response from synthesizerAgent=%s", output)
+    await Util.run_blocking(cache_response, request, output)
+    await Util.run_blocking(store_conversation_to_memory, request.user_query, output, request.user_id)
+    return output
+
+
+async def stream_synthesized_response(request: SynthesizerAgentRequest) -> AsyncIterator[str]:
+    """Stream the response as text deltas, the full response is stored to memory once the stream completes."""
+    if request.is_sensitive_data_exists:
+        await Util.run_blocking(store_conversation_to_memory, request.user_query, Util.ERROR_GUARD_PII,
+                                request.user_id)
+        yield Util.ERROR_GUARD_PII
+        return
+    cached_response = await Util.run_blocking(lookup_cached_response, request)
+    if cached_response is not None:
+        await Util.run_blocking(store_conversation_to_memory, request.user_query, cached_response,
+                                request.user_id)
+        yield cached_response
+        return
+    deltas = []
+    with observability.record_latency(observability.llm_latency, streamed=True):
+        async for delta in LlmClient.stream(get_agent(), request.user_query, request, get_llm_policy(request),
+                                            MODEL_GOOGLE_GEMINI):
+            deltas.append(delta)
+            yield delta
+    output = "".join(deltas)
+    logger.debug("Response from synthesizerAgent=%s", output)
+    await Util.run_blocking(cache_response, request, output)
+    await Util.run_blocking(store_conversation_to_memory, request.user_query, output, request.user_id)
+
 
 @logfire.instrument("SynthesizerAgent.get_synthesized_response")
 def get_synthesized_response(request: SynthesizerAgentRequest
                              ) -> Any:
-    if request.is_sensitive_data_exists:
-        store_conversation_to_memory(request.user_query, Util.ERROR_GUARD_PII)
-        return Util.ERROR_GUARD_PII
-    delimiter_context = "####CONTEXT####"
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    path = os.path.join(current_dir, "instructions.md")
-    system_prompt = Util.get_instructions(path)
-    system_prompt = system_prompt.replace("####MESSAGE####", Util.CANNOT_PROCESS_MESSAGE)
-    if request.ingestion_context:
-        system_prompt += f"\n\n{delimiter_context}\n\n{request.ingestion_context}\n\n{delimiter_context}"
-    else:
-        system_prompt += f"\n\n{delimiter_context}\n\n{delimiter_context}"
-    print(f"system_prompt={system_prompt}")
-    agent = Agent(
-        model=MODEL_GOOGLE_GEMINI,
-        system_prompt=[system_prompt],
-    )
-    result = agent.run_sync(request.user_query)
-    print(f"response from synthesizerAgent={result.output}")
-    store_conversation_to_memory(request.user_query, result.output)
-    return result.output
-
-
-def store_conversation_to_memory(user_query:str, agent_response:str) -> None:
-    agent_memory.add_conversation(user_query, agent_response)
-
-dataset = Dataset(
-    cases=[
-        Case(
-            name="Retrieve answers from Agent for the questions related to EduTrack",
-            inputs=SynthesizerAgentRequest(
-                user_query='What is EduTrack used for?',
-                ingestion_context = """
-                EduTrack – Frequently Asked Questions
-                Q1: What is EduTrack used for?
-                A1: EduTrack helps educational institutions monitor student engagement, analyze learning
-                behavior, and proactively support at-risk learners through data-driven insights.
-                Q2: Which platforms does EduTrack integrate with?
-                A2: EduTrack integrates seamlessly with LMS platforms such as Moodle, Canvas,
-                Blackboard, Google Classroom, and can be extended to custom LMS solutions via API.Q5: How does EduTrack benefit teachers?
-                A5: Instructors receive weekly summaries, alerts about disengaged students, and tools to
-                send personalized feedback or motivational nudges.
-                Q6: Can students access their own dashboards?
-                A6: Yes. Students can view their own learning progress, receive AI-generated tips, and
-                compare their engagement anonymously against peers.
-                Q7: Does EduTrack support real-time notifications?access to EduTrack’s support portal.
-                Q18: Does EduTrack integrate with Student Information Systems (SIS)?
-                A18: Yes. It can sync with most SIS platforms to fetch enrollment, demographics, and
-                academic standing data.
-                Q19: How does EduTrack notify instructors about at-risk students?
-                A19: Faculty receive weekly alerts and visual cues on their dashboards, highlighting students
-                who need attention based on defined risk thresholds.
-                Q20: Where can users learn about new EduTrack features?
-                """,
-            ),
-            expected_output="should contain educational",
-            evaluators=[Contains("educational")],
-        ),
-        Case(
-            name="Retrieve answer for general question",
-            inputs=SynthesizerAgentRequest(
-                user_query='Who is the prime minister of India?',
-            ),
-            expected_output=Util.CANNOT_PROCESS_MESSAGE,
-            evaluators=[Contains(Util.CANNOT_PROCESS_MESSAGE)],
-        )
-    ]
+    return asyncio.run(get_synthesized_response_async(request))
+
+
+def get_agent() -> "Agent[SynthesizerAgentRequest, str]":
+    """Long-lived agent, the request is passed as deps and only the context part of the prompt changes per run."""
+    global _agent
+    if _agent is None:
+        with _agent_lock:
+            if _agent is None:
+                # Imported on first use, pydantic_ai and its model providers are slow to import
+                from pydantic_ai import Agent, RunContext
+                agent = Agent(
+                    model=MODEL_GOOGLE_GEMINI,
+                    deps_type=SynthesizerAgentRequest,
+                )
+
+                # Static prefix first, identical for every request so that Gemini context caching applies
+                @agent.system_prompt
+                def instructions() -> str:
+                    return prompt_builder.get_instructions()
+
+                @agent.system_prompt
+                def ingestion_context(ctx: RunContext[SynthesizerAgentRequest]) -> str:
+                    return prompt_builder.build_context_prompt(ctx.deps.ingestion_context)
+
+                @agent.system_prompt
+                def memory_context(ctx: RunContext[SynthesizerAgentRequest]) -> str:
+                    return prompt_builder.build_memory_prompt(ctx.deps.memory_context)
+
+                _agent = agent
+    return _agent
+
+
+def get_llm_policy(request: SynthesizerAgentRequest) -> LlmPolicy:
+    return request.llm_policy or DEFAULT_LLM_POLICY
+
+
+def get_response_cache_key(request: SynthesizerAgentRequest) -> tuple[list[float], str, str]:
+    # The query embedding is already in the embedding service cache from the retrieval of the same query.
+    # A response written with the memory of a user's conversation is only served back to that user. The memory
+    # itself is left out, it differs on every turn and the retrieved context already follows the topic of the
+    # conversation. The coordinator only sends the memory with the questions that follow the conversation, the
+    # standalone ones are shared by all the users
+    user_id = (request.user_id or DEFAULT_USER_ID) if request.memory_context else ""
+    return (EmbeddingService.encode_query(request.user_query),
+            SemanticResponseCache.get_context_key(request.ingestion_context, prompt_builder.get_version(),
+                                                  request.tenant_id or "", user_id),
+            RagService.get_collection_version(request.tenant_id))
+
+
+def get_response_cache() -> SemanticResponseCache:
+    """Response cache loaded from disk on first use."""
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = SemanticResponseCache(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    similarity_threshold=float(os.getenv("RESPONSE_CACHE_SIMILARITY_THRESHOLD", "0.95")),
+                    ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400")),
+                    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+                )
+    return _response_cache
+
+
+def lookup_cached_response(request: SynthesizerAgentRequest) -> str | None:
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    with logfire.span("SynthesizerAgent.lookup_cached_response") as span:
+        cached_response = get_response_cache().get(*get_response_cache_key(request))
+        span.set_attribute("cache_hit", cached_response is not None)
+    observability.record_cache_lookup("response", cached_response is not None)
+    return cached_response
+
+
+def cache_response(request: SynthesizerAgentRequest, response: str) -> None:
+    if RESPONSE_CACHE_ENABLED:
+        get_response_cache().put(*get_response_cache_key(request), response)
+
+
+def get_agent_memory(user_id: str | None = None) -> AgentMemory:
+    user_id = user_id or DEFAULT_USER_ID
+    with agent_memories_lock:
+        agent_memory = agent_memories.get(user_id)
+        if agent_memory is None:
+            agent_memory = AgentMemory(user_id=user_id)
+            agent_memories[user_id] = agent_memory
+            while len(agent_memories) > MAX_ACTIVE_MEMORIES:
+                agent_memories.popitem(last=False)
+        else:
+            agent_memories.move_to_end(user_id)
+        return agent_memory
+
+
+def get_memory_context(user_id: str | None = None) -> str | None:
+    """Token budgeted memory of the user's conversation for the prompt, None before the first conversation."""
+    agent_memory = get_agent_memory(user_id)
+    if not agent_memory.get_recent_conversations(1):
+        return None
+    return agent_memory.generate_context_for_llm(MEMORY_CONTEXT_TOKEN_BUDGET)
+
+
+def store_conversation_to_memory(user_query:str, agent_response:str, user_id: str | None = None) -> None:
+    with observability.record_latency(observability.memory_persist_latency):
+        get_agent_memory(user_id).add_conversation(user_query, agent_response)
+
+
+def _active_memories() -> list[AgentMemory]:
+    with agent_memories_lock:
+        return list(agent_memories.values())
+
+
+# Observed on every metrics export, off the request path
+logfire.metric_gauge_callback(
+    "working_memory_items",
+    [lambda options: [Observation(sum(len(memory.working_memory) for memory in _active_memories()))]],
+    unit="1", description="Items in the working memory of all the active users"
+)
+logfire.metric_gauge_callback(
+    "working_memory_tokens",
+    [lambda options: [Observation(sum(memory.working_memory.total_tokens for memory in _active_memories()))]],
+    unit="1", description="Estimated tokens in the working memory of all the active users"
 )
+logfire.metric_gauge_callback(
+    "active_agent_memories",
+    [lambda options: [Observation(len(agent_memories))]],
+    unit="1", description="Users with an agent memory loaded"
+)
+
+def get_eval_datasets():
+    # pydantic_evals is only imported to run the evaluations
+    from pydantic_evals import Case, Dataset
+    from pydantic_evals.evaluators import Contains
+
+    dataset = Dataset(
+        cases=[
+            Case(
+                name="Retrieve answers from Agent for the questions related to EduTrack",
+                inputs=SynthesizerAgentRequest(
+                    user_query='What is EduTrack used for?',
+                    ingestion_context = """
+                    EduTrack – Frequently Asked Questions
+                    Q1: What is EduTrack used for?
+                    A1: EduTrack helps educational institutions monitor student engagement, analyze learning
+                    behavior, and proactively support at-risk learners through data-driven insights.
+                    Q2: Which platforms does EduTrack integrate with?
+                    A2: EduTrack integrates seamlessly with LMS platforms such as Moodle, Canvas,
+                    Blackboard, Google Classroom, and can be extended to custom LMS solutions via API.Q5: How does EduTrack benefit teachers?
+                    A5: Instructors receive weekly summaries, alerts about disengaged students, and tools to
+                    send personalized feedback or motivational nudges.
+                    Q6: Can students access their own dashboards?
+                    A6: Yes. Students can view their own learning progress, receive AI-generated tips, and
+                    compare their engagement anonymously against peers.
+                    Q7: Does EduTrack support real-time notifications?access to EduTrack’s support portal.
+                    Q18: Does EduTrack integrate with Student Information Systems (SIS)?
+                    A18: Yes. It can sync with most SIS platforms to fetch enrollment, demographics, and
+                    academic standing data.
+                    Q19: How does EduTrack notify instructors about at-risk students?
+                    A19: Faculty receive weekly alerts and visual cues on their dashboards, highlighting students
+                    who need attention based on defined risk thresholds.
+                    Q20: Where can users learn about new EduTrack features?
+                    """,
+                ),
+                expected_output="should contain educational",
+                evaluators=[Contains("educational")],
+            ),
+            Case(
+                name="Retrieve answer for general question",
+                inputs=SynthesizerAgentRequest(
+                    user_query='Who is the prime minister of India?',
+                ),
+                expected_output=Util.CANNOT_PROCESS_MESSAGE,
+                evaluators=[Contains(Util.CANNOT_PROCESS_MESSAGE)],
+            )
+        ]
+    )
+    return dataset
+
 
 if __name__ == "__main__":
-    report = dataset.evaluate_sync(get_synthesized_response)
+    dataset = get_eval_datasets()
+    report = dataset.evaluate_sync(get_synthesized_response_async)
     report.print(include_expected_output=True, include_input=True, include_output=True, width=300)
@@ -0,0 +1,20 @@
+from pydantic import BaseModel
+
+
+class LlmPolicy(BaseModel):
+    """How the synthesizer calls the LLM, requests without a policy use llm_client.get_default_policy()."""
+    # Primary model, the agent's model (gemini-2.5-pro) when not set
+    model: str | None = None
+    # Per attempt, up to the first token when streamed (and between the following tokens)
+    timeout_seconds: float = 30.0
+    # Whole call, including the retries, the hedged requests and the fallback
+    deadline_seconds: float = 60.0
+    max_attempts: int = 3
+    # Full jitter backoff between attempts, a random wait up to min(max, base * 2^attempt)
+    backoff_base_seconds: float = 0.5
+    backoff_max_seconds: float = 4.0
+    # A second identical request is sent when the first one has not answered by then, the first answer wins
+    hedge_after_seconds: float | None = None
+    # Cheaper and faster model, used when the primary attempts failed or it is slower than fallback_after_seconds
+    fallback_model: str | None = "google-gla:gemini-2.5-flash"
+    fallback_after_seconds: float | None = None
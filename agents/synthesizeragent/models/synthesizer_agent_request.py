@@ -1,6 +1,13 @@
 from pydantic import BaseModel
+from agents.synthesizeragent.models.llm_policy import LlmPolicy
 
 class SynthesizerAgentRequest(BaseModel):
     user_query: str
     is_sensitive_data_exists: bool = False
     ingestion_context: str|None = None
+    # Token budgeted summary of the recent conversation of the user, for follow-up questions
+    memory_context: str|None = None
+    user_id: str|None = None
+    tenant_id: str|None = None
+    # Timeouts, retries, hedging and fallback of the LLM call, the configured defaults when not set
+    llm_policy: LlmPolicy | None = None
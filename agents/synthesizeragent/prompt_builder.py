@@ -0,0 +1,62 @@
+import hashlib
+import os
+import threading
+from util import Util
+
+DELIMITER_CONTEXT = "####CONTEXT####"
+DELIMITER_MEMORY = "####MEMORY####"
+PLACEHOLDER_MESSAGE = "####MESSAGE####"
+
+
+class PromptBuilder:
+    """Assembles the system prompt of the SynthesizerAgent.
+
+    The instructions file is read and templated once, and only read again when its modification time changes.
+    The templated instructions are the static prefix of every prompt, identical from request to request so
+    that the provider can cache it, and the retrieved context and the memory of the conversation are rendered
+    as separate dynamic parts after it.
+    """
+
+    def __init__(self, instructions_path: str):
+        self.instructions_path = instructions_path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.instructions = ""
+        self.version = ""
+
+    def get_instructions(self) -> str:
+        self._reload_if_changed()
+        return self.instructions
+
+    def get_version(self) -> str:
+        """Hash of the templated instructions, changes whenever the instructions file changes."""
+        self._reload_if_changed()
+        return self.version
+
+    @staticmethod
+    def build_context_prompt(ingestion_context: str | None) -> str:
+        if ingestion_context:
+            return f"{DELIMITER_CONTEXT}\n\n{ingestion_context}\n\n{DELIMITER_CONTEXT}"
+        return f"{DELIMITER_CONTEXT}\n\n{DELIMITER_CONTEXT}"
+
+    @staticmethod
+    def build_memory_prompt(memory_context: str | None) -> str:
+        if memory_context:
+            return f"{DELIMITER_MEMORY}\n\n{memory_context}\n\n{DELIMITER_MEMORY}"
+        return f"{DELIMITER_MEMORY}\n\n{DELIMITER_MEMORY}"
+
+    def _reload_if_changed(self) -> None:
+        try:
+            mtime = os.stat(self.instructions_path).st_mtime_ns
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Instructions file not found at: {self.instructions_path}")
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            instructions = Util.get_instructions(self.instructions_path)
+            instructions = instructions.replace(PLACEHOLDER_MESSAGE, Util.CANNOT_PROCESS_MESSAGE)
+            self.instructions = instructions
+            self.version = hashlib.sha256(instructions.encode("utf-8")).hexdigest()
+            self.mtime = mtime
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+
+
+class SemanticResponseCache:
+    """Cache of LLM responses looked up by the similarity of the query embedding.
+
+    An entry only matches a query that was answered with the same retrieved context and the same
+    instructions (the context key), and whose embedding is at least `similarity_threshold` cosine similar.
+    Entries expire after `ttl_seconds`, the least recently used entry is evicted beyond `max_entries`, and an
+    entry is dropped as soon as the version of the knowledge collection it was answered from changes.
+
+    The entries are looked up in memory and persisted in SQLite (WAL mode), one row per entry, so storing a
+    response costs a single insert whatever the size of the cache.
+    """
+
+    def __init__(self, storage_dir: str, similarity_threshold: float = 0.95, ttl_seconds: float = 86400,
+                 max_entries: int = 1000):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.db_path = os.path.join(storage_dir, 'response_cache.db')
+        # entry id -> entry, in least recently used order
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.embeddings: dict[str, np.ndarray] = {}
+        self.entries_by_context: dict[str, set[str]] = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA busy_timeout=5000")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS response_cache (
+                entry_id TEXT PRIMARY KEY,
+                context_key TEXT NOT NULL,
+                collection_version TEXT,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                embedding BLOB NOT NULL
+            )"""
+        )
+        self._import_legacy_files(storage_dir)
+        self._load()
+
+    @staticmethod
+    def get_context_key(ingestion_context: Optional[str], instructions_version: str, tenant_id: str = "",
+                        user_id: str = "") -> str:
+        key = f"{tenant_id}\x00{user_id}\x00{instructions_version}\x00{ingestion_context or ''}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, query_embedding: list[float], context_key: str, collection_version: str) -> Optional[str]:
+        """Return the cached response of the most similar query, or None when there is no match."""
+        with self.lock:
+            entry_ids = self._live_entry_ids(context_key, collection_version)
+            if not entry_ids:
+                return None
+            query = self._normalize(np.asarray(query_embedding, dtype=np.float32))
+            similarities = np.stack([self.embeddings[entry_id] for entry_id in entry_ids]) @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                return None
+            entry_id = entry_ids[best]
+            self.entries.move_to_end(entry_id)
+            self.connection.execute("UPDATE response_cache SET used_at = ? WHERE entry_id = ?",
+                                    (time.time(), entry_id))
+            return self.entries[entry_id]["response"]
+
+    def put(self, query_embedding: list[float], context_key: str, collection_version: str, response: str) -> None:
+        with self.lock:
+            embedding = self._normalize(np.asarray(query_embedding, dtype=np.float32))
+            entry_id = hashlib.sha256(embedding.tobytes() + context_key.encode("utf-8")).hexdigest()
+            if entry_id in self.entries:
+                self._remove(entry_id)
+            now = time.time()
+            self.entries[entry_id] = {
+                "context_key": context_key,
+                "collection_version": collection_version,
+                "response": response,
+                "created_at": now,
+            }
+            self.embeddings[entry_id] = embedding
+            self.entries_by_context.setdefault(context_key, set()).add(entry_id)
+            evicted_ids = []
+            while len(self.entries) > self.max_entries:
+                evicted_ids.append(next(iter(self.entries)))
+                self._remove(evicted_ids[-1])
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO response_cache (entry_id, context_key, collection_version, response, "
+                    "created_at, used_at, embedding) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (entry_id, context_key, collection_version, response, now, now,
+                     embedding.astype(np.float32).tobytes()),
+                )
+                self._delete_rows(evicted_ids)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.embeddings.clear()
+            self.entries_by_context.clear()
+            self.connection.execute("DELETE FROM response_cache")
+
+    def _live_entry_ids(self, context_key: str, collection_version: str) -> list[str]:
+        # Re-ingestion changes the collection version, the responses cached before it may no longer be valid
+        expired_before = time.time() - self.ttl_seconds
+        entry_ids = []
+        expired_ids = []
+        for entry_id in list(self.entries_by_context.get(context_key, ())):
+            entry = self.entries[entry_id]
+            if entry["created_at"] < expired_before or entry.get("collection_version") != collection_version:
+                self._remove(entry_id)
+                expired_ids.append(entry_id)
+            else:
+                entry_ids.append(entry_id)
+        self._delete_rows(expired_ids)
+        return entry_ids
+
+    def _remove(self, entry_id: str) -> None:
+        entry = self.entries.pop(entry_id)
+        self.embeddings.pop(entry_id)
+        context_entries = self.entries_by_context[entry["context_key"]]
+        context_entries.discard(entry_id)
+        if not context_entries:
+            del self.entries_by_context[entry["context_key"]]
+
+    def _delete_rows(self, entry_ids: list[str]) -> None:
+        if entry_ids:
+            self.connection.executemany("DELETE FROM response_cache WHERE entry_id = ?",
+                                        [(entry_id,) for entry_id in entry_ids])
+
+    @staticmethod
+    def _normalize(embedding: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    def _load(self) -> None:
+        rows = self.connection.execute(
+            "SELECT entry_id, context_key, collection_version, response, created_at, embedding FROM response_cache "
+            "ORDER BY used_at"
+        ).fetchall()
+        for entry_id, context_key, collection_version, response, created_at, embedding in rows:
+            self.entries[entry_id] = {
+                "context_key": context_key,
+                "collection_version": collection_version,
+                "response": response,
+                "created_at": created_at,
+            }
+            self.embeddings[entry_id] = np.frombuffer(embedding, dtype=np.float32)
+            self.entries_by_context.setdefault(context_key, set()).add(entry_id)
+
+    def _import_legacy_files(self, storage_dir: str) -> None:
+        # The cache used to be rewritten as a whole to a json file and a numpy array on every insert
+        entries_file = os.path.join(storage_dir, 'response_cache.json')
+        embeddings_file = os.path.join(storage_dir, 'response_cache.npy')
+        if not (os.path.exists(entries_file) and os.path.exists(embeddings_file)):
+            return
+        try:
+            with open(entries_file, 'r') as f:
+                data = json.load(f)
+            embeddings = np.load(embeddings_file)
+        except (json.decoder.JSONDecodeError, ValueError, OSError):
+            data, embeddings = {"entry_ids": []}, []
+        if len(data["entry_ids"]) == len(embeddings):
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO response_cache (entry_id, context_key, collection_version, response, "
+                "created_at, used_at, embedding) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(entry_id, entry["context_key"], entry.get("collection_version"), entry["response"],
+                  entry["created_at"], entry["created_at"], np.asarray(embedding, dtype=np.float32).tobytes())
+                 for entry_id, entry, embedding in zip(data["entry_ids"], data["entries"], embeddings)],
+            )
+        os.remove(entries_file)
+        os.remove(embeddings_file)
@@ -0,0 +1,123 @@
+"""Latency of the chat pipeline with the LLM replaced by a deterministic stand-in.
+
+    python -m benchmarks.chat_pipeline_benchmark --requests 200 --concurrency 8 --latency 0.3 --tokens-per-second 50
+
+Reports p50/p95/p99 per stage (guard, retrieval, prompt build, llm, memory write) and end to end.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Runnable as a script from the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import environment
+from benchmarks.report import StageTimer, print_table, write_json
+from benchmarks.synthetic_pdf import write_corpus
+
+QUESTIONS = [
+    "What is EduTrack used for?",
+    "Which platforms does EduTrack integrate with?",
+    "How does EduTrack notify instructors about at-risk students?",
+    "Can students access their own dashboards?",
+    "Does EduTrack support real-time notifications?",
+    "How is student privacy protected?",
+    "Where can users learn about new EduTrack features?",
+]
+# Every PII_EVERY-th request carries an email address, so that the guard runs its full analysis
+PII_EVERY = 10
+CORPUS_FILES = 20
+STAGES = ["guard", "retrieval", "prompt_build", "llm", "memory_write", "total"]
+
+
+def build_question(index: int) -> str:
+    question = f"{QUESTIONS[index % len(QUESTIONS)]} (request {index})"
+    if index % PII_EVERY == 0:
+        question = f"My email is student{index}@example.com. {question}"
+    return question
+
+
+async def run_requests(coordinator, request_type, timer: StageTimer, requests: int, concurrency: int,
+                       users: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(index: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            await coordinator.get_response_async(request_type(user_input=build_question(index),
+                                                              user_id=f"benchmark-user-{index % users}"))
+            timer.record("total", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(index) for index in range(requests)))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=10, help="distinct user ids the requests are spread over")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds to the first token of the model")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--response-tokens", type=int, default=60)
+    parser.add_argument("--warmup", type=int, default=5, help="requests run before measuring")
+    parser.add_argument("--workdir", help="keep the stores in this folder instead of a temporary one")
+    parser.add_argument("--output", help="also write the results as json")
+    parser.add_argument("--verbose", action="store_true", help="show the spans and logs of the application")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="chat-benchmark-")
+    environment.isolate(workdir, console=args.verbose)
+    import rag.rag_service as RagService
+    import agents.coordinatoragent.main as CoordinatorAgent
+    import agents.synthesizeragent.main as SynthesizerAgent
+    from agents.coordinatoragent.models.coordinator_agent_request import CoordinatorAgentRequest
+    from benchmarks.fake_model import build_fake_model
+
+    timer = StageTimer()
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            corpus_path = os.path.join(workdir, "corpus")
+            write_corpus(corpus_path, CORPUS_FILES)
+            RagService.ingest_data_from_file_or_folder(corpus_path)
+
+            fake_model = build_fake_model(args.latency, args.tokens_per_second, args.response_tokens,
+                                          on_request=lambda seconds: timer.record("llm", seconds))
+            # The stages are timed where the pipeline calls them, through their module attributes
+            CoordinatorAgent.scan_sensitive_data = timer.wrap("guard", CoordinatorAgent.scan_sensitive_data)
+            RagService.retrieve_ingested_data = timer.wrap("retrieval", RagService.retrieve_ingested_data)
+            SynthesizerAgent.prompt_builder.build_context_prompt = timer.wrap(
+                "prompt_build", SynthesizerAgent.prompt_builder.build_context_prompt)
+            SynthesizerAgent.store_conversation_to_memory = timer.wrap(
+                "memory_write", SynthesizerAgent.store_conversation_to_memory)
+
+            with SynthesizerAgent.get_agent().override(model=fake_model):
+                asyncio.run(run_requests(CoordinatorAgent, CoordinatorAgentRequest, StageTimer(), args.warmup,
+                                         args.concurrency, args.users))
+                timer.samples.clear()
+                elapsed = asyncio.run(run_requests(CoordinatorAgent, CoordinatorAgentRequest, timer,
+                                                   args.requests, args.concurrency, args.users))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = timer.summary()
+    rows = [{"stage": stage, **summary[stage]} for stage in STAGES if stage in summary]
+    print_table(f"Chat pipeline: {args.requests} requests, concurrency {args.concurrency}, "
+                f"{args.requests / elapsed:.2f} requests/s",
+                rows, ["stage", "count", "p50_ms", "p95_ms", "p99_ms", "mean_ms"])
+    if args.output:
+        write_json(args.output, {"parameters": vars(args), "requests_per_second": args.requests / elapsed,
+                                 "stages": summary})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import os
+import sys
+
+APPLICATION_MODULES = ("rag.rag_service", "agents.memory.agent_memory", "agents.synthesizeragent.main")
+
+
+def isolate(workdir: str, console: bool = False) -> None:
+    """Point the application stores at the work directory, so a benchmark never touches the real data.
+
+    Must run before the application modules are imported, their paths are read at import time.
+    """
+    imported = [module for module in APPLICATION_MODULES if module in sys.modules]
+    if imported:
+        raise RuntimeError(f"Application modules imported before isolating the benchmark: {imported}")
+    os.environ["CHROMA_PATH"] = os.path.join(workdir, "chroma")
+    os.environ["MEMORY_DB_PATH"] = os.path.join(workdir, "conversations.db")
+    # The console exporter would print every span and log into the measurements
+    os.environ["LOGFIRE_CONSOLE"] = "true" if console else "false"
+    # Every request must reach the model stand-in
+    os.environ["RESPONSE_CACHE_ENABLED"] = "false"
+    # The agent is built for Gemini before the model is overridden, it only needs a key to be present
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
@@ -0,0 +1,56 @@
+import asyncio
+import random
+import time
+from typing import AsyncIterator, Callable, Optional
+from pydantic_ai.exceptions import ModelHTTPError
+from pydantic_ai.messages import ModelMessage, ModelResponse, TextPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+
+RESPONSE_WORDS = ("EduTrack helps educational institutions monitor student engagement, analyze learning behavior, "
+                  "and proactively support at-risk learners through data-driven insights.").split()
+
+
+def build_fake_model(latency_seconds: float = 0.3, tokens_per_second: float = 50.0, response_tokens: int = 60,
+                     on_request: Optional[Callable[[float], None]] = None, error_rate: float = 0.0,
+                     error_status: int = 503, slow_rate: float = 0.0, slow_latency_seconds: float = 5.0,
+                     seed: int | None = None, model_name: str = "benchmark-fake-model") -> FunctionModel:
+    """Deterministic stand-in for the LLM.
+
+    Every request waits `latency_seconds` (time to first token) and then produces `response_tokens` words at
+    `tokens_per_second`, streamed or at once. `on_request` receives the seconds spent in every model request.
+
+    Faults are injected with a seeded random generator: a share `error_rate` of the requests fails with the
+    http status `error_status` after the latency, and a share `slow_rate` waits `slow_latency_seconds` instead.
+    """
+    words = [RESPONSE_WORDS[index % len(RESPONSE_WORDS)] for index in range(response_tokens)]
+    token_interval = 1 / tokens_per_second if tokens_per_second > 0 else 0.0
+    generator = random.Random(seed)
+
+    def record(start: float) -> None:
+        if on_request is not None:
+            on_request(time.perf_counter() - start)
+
+    async def wait_first_token(start: float) -> None:
+        roll = generator.random()
+        slow = error_rate <= roll < error_rate + slow_rate
+        await asyncio.sleep(slow_latency_seconds if slow else latency_seconds)
+        if roll < error_rate:
+            record(start)
+            raise ModelHTTPError(error_status, model_name, {"error": "injected by the benchmark"})
+
+    async def respond(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        start = time.perf_counter()
+        await wait_first_token(start)
+        await asyncio.sleep(token_interval * len(words))
+        record(start)
+        return ModelResponse(parts=[TextPart(" ".join(words))])
+
+    async def stream(messages: list[ModelMessage], info: AgentInfo) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        await wait_first_token(start)
+        for index, word in enumerate(words):
+            await asyncio.sleep(token_interval)
+            yield word if index == 0 else f" {word}"
+        record(start)
+
+    return FunctionModel(respond, stream_function=stream, model_name=model_name)
@@ -0,0 +1,85 @@
+"""Ingestion throughput over synthetic PDF corpora.
+
+    python -m benchmarks.ingestion_benchmark --sizes 10 1000 10000 --pages-per-file 2
+
+Every corpus is ingested twice into its own tenant: a cold run (a full re-ingestion) that extracts, embeds and
+stores everything, then an incremental run over the unchanged corpus that should only hash the files.
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Runnable as a script from the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import environment
+from benchmarks.report import print_table, write_json
+from benchmarks.synthetic_pdf import write_corpus
+
+
+def run_ingestion(ingest, progress_type, corpus_path: str, tenant_id: str, workers: int) -> tuple[float, int]:
+    progress = progress_type()
+    start = time.perf_counter()
+    ingest(corpus_path, tenant_id, progress, workers)
+    return time.perf_counter() - start, progress.chunks_done
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000], help="files per corpus")
+    parser.add_argument("--pages-per-file", type=int, default=2)
+    parser.add_argument("--words-per-page", type=int, default=300)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="pdf extraction processes")
+    parser.add_argument("--workdir", help="keep the corpora and stores in this folder instead of a temporary one")
+    parser.add_argument("--output", help="also write the results as json")
+    parser.add_argument("--verbose", action="store_true", help="show the spans and logs of the application")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ingestion-benchmark-")
+    environment.isolate(workdir, console=args.verbose)
+    import rag.rag_service as RagService
+    # Load the embedding model up front, it is not part of the throughput
+    import rag.embedding_service as EmbeddingService
+    EmbeddingService.get_model()
+
+    rows = []
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        for size in args.sizes:
+            corpus_path = os.path.join(workdir, f"corpus-{size}")
+            if not os.path.exists(corpus_path):
+                write_corpus(corpus_path, size, args.pages_per_file, args.words_per_page)
+            with output:
+                cold_seconds, chunks = run_ingestion(RagService.reingest_data_from_file_or_folder,
+                                                     RagService.IngestionProgress, corpus_path, f"benchmark-{size}",
+                                                     args.workers)
+                incremental_seconds, _ = run_ingestion(RagService.ingest_data_from_file_or_folder,
+                                                       RagService.IngestionProgress, corpus_path,
+                                                       f"benchmark-{size}", args.workers)
+            pages = size * args.pages_per_file
+            rows.append({
+                "files": size,
+                "chunks": chunks,
+                "cold_s": cold_seconds,
+                "files_per_s": size / cold_seconds,
+                "pages_per_s": pages / cold_seconds,
+                "chunks_per_s": chunks / cold_seconds,
+                "incremental_s": incremental_seconds,
+            })
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(f"Ingestion throughput ({args.pages_per_file} pages per file, {args.workers} extraction workers)",
+                rows, ["files", "chunks", "cold_s", "files_per_s", "pages_per_s", "chunks_per_s", "incremental_s"])
+    if args.output:
+        write_json(args.output, {"parameters": vars(args), "results": rows})
+
+
+if __name__ == "__main__":
+    main()
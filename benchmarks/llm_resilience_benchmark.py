@@ -0,0 +1,126 @@
+"""Latency and availability of the synthesizer against a faulty model stand-in, per LLM policy.
+
+    python -m benchmarks.llm_resilience_benchmark --requests 200 --concurrency 16 --error-rate 0.1 --slow-rate 0.05
+
+The primary model fails a share of the requests with a 503 and answers a share of them slowly, the fallback
+model is healthy and faster. Compares no retries, retries, retries with hedging and all of them with a fallback.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Runnable as a script from the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import environment
+from benchmarks.report import StageTimer, latency_summary, print_table, write_json
+
+FALLBACK_MODEL = "benchmark-fallback"
+CONTEXT = ("Q1: What is EduTrack used for?\nA1: EduTrack helps educational institutions monitor student engagement, "
+           "analyze learning behavior, and proactively support at-risk learners through data-driven insights.")
+
+
+def build_policies(args, LlmPolicy) -> dict:
+    common = dict(timeout_seconds=args.timeout, deadline_seconds=args.deadline, backoff_base_seconds=0.05,
+                  backoff_max_seconds=0.5)
+    hedge_after = args.latency * 2
+    return {
+        "no_retries": LlmPolicy(max_attempts=1, fallback_model=None, **common),
+        "retries": LlmPolicy(max_attempts=3, fallback_model=None, **common),
+        "retries_hedge": LlmPolicy(max_attempts=3, fallback_model=None, hedge_after_seconds=hedge_after, **common),
+        "retries_hedge_fallback": LlmPolicy(max_attempts=3, fallback_model=FALLBACK_MODEL,
+                                            hedge_after_seconds=hedge_after,
+                                            fallback_after_seconds=args.timeout / 2, **common),
+    }
+
+
+async def run_requests(synthesizer, request_type, policy, timer: StageTimer, requests: int,
+                       concurrency: int) -> int:
+    """Run the requests and return how many of them failed."""
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def run_one(index: int) -> None:
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await synthesizer.get_synthesized_response_async(request_type(
+                    user_query=f"What is EduTrack used for? (request {index})", ingestion_context=CONTEXT,
+                    user_id=f"benchmark-user-{index % 10}", llm_policy=policy))
+            except Exception:
+                failures += 1
+                return
+            timer.record("answered", time.perf_counter() - start)
+
+    await asyncio.gather(*(run_one(index) for index in range(requests)))
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds to the first token of the primary")
+    parser.add_argument("--fallback-latency", type=float, default=0.1)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--error-rate", type=float, default=0.1, help="share of primary requests failing with 503")
+    parser.add_argument("--slow-rate", type=float, default=0.05, help="share of slow primary requests")
+    parser.add_argument("--slow-latency", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=2.0, help="per attempt timeout of the policies")
+    parser.add_argument("--deadline", type=float, default=6.0, help="deadline of the policies")
+    parser.add_argument("--output", help="also write the results as json")
+    parser.add_argument("--verbose", action="store_true", help="show the spans and logs of the application")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="llm-resilience-benchmark-")
+    environment.isolate(workdir, console=args.verbose)
+    # The coordinator configures logfire and the logging of the application
+    import agents.coordinatoragent.main  # noqa: F401
+    import agents.synthesizeragent.llm_client as LlmClient
+    import agents.synthesizeragent.main as SynthesizerAgent
+    from agents.synthesizeragent.models.llm_policy import LlmPolicy
+    from agents.synthesizeragent.models.synthesizer_agent_request import SynthesizerAgentRequest
+    from benchmarks.fake_model import build_fake_model
+
+    results = {}
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            for name, policy in build_policies(args, LlmPolicy).items():
+                # Same faults for every policy
+                primary = build_fake_model(args.latency, args.tokens_per_second, error_rate=args.error_rate,
+                                           slow_rate=args.slow_rate, slow_latency_seconds=args.slow_latency,
+                                           seed=42, model_name="benchmark-primary")
+                fallback = build_fake_model(args.fallback_latency, args.tokens_per_second,
+                                            model_name=FALLBACK_MODEL)
+                # The models are resolved by name through the client, the benchmark maps them to the stand-ins
+                LlmClient.get_model = lambda model_name: fallback if model_name == FALLBACK_MODEL else primary
+                timer = StageTimer()
+                start = time.perf_counter()
+                failures = asyncio.run(run_requests(SynthesizerAgent, SynthesizerAgentRequest, policy, timer,
+                                                    args.requests, args.concurrency))
+                elapsed = time.perf_counter() - start
+                samples = timer.samples.get("answered", [])
+                results[name] = {"failed": failures, "availability": (args.requests - failures) / args.requests,
+                                 "requests_per_second": args.requests / elapsed,
+                                 **(latency_summary(samples) if samples else {})}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(f"LLM policies: {args.requests} requests, concurrency {args.concurrency}, "
+                f"{args.error_rate:.0%} errors and {args.slow_rate:.0%} slow answers from the primary",
+                [{"policy": name, **result} for name, result in results.items()],
+                ["policy", "availability", "failed", "p50_ms", "p95_ms", "p99_ms", "mean_ms"])
+    if args.output:
+        write_json(args.output, {"parameters": vars(args), "policies": results})
+
+
+if __name__ == "__main__":
+    main()
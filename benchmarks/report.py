@@ -0,0 +1,61 @@
+import json
+import threading
+import time
+from functools import wraps
+import numpy as np
+
+
+class StageTimer:
+    """Collects the latency samples of the pipeline stages, safe to use from any thread."""
+
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage: str, func):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        with self.lock:
+            return {stage: latency_summary(samples) for stage, samples in self.samples.items()}
+
+
+def latency_summary(samples: list[float]) -> dict[str, float]:
+    milliseconds = np.asarray(samples) * 1000
+    return {
+        "count": len(samples),
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p95_ms": float(np.percentile(milliseconds, 95)),
+        "p99_ms": float(np.percentile(milliseconds, 99)),
+        "mean_ms": float(milliseconds.mean()),
+    }
+
+
+def print_table(title: str, rows: list[dict], columns: list[str]) -> None:
+    print(f"\n{title}")
+    widths = [max(len(column), *(len(_format(row.get(column))) for row in rows)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(_format(row.get(column)).ljust(width) for column, width in zip(columns, widths)))
+
+
+def write_json(path: str, results: dict) -> None:
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def _format(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return "" if value is None else str(value)
@@ -0,0 +1,106 @@
+"""Import time profile of the chat pipeline, and time to the first answer of a fresh process.
+
+    python -m benchmarks.startup_benchmark --budget-ms 1000 --first-answer
+
+Fails when importing agents.coordinatoragent.main loads one of the heavyweight libraries, which must only be
+loaded on first use or by warmup(), or when the import takes longer than the budget.
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# Runnable as a script from the project root
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT)
+
+from benchmarks import environment
+from benchmarks.report import print_table, write_json
+
+ENTRY_MODULE = "agents.coordinatoragent.main"
+HEAVY_MODULES = ("torch", "sentence_transformers", "transformers", "chromadb", "guardrails", "presidio_analyzer",
+                 "spacy", "pydantic_ai", "pydantic_evals", "pypdf", "langchain_text_splitters")
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+FIRST_ANSWER_SCRIPT = """
+import asyncio, time
+start = time.perf_counter()
+import agents.coordinatoragent.main as CoordinatorAgent
+import agents.synthesizeragent.main as SynthesizerAgent
+from agents.coordinatoragent.models.coordinator_agent_request import CoordinatorAgentRequest
+from benchmarks.fake_model import build_fake_model
+imported = time.perf_counter()
+with SynthesizerAgent.get_agent().override(model=build_fake_model(0.0, 0.0)):
+    asyncio.run(CoordinatorAgent.get_response_async(CoordinatorAgentRequest(user_input="What is EduTrack used for?",
+                                                                            user_id="startup-benchmark")))
+print(imported - start, time.perf_counter() - start)
+"""
+
+
+def profile_imports(module: str) -> list[tuple[str, int, int, int]]:
+    """(module, self us, cumulative us, nesting depth) of every module imported by a fresh interpreter."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=PROJECT_ROOT,
+                            capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return imports
+
+
+def measure_first_answer() -> tuple[float, float]:
+    result = subprocess.run([sys.executable, "-c", FIRST_ANSWER_SCRIPT], cwd=PROJECT_ROOT, capture_output=True,
+                            text=True, check=True)
+    import_seconds, first_answer_seconds = result.stdout.strip().splitlines()[-1].split()
+    return float(import_seconds), float(first_answer_seconds)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=1000.0, help="maximum import time of the chat pipeline")
+    parser.add_argument("--top", type=int, default=10, help="slowest direct imports of the entry module to show")
+    parser.add_argument("--first-answer", action="store_true",
+                        help="also measure a fresh process up to its first answer (with the model stand-in)")
+    parser.add_argument("--output", help="also write the results as json")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="startup-benchmark-")
+    # The child processes inherit the isolated environment
+    environment.isolate(workdir)
+    try:
+        imports = profile_imports(ENTRY_MODULE)
+        first_answer = measure_first_answer() if args.first_answer else None
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    total_ms = next(cumulative for name, _, cumulative, _ in imports if name == ENTRY_MODULE) / 1000
+    heavy = sorted({name for name, _, _, _ in imports if name.split(".")[0] in HEAVY_MODULES})
+    direct = sorted((item for item in imports if item[3] == 1), key=lambda item: item[2], reverse=True)
+    print_table(f"Slowest imports of {ENTRY_MODULE}",
+                [{"module": name, "cumulative_ms": cumulative / 1000, "self_ms": self_us / 1000}
+                 for name, self_us, cumulative, _ in direct[:args.top]],
+                ["module", "cumulative_ms", "self_ms"])
+    print(f"\nImport time: {total_ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    if first_answer is not None:
+        print(f"Fresh process: imported in {first_answer[0] * 1000:.0f} ms, first answer after "
+              f"{first_answer[1] * 1000:.0f} ms")
+    if args.output:
+        write_json(args.output, {"import_ms": total_ms, "heavy_modules_imported": heavy,
+                                 "first_answer_s": first_answer[1] if first_answer else None})
+
+    failures = []
+    if heavy:
+        failures.append(f"heavyweight modules imported eagerly: {', '.join(heavy)}")
+    if total_ms > args.budget_ms:
+        failures.append(f"import time {total_ms:.0f} ms is over the budget of {args.budget_ms:.0f} ms")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
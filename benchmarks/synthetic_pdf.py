@@ -0,0 +1,88 @@
+import os
+import random
+
+VOCABULARY = (
+    "EduTrack student engagement learning dashboard instructor course assignment attendance analytics alert "
+    "risk semester grade feedback integration Moodle Canvas Blackboard report privacy access notification "
+    "progress module quiz enrollment faculty insight support portal weekly summary behavior data platform"
+).split()
+LINE_LENGTH = 90
+LINES_PER_PAGE = 45
+FILES_PER_FOLDER = 100
+
+
+def build_pdf(pages: list[str]) -> bytes:
+    """Smallest valid PDF with one text page per item, readable by pypdf."""
+    objects = {
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    }
+    page_ids = []
+    for index, text in enumerate(pages):
+        page_id = 4 + index * 2
+        page_ids.append(page_id)
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>").encode()
+        content = _content_stream(text)
+        objects[page_id + 1] = b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[2] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode()
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(output)
+        output += b"%d 0 obj\n%s\nendobj\n" % (object_id, objects[object_id])
+    xref_offset = len(output)
+    size = max(objects) + 1
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % size
+    for object_id in range(1, size):
+        output += b"%010d 00000 n \n" % offsets[object_id]
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref_offset)
+    return bytes(output)
+
+
+def _content_stream(text: str) -> bytes:
+    lines = []
+    line = ""
+    for word in text.split():
+        if line and len(line) + len(word) + 1 > LINE_LENGTH:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    if line:
+        lines.append(line)
+    commands = ["BT", "/F1 11 Tf", "14 TL", "72 740 Td"]
+    for line in lines[:LINES_PER_PAGE]:
+        escaped = line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        commands.append(f"({escaped}) Tj T*")
+    commands.append("ET")
+    return "\n".join(commands).encode("latin-1", errors="replace")
+
+
+def generate_page_text(rng: random.Random, words: int) -> str:
+    sentences = []
+    remaining = words
+    while remaining > 0:
+        length = min(remaining, rng.randint(8, 16))
+        sentence = " ".join(rng.choice(VOCABULARY) for _ in range(length))
+        sentences.append(sentence[0].upper() + sentence[1:] + ".")
+        remaining -= length
+    return " ".join(sentences)
+
+
+def write_corpus(directory: str, file_count: int, pages_per_file: int = 2, words_per_page: int = 300,
+                 seed: int = 42) -> list[str]:
+    """Write a deterministic corpus of PDFs, spread over sub folders of FILES_PER_FOLDER files."""
+    rng = random.Random(seed)
+    paths = []
+    for index in range(file_count):
+        folder = os.path.join(directory, f"part-{index // FILES_PER_FOLDER:04d}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"doc-{index:06d}.pdf")
+        pages = [generate_page_text(rng, words_per_page) for _ in range(pages_per_file)]
+        with open(path, 'wb') as f:
+            f.write(build_pdf(pages))
+        paths.append(path)
+    return paths
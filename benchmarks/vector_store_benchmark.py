@@ -0,0 +1,108 @@
+"""Build time, disk size, open time, query latency and recall@k of the vector store backends.
+
+    python -m benchmarks.vector_store_benchmark --vectors 1000000 --backends chroma quantized
+
+Uses clustered random unit vectors of the embedding dimension instead of a corpus, so that millions of chunks
+can be measured without embedding them. The recall is measured against an exact float32 search.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Runnable as a script from the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.report import latency_summary, print_table, write_json
+
+CLUSTERS = 1000
+BATCH_SIZE = 1000
+
+
+def generate_vectors(count: int, dim: int, seed: int = 42) -> np.ndarray:
+    generator = np.random.default_rng(seed)
+    centers = generator.standard_normal((CLUSTERS, dim)).astype(np.float32)
+    vectors = np.empty((count, dim), dtype=np.float32)
+    for start in range(0, count, BATCH_SIZE * 100):
+        end = min(start + BATCH_SIZE * 100, count)
+        vectors[start:end] = (centers[generator.integers(0, CLUSTERS, end - start)]
+                              + 0.5 * generator.standard_normal((end - start, dim)).astype(np.float32))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def open_store(backend: str, workdir: str):
+    if backend == "chroma":
+        import chromadb
+        from rag.vector_store import ChromaVectorStore
+        return ChromaVectorStore("benchmark", chromadb.PersistentClient(path=workdir),
+                                 Path(workdir).joinpath("keyword", "benchmark.db"))
+    from rag.quantized_vector_store import QuantizedVectorStore
+    return QuantizedVectorStore("benchmark", Path(workdir))
+
+
+def directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=384, help="dimension of the embeddings (all-MiniLM-L6-v2)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--backends", nargs="+", default=["chroma", "quantized"])
+    parser.add_argument("--output", help="also write the results as json")
+    args = parser.parse_args()
+
+    vectors = generate_vectors(args.vectors, args.dim)
+    generator = np.random.default_rng(7)
+    queries = vectors[generator.integers(0, args.vectors, args.queries)]
+    queries = queries + 0.1 * generator.standard_normal(queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    exact = [set(np.argpartition(vectors @ query, -args.top_k)[-args.top_k:].tolist()) for query in queries]
+
+    rows = []
+    for backend in args.backends:
+        workdir = tempfile.mkdtemp(prefix=f"vector-store-benchmark-{backend}-")
+        try:
+            store = open_store(backend, workdir)
+            start = time.perf_counter()
+            for batch_start in range(0, args.vectors, BATCH_SIZE):
+                batch_end = min(batch_start + BATCH_SIZE, args.vectors)
+                ids = [str(index) for index in range(batch_start, batch_end)]
+                store.upsert(ids, vectors[batch_start:batch_end].tolist(), ids,
+                             [{"index": index} for index in range(batch_start, batch_end)])
+            build_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            store = open_store(backend, workdir)
+            store.count()
+            open_seconds = time.perf_counter() - start
+
+            latencies, hits = [], 0
+            for query, expected in zip(queries, exact):
+                start = time.perf_counter()
+                results = store.query(query.tolist(), args.top_k)
+                latencies.append(time.perf_counter() - start)
+                hits += len(expected.intersection(int(chunk_id) for chunk_id, _ in results))
+            summary = latency_summary(latencies)
+            rows.append({"backend": backend, "build_s": build_seconds, "open_ms": open_seconds * 1000,
+                         "disk_mb": directory_size(workdir) / 2 ** 20, "p50_ms": summary["p50_ms"],
+                         "p95_ms": summary["p95_ms"], f"recall@{args.top_k}": hits / (args.top_k * args.queries)})
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(f"Vector stores: {args.vectors} vectors of {args.dim} dimensions, {args.queries} queries", rows,
+                ["backend", "build_s", "open_ms", "disk_mb", "p50_ms", "p95_ms", f"recall@{args.top_k}"])
+    if args.output:
+        write_json(args.output, {"parameters": vars(args), "backends": rows})
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,14 @@ import warnings
 # Add project root to Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from agents.coordinatoragent.main import get_response
-from agents.coordinatoragent.main import ingest_data_from_docs
+from agents.coordinatoragent.main import stream_response
+from agents.coordinatoragent.main import submit_docs_ingestion
+from agents.coordinatoragent.main import warmup
 from agents.coordinatoragent.models.coordinator_agent_request import CoordinatorAgentRequest
 
 warnings.filterwarnings("ignore")
+# Load the models in the background while the page renders, only the first run of the process starts it
+warmup()
 # -------------------- Configuration --------------------
 st.set_page_config(page_title="💬 EduTrack", page_icon="🧠", layout="centered")
 
@@ -22,7 +25,8 @@ st.markdown("Type below to chat with EduTrack Chat Assistant Agent!")
 # Use Streamlit session state to store chat history
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
-    ingest_data_from_docs()
+    # Runs in the background, the questions are answered from the current knowledge meanwhile
+    st.session_state.ingestion_job_id = submit_docs_ingestion()
 
 if "user_id" not in st.session_state:
     # For local testing used hard-coded value
@@ -32,18 +36,24 @@ if "user_id" not in st.session_state:
 # Text input box
 user_input = st.text_input("You:", placeholder="Ask me anything related to EduTrack...", key="input_box")
 
-# When user submits a message
-if user_input:
-    with st.spinner("Thinking..."):
-        response = get_response(CoordinatorAgentRequest(user_input=user_input, user_id=st.session_state.user_id))
-
-    # Append to history
-    st.session_state.chat_history.append(("You", user_input))
-    st.session_state.chat_history.append(("Bot", response))
-
 # Display chat history
 for sender, message in st.session_state.chat_history:
     if sender == "You":
         st.markdown(f"🧑 **{sender}:** {message}")
     else:
-        st.markdown(f"🤖 **{sender}:** {message}")
\ No newline at end of file
+        st.markdown(f"🤖 **{sender}:** {message}")
+
+# When user submits a message, render the response tokens as they arrive
+if user_input:
+    st.markdown(f"🧑 **You:** {user_input}")
+    placeholder = st.empty()
+    placeholder.markdown("🤖 **Bot:** _Thinking..._")
+    deltas = []
+    for delta in stream_response(CoordinatorAgentRequest(user_input=user_input, user_id=st.session_state.user_id)):
+        deltas.append(delta)
+        placeholder.markdown(f"🤖 **Bot:** {''.join(deltas)}")
+    response = "".join(deltas)
+
+    # Append to history
+    st.session_state.chat_history.append(("You", user_input))
+    st.session_state.chat_history.append(("Bot", response))
@@ -0,0 +1,71 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+import logfire
+
+# Level of the application logs (DEBUG, INFO, WARNING, ERROR), the libraries only log warnings and errors
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+APPLICATION_LOGGERS = ("agents", "rag", "util")
+
+# Metrics are exported through the OpenTelemetry setup of logfire.configure (OTEL_EXPORTER_OTLP_ENDPOINT).
+# Collection size and working memory gauges are observed where that state lives, in rag_service and the
+# synthesizer agent.
+guard_latency = logfire.metric_histogram(
+    "pii_guard_latency", unit="ms", description="Latency of the PII guard per message"
+)
+embedding_latency = logfire.metric_histogram(
+    "embedding_latency", unit="ms", description="Latency of the embedding model calls, per kind (query or documents)"
+)
+vector_query_latency = logfire.metric_histogram(
+    "vector_query_latency", unit="ms", description="Latency of the similarity queries, per vector store backend"
+)
+llm_latency = logfire.metric_histogram(
+    "llm_latency", unit="ms", description="Latency of the LLM calls, up to the last token when streamed"
+)
+llm_retries = logfire.metric_counter(
+    "llm_retries", unit="1", description="LLM attempts retried, per reason (timeout, status code or error type)"
+)
+llm_hedged_requests = logfire.metric_counter(
+    "llm_hedged_requests", unit="1", description="Second requests sent because the first one was slow"
+)
+llm_fallbacks = logfire.metric_counter(
+    "llm_fallbacks", unit="1", description="Requests sent to the fallback model, per reason (slow or failed)"
+)
+memory_persist_latency = logfire.metric_histogram(
+    "memory_persist_latency", unit="ms", description="Latency of storing a conversation to the agent memory"
+)
+cache_hits = logfire.metric_counter(
+    "cache_hits", unit="1", description="Cache hits, per cache (response or query_embedding)"
+)
+cache_misses = logfire.metric_counter(
+    "cache_misses", unit="1", description="Cache misses, per cache (response or query_embedding)"
+)
+pii_detections = logfire.metric_counter(
+    "pii_detections", unit="1", description="Messages in which the guard found PII"
+)
+
+
+@contextmanager
+def record_latency(histogram, **attributes):
+    """Record the duration of the block in milliseconds, also when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.record((time.perf_counter() - start) * 1000, attributes)
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    (cache_hits if hit else cache_misses).add(1, {"cache": cache})
+
+
+def configure_logging(level: str = LOG_LEVEL) -> None:
+    """Send the application logs through logfire, as structured records exported with the traces.
+
+    The message template and its arguments are kept as attributes. Records below the level are dropped before
+    their message is formatted.
+    """
+    logging.basicConfig(level=logging.WARNING, handlers=[logfire.LogfireLoggingHandler()])
+    for name in APPLICATION_LOGGERS:
+        logging.getLogger(name).setLevel(level)
@@ -0,0 +1,34 @@
+from __future__ import annotations
+import math
+import re
+from collections import Counter
+
+# Okapi BM25 parameters
+K1 = 1.5
+B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset({
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in", "is",
+    "it", "me", "my", "of", "on", "or", "that", "the", "this", "to", "was", "what", "when", "where", "which",
+    "who", "why", "will", "with", "you", "your",
+})
+
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+def term_frequencies(text: str) -> tuple[Counter, int]:
+    # Term frequencies of the text and its length in terms
+    tokens = tokenize(text)
+    return Counter(tokens), len(tokens)
+
+
+def idf(document_frequency: int, document_count: int) -> float:
+    return math.log(1 + (document_count - document_frequency + 0.5) / (document_frequency + 0.5))
+
+
+def term_score(term_frequency: int, term_idf: float, document_length: int, average_document_length: float) -> float:
+    norm = K1 * (1 - B + B * document_length / average_document_length) if average_document_length else K1
+    return term_idf * term_frequency * (K1 + 1) / (term_frequency + norm)
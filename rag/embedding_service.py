@@ -0,0 +1,78 @@
+from __future__ import annotations
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+import observability
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "all-MiniLM-L6-v2")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+QUERY_CACHE_SIZE = int(os.getenv("EMBEDDING_QUERY_CACHE_SIZE", "1024"))
+
+# One model per process, shared by ingestion and query path. Loaded on first use, importing
+# sentence_transformers (torch) alone takes seconds
+_model: SentenceTransformer | None = None
+_model_lock = threading.Lock()
+
+_query_cache: OrderedDict[str, list[float]] = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+
+def get_model() -> SentenceTransformer:
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return _model
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def encode_documents(texts: list[str], batch_size: int = EMBEDDING_BATCH_SIZE) -> list[list[float]]:
+    """Embed the given texts (unit length), the encoder batches them internally with the given batch size."""
+    if not texts:
+        return []
+    with observability.record_latency(observability.embedding_latency, kind="documents"):
+        return get_model().encode(texts, batch_size=batch_size, normalize_embeddings=True).tolist()
+
+
+def encode_query(text: str, cache: bool = True) -> list[float]:
+    """Embed a user query, repeated queries (after normalization) are served from an LRU cache.
+
+    With cache=False a new embedding is not added to the cache, the caller adds it with cache_query once the
+    query is known to be safe to keep.
+    """
+    key = normalize_query(text)
+    with _query_cache_lock:
+        embedding = _query_cache.get(key)
+        if embedding is not None:
+            _query_cache.move_to_end(key)
+    observability.record_cache_lookup("query_embedding", embedding is not None)
+    if embedding is not None:
+        return embedding
+    with observability.record_latency(observability.embedding_latency, kind="query"):
+        embedding = get_model().encode([key], normalize_embeddings=True)[0].tolist()
+    if cache:
+        cache_query(text, embedding)
+    return embedding
+
+
+def cache_query(text: str, embedding: list[float]) -> None:
+    key = normalize_query(text)
+    with _query_cache_lock:
+        _query_cache[key] = embedding
+        _query_cache.move_to_end(key)
+        while len(_query_cache) > QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+
+
+def clear_query_cache() -> None:
+    with _query_cache_lock:
+        _query_cache.clear()
@@ -0,0 +1,113 @@
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class IngestManifest:
+    """Ingestion manifest of a collection, stored in SQLite in WAL mode.
+
+    One row per ingested file with its size, modification time, content hash and the ids of the chunks it
+    produced, and the version of the collection. Recording the files completed by an ingestion only writes
+    their rows, whatever the number of files already ingested.
+
+    `legacy_manifest_path` is the json file the manifest was kept in before, it is imported into an empty
+    manifest and then deleted.
+    """
+
+    def __init__(self, db_path: Path, legacy_manifest_path: Optional[Path] = None):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA busy_timeout=5000")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                file_hash TEXT NOT NULL,
+                file_size INTEGER,
+                file_mtime_ns INTEGER,
+                chunk_ids TEXT NOT NULL
+            )"""
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if legacy_manifest_path is not None:
+            self._import_legacy_manifest(legacy_manifest_path)
+
+    def get_files(self) -> dict[str, dict]:
+        """Entry of every ingested file: file_hash, file_size, file_mtime_ns and chunk_ids."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, file_hash, file_size, file_mtime_ns, chunk_ids FROM files").fetchall()
+        return {path: {"file_hash": file_hash, "file_size": file_size, "file_mtime_ns": file_mtime_ns,
+                       "chunk_ids": json.loads(chunk_ids)}
+                for path, file_hash, file_size, file_mtime_ns, chunk_ids in rows}
+
+    def get_version(self) -> str:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else ""
+
+    def get_data_version(self) -> int:
+        """Changes whenever another connection, of this process or another one, commits to the manifest."""
+        with self.lock:
+            return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def save(self, files: dict[str, Optional[dict]], version: Optional[str]) -> None:
+        """Write the entries of the given files (None deletes the file) and the version in one transaction."""
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO files (path, file_hash, file_size, file_mtime_ns, chunk_ids) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(path, entry["file_hash"], entry.get("file_size"), entry.get("file_mtime_ns"),
+                      json.dumps(entry["chunk_ids"])) for path, entry in files.items() if entry is not None],
+                )
+                self.connection.executemany("DELETE FROM files WHERE path = ?",
+                                            [(path,) for path, entry in files.items() if entry is None])
+                if version is not None:
+                    self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                                            (version,))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def drop(self) -> None:
+        with self.lock:
+            self.connection.close()
+            for suffix in ("", "-wal", "-shm"):
+                Path(f"{self.db_path}{suffix}").unlink(missing_ok=True)
+
+    def _import_legacy_manifest(self, file_path: Path) -> None:
+        try:
+            manifest = json.loads(file_path.read_text())
+        except FileNotFoundError:
+            return
+        except json.decoder.JSONDecodeError:
+            logger.warning("Could not import the manifest %s, the file is not valid json", file_path)
+            return
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Only into an empty manifest, so that the import happens once even with several processes starting
+            if self.connection.execute("SELECT 1 FROM meta LIMIT 1").fetchone() is None:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO files (path, file_hash, chunk_ids) VALUES (?, ?, ?)",
+                    [(path, entry["file_hash"], json.dumps(entry["chunk_ids"]))
+                     for path, entry in manifest.get("files", {}).items()],
+                )
+                self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                                        (manifest.get("version", ""),))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        file_path.unlink(missing_ok=True)
+        logger.info("Imported the ingestion manifest %s", file_path)
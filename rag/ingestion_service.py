@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import logfire
+import rag.rag_service as RagService
+from rag.models.ingestion_job import IngestionJob
+
+logger = logging.getLogger(__name__)
+
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "1"))
+# Jobs waiting to run beyond this are refused instead of piling up
+INGESTION_QUEUE_SIZE = int(os.getenv("INGESTION_QUEUE_SIZE", "16"))
+# Background jobs extract with fewer processes, leaving CPU for the interactive requests
+BACKGROUND_PDF_EXTRACT_WORKERS = int(os.getenv("BACKGROUND_PDF_EXTRACT_WORKERS",
+                                               str(max(1, (os.cpu_count() or 1) // 2))))
+JOBS_PATH = RagService.CHROMA_PATH.joinpath('ingestion_jobs.json')
+FINISHED_JOBS_KEPT = 100
+# Progress is written at most this often, status changes are written immediately
+JOBS_SAVE_INTERVAL = 1.0
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class IngestionQueueFullError(Exception):
+    pass
+
+
+class _JobProgress(RagService.IngestionProgress):
+
+    def __init__(self, service: "IngestionService", job_id: str):
+        super().__init__()
+        self.service = service
+        self.job_id = job_id
+
+    def update(self) -> None:
+        self.service._update_progress(self.job_id, self)
+
+    def is_cancelled(self) -> bool:
+        return self.job_id in self.service.cancel_requested
+
+
+class IngestionService:
+    """Runs the ingestions as background jobs, so they never block the chat requests.
+
+    Jobs are queued and run by a small pool of worker threads, the queries keep being served from the current
+    collection while they run. The jobs are persisted, the ones interrupted by a crash are queued again on
+    start and resume where they stopped, since the ingestion manifest skips the files already ingested. A
+    re-ingestion records the collection it builds before starting, and resumes into it.
+    """
+
+    def __init__(self, jobs_path=JOBS_PATH, workers: int = INGESTION_WORKERS,
+                 queue_size: int = INGESTION_QUEUE_SIZE, max_pdf_workers: int = BACKGROUND_PDF_EXTRACT_WORKERS):
+        self.jobs_path = jobs_path
+        self.queue_size = queue_size
+        self.max_pdf_workers = max_pdf_workers
+        self.lock = threading.Lock()
+        self.jobs: OrderedDict[str, IngestionJob] = OrderedDict()
+        self.cancel_requested: set[str] = set()
+        self.pending: queue.Queue[str] = queue.Queue()
+        self.last_saved = 0.0
+        for job in self._load():
+            if job.status in ACTIVE_STATUSES:
+                job.status = "queued"
+                self.pending.put(job.job_id)
+            self.jobs[job.job_id] = job
+        for index in range(workers):
+            threading.Thread(target=self._work, name=f"ingestion-worker-{index}", daemon=True).start()
+
+    def submit(self, path: str, tenant_id: str | None = None, reingest: bool = False) -> IngestionJob:
+        """Queue an ingestion, an identical job that is still queued or running is returned instead."""
+        path = str(path)
+        with self.lock:
+            for job in self.jobs.values():
+                if (job.status in ACTIVE_STATUSES and job.path == path and job.tenant_id == tenant_id
+                        and job.reingest == reingest):
+                    return job.model_copy()
+            if sum(job.status == "queued" for job in self.jobs.values()) >= self.queue_size:
+                raise IngestionQueueFullError(f"Too many ingestion jobs are waiting ({self.queue_size})")
+            now = time.time()
+            job = IngestionJob(job_id=str(uuid.uuid4()), path=path, tenant_id=tenant_id, reingest=reingest,
+                               created_at=now, updated_at=now)
+            self.jobs[job.job_id] = job
+            self._save(force=True)
+        self.pending.put(job.job_id)
+        logger.info("Ingestion job %s queued for %s", job.job_id, path)
+        return job.model_copy()
+
+    def status(self, job_id: str) -> IngestionJob | None:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.model_copy() if job else None
+
+    def list_jobs(self, tenant_id: str | None = None) -> list[IngestionJob]:
+        with self.lock:
+            return [job.model_copy() for job in self.jobs.values() if tenant_id is None or job.tenant_id == tenant_id]
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job, a running job stops after its current page."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status not in ACTIVE_STATUSES:
+                return False
+            if job.status == "queued":
+                self._set_status(job, "cancelled")
+            else:
+                self.cancel_requested.add(job_id)
+            return True
+
+    def _work(self) -> None:
+        while True:
+            job_id = self.pending.get()
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job is None or job.status != "queued":
+                    continue
+                self._set_status(job, "running")
+            self._run(job)
+
+    def _run(self, job: IngestionJob) -> None:
+        progress = _JobProgress(self, job.job_id)
+        status, error = "completed", None
+        try:
+            with logfire.span("IngestionService.run_job", job_id=job.job_id, path=job.path, reingest=job.reingest):
+                if job.reingest:
+                    with self.lock:
+                        if job.target_collection is None:
+                            job.target_collection = RagService.new_collection_name(job.tenant_id)
+                            self._save(force=True)
+                    RagService.reingest_data_from_file_or_folder(job.path, job.tenant_id, progress,
+                                                                 self.max_pdf_workers, job.target_collection)
+                else:
+                    RagService.ingest_data_from_file_or_folder(job.path, job.tenant_id, progress,
+                                                               self.max_pdf_workers)
+        except RagService.IngestionCancelledError:
+            status = "cancelled"
+        except Exception as e:
+            # Keep the worker alive for the next jobs
+            logger.exception("Ingestion job %s failed", job.job_id)
+            status, error = "failed", str(e)
+        with self.lock:
+            self.cancel_requested.discard(job.job_id)
+            job.error = error
+            self._set_status(job, status)
+        logger.info("Ingestion job %s %s: %d/%d files, %d chunks", job.job_id, status, job.files_done,
+                    job.files_total, job.chunks_done)
+
+    def _update_progress(self, job_id: str, progress: RagService.IngestionProgress) -> None:
+        with self.lock:
+            job = self.jobs[job_id]
+            job.files_total = progress.files_total
+            job.files_done = progress.files_done
+            job.chunks_done = progress.chunks_done
+            job.updated_at = time.time()
+            self._save()
+
+    def _set_status(self, job: IngestionJob, status: str) -> None:
+        job.status = status
+        job.updated_at = time.time()
+        self._save(force=True)
+
+    def _load(self) -> list[IngestionJob]:
+        if not os.path.exists(self.jobs_path):
+            return []
+        try:
+            with open(self.jobs_path, 'r') as f:
+                return [IngestionJob(**job) for job in json.load(f)]
+        except (json.decoder.JSONDecodeError, TypeError, ValueError, OSError):
+            return []
+
+    def _save(self, force: bool = False) -> None:
+        if not force and time.monotonic() - self.last_saved < JOBS_SAVE_INTERVAL:
+            return
+        finished = [job_id for job_id, job in self.jobs.items() if job.status not in ACTIVE_STATUSES]
+        for job_id in finished[:max(0, len(finished) - FINISHED_JOBS_KEPT)]:
+            del self.jobs[job_id]
+        os.makedirs(os.path.dirname(self.jobs_path), exist_ok=True)
+        with open(f"{self.jobs_path}.tmp", 'w') as f:
+            json.dump([job.model_dump() for job in self.jobs.values()], f)
+        os.replace(f"{self.jobs_path}.tmp", self.jobs_path)
+        self.last_saved = time.monotonic()
+
+
+_ingestion_service: IngestionService | None = None
+_ingestion_service_lock = threading.Lock()
+
+
+def get_ingestion_service() -> IngestionService:
+    global _ingestion_service
+    if _ingestion_service is None:
+        with _ingestion_service_lock:
+            if _ingestion_service is None:
+                _ingestion_service = IngestionService()
+    return _ingestion_service
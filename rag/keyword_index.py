@@ -0,0 +1,47 @@
+import sqlite3
+import rag.bm25 as Bm25
+
+# Full text index over the document column of a chunks table (row INTEGER PRIMARY KEY, chunk_id, document). The
+# index does not copy the documents, and the triggers keep it in the same transaction as the writes to the chunks
+KEYWORD_INDEX_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(document, content='chunks', content_rowid='row');
+CREATE TRIGGER IF NOT EXISTS chunks_fts_insert AFTER INSERT ON chunks BEGIN
+    INSERT INTO chunks_fts (rowid, document) VALUES (new.row, new.document);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_fts_delete AFTER DELETE ON chunks BEGIN
+    INSERT INTO chunks_fts (chunks_fts, rowid, document) VALUES ('delete', old.row, old.document);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_fts_update AFTER UPDATE OF document ON chunks BEGIN
+    INSERT INTO chunks_fts (chunks_fts, rowid, document) VALUES ('delete', old.row, old.document);
+    INSERT INTO chunks_fts (rowid, document) VALUES (new.row, new.document);
+END;
+"""
+
+
+def create_keyword_index(connection: sqlite3.Connection) -> None:
+    """Create the keyword index of the chunks table, indexing the chunks stored before it existed."""
+    exists = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone() is not None
+    connection.executescript(KEYWORD_INDEX_SCHEMA)
+    if not exists:
+        connection.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+    connection.commit()
+
+
+def search_keywords(connection: sqlite3.Connection, query: str, limit: int) -> list[tuple[str, float]]:
+    """Top `limit` (chunk id, score) pairs for the query, ranked with the BM25 of FTS5.
+
+    The query is tokenized like the other BM25 searches (lowercase words, without stop words), and only the
+    postings of its terms are read from disk.
+    """
+    terms = dict.fromkeys(Bm25.tokenize(query))
+    if not terms:
+        return []
+    # The tokens are plain words, quoted they can't be taken for FTS5 operators
+    expression = " OR ".join(f'"{term}"' for term in terms)
+    rows = connection.execute(
+        "SELECT chunks.chunk_id, bm25(chunks_fts) FROM chunks_fts JOIN chunks ON chunks.row = chunks_fts.rowid "
+        "WHERE chunks_fts MATCH ? ORDER BY bm25(chunks_fts) LIMIT ?",
+        (expression, limit),
+    ).fetchall()
+    # bm25() is lower for better matches
+    return [(chunk_id, -score) for chunk_id, score in rows]
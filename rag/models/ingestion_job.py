@@ -0,0 +1,20 @@
+from typing import Literal
+from pydantic import BaseModel
+
+JobStatus = Literal["queued", "running", "completed", "failed", "cancelled"]
+
+
+class IngestionJob(BaseModel):
+    job_id: str
+    path: str
+    tenant_id: str | None = None
+    reingest: bool = False
+    # Collection a re-ingestion builds before the switch, chosen when the job first runs and resumed after a crash
+    target_collection: str | None = None
+    status: JobStatus = "queued"
+    files_total: int = 0
+    files_done: int = 0
+    chunks_done: int = 0
+    error: str | None = None
+    created_at: float
+    updated_at: float
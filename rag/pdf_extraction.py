@@ -0,0 +1,14 @@
+# Imported by the extraction worker processes, which are started without the parent's modules. Kept apart from
+# rag_service so that a worker only imports pypdf
+
+
+def extract_pages(file_path: str) -> list[tuple[int, str]]:
+    # Runs inside the worker processes, so it only returns the text of a single file
+    from pypdf import PdfReader
+    reader = PdfReader(str(file_path))
+    pages = []
+    for page_number, page in enumerate(reader.pages, start=1):
+        extracted = (page.extract_text() or "").strip()
+        if extracted:
+            pages.append((page_number, extracted))
+    return pages
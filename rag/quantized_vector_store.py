@@ -0,0 +1,322 @@
+from __future__ import annotations
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Iterator
+import numpy as np
+from rag.keyword_index import create_keyword_index, search_keywords
+from rag.vector_store import READ_BATCH_SIZE, SQLITE_MAX_VARIABLES, VectorStore
+
+# Candidates scored on the int8 codes per requested result, rescored with the float vectors
+RESCORE_FACTOR = int(os.getenv("QUANTIZED_RESCORE_FACTOR", "4"))
+# Inverted file index, 0 scans every vector. The lists are trained once the store has IVF_LISTS * 39 vectors
+IVF_LISTS = int(os.getenv("QUANTIZED_IVF_LISTS", "0"))
+IVF_PROBES = int(os.getenv("QUANTIZED_IVF_PROBES", "8"))
+IVF_MIN_VECTORS_PER_LIST = 39
+IVF_TRAIN_SAMPLE = 50_000
+IVF_TRAIN_ITERATIONS = 10
+# Retrained when the store grew this much since the last training
+IVF_RETRAIN_GROWTH = 4
+# Rows scored at once by the exhaustive scan. Small enough that the float32 copy of a block stays in the CPU
+# caches, larger blocks made the scan about 3x slower
+SCAN_BLOCK_ROWS = 8192
+INITIAL_CAPACITY = 1024
+
+
+class QuantizedVectorStore(VectorStore):
+    """Vector store for large corpora on CPU, the vectors are kept in memory mapped numpy files.
+
+    Every vector is stored as int8 codes with a per row scale (a quarter of float32) that the top-k search
+    scores with one matrix product per block of rows, and as float16 to rescore the best candidates exactly.
+    Documents and metadata live in a SQLite sidecar, keyed by the row of the vector, with the FTS5 index of the
+    keyword search. Opening a store only maps the files, the operating system pages in the parts that are read.
+
+    With QUANTIZED_IVF_LISTS set, the vectors are also assigned to k-means lists, and a query only scores the
+    vectors of the lists nearest to it.
+    """
+
+    backend = "quantized"
+
+    def __init__(self, name: str, path: Path):
+        super().__init__(name)
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.RLock()
+        self.meta_path = path.joinpath("meta.json")
+        meta = json.loads(self.meta_path.read_text()) if self.meta_path.exists() else {}
+        self.dim: int | None = meta.get("dim")
+        self.size: int = meta.get("size", 0)
+        self.capacity: int = meta.get("capacity", 0)
+        self.trained_size: int = meta.get("trained_size", 0)
+        self.conn = sqlite3.connect(path.joinpath("chunks.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL UNIQUE,"
+                          " document TEXT NOT NULL, metadata TEXT NOT NULL)")
+        create_keyword_index(self.conn)
+        self.centroids: np.ndarray | None = None
+        centroids_path = path.joinpath("centroids.npy")
+        if centroids_path.exists():
+            self.centroids = np.load(centroids_path)
+        self.free_rows: list[int] | None = None
+        self.live_count: int | None = None
+        if self.dim is not None:
+            self._map()
+            self._recover()
+
+    def upsert(self, ids: list[str], embeddings: list[list[float]], documents: list[str],
+               metadatas: list[dict[str, Any]]) -> None:
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        with self.lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._grow(INITIAL_CAPACITY)
+            rows_by_id = self._rows_of(ids)
+            free_rows = self._get_free_rows()
+            rows = []
+            for chunk_id in ids:
+                row = rows_by_id.get(chunk_id)
+                if row is None:
+                    row = free_rows.pop() if free_rows else self.size
+                    self.size = max(self.size, row + 1)
+                    rows_by_id[chunk_id] = row
+                    self.live_count = self._get_live_count() + 1
+                rows.append(row)
+            if self.size > self.capacity:
+                self._grow(max(self.size, self.capacity * 2))
+            rows = np.asarray(rows)
+            self.codes[rows], self.scales[rows] = quantize(vectors)
+            self.vectors[rows] = vectors.astype(np.float16)
+            self.live[rows] = 1
+            if self.centroids is not None:
+                self.lists[rows] = self._assign(vectors)
+            # Writes to the maps are in the page cache, they survive a crash of the process
+            # An update rather than a replace, so that the triggers of the keyword index see the previous document
+            self.conn.executemany("INSERT INTO chunks (row, chunk_id, document, metadata) VALUES (?, ?, ?, ?) "
+                                  "ON CONFLICT (row) DO UPDATE SET chunk_id = excluded.chunk_id, "
+                                  "document = excluded.document, metadata = excluded.metadata",
+                                  [(int(row), chunk_id, document, json.dumps(metadata or {}))
+                                   for row, chunk_id, document, metadata in zip(rows, ids, documents, metadatas)])
+            # The size is saved before the chunks are committed, a reopened store never hands out a committed row
+            self._save_meta()
+            self.conn.commit()
+            if IVF_LISTS and self._get_live_count() >= max(IVF_LISTS * IVF_MIN_VECTORS_PER_LIST,
+                                                         self.trained_size * IVF_RETRAIN_GROWTH):
+                self._train_ivf()
+                self._save_meta()
+
+    def delete(self, ids: list[str]) -> None:
+        with self.lock:
+            rows = list(self._rows_of(ids).values())
+            if not rows:
+                return
+            for start in range(0, len(rows), SQLITE_MAX_VARIABLES):
+                batch = rows[start:start + SQLITE_MAX_VARIABLES]
+                self.conn.execute(f"DELETE FROM chunks WHERE row IN ({','.join('?' * len(batch))})", batch)
+            self.conn.commit()
+            self.live[rows] = 0
+            self._get_free_rows().extend(rows)
+            self.live_count = self._get_live_count() - len(rows)
+
+    def count(self) -> int:
+        with self.lock:
+            return self._get_live_count()
+
+    def iter_chunks(self, batch_size: int = READ_BATCH_SIZE) -> Iterator[tuple[str, str, dict[str, Any]]]:
+        last_row = -1
+        while True:
+            with self.lock:
+                batch = self.conn.execute("SELECT row, chunk_id, document, metadata FROM chunks WHERE row > ? "
+                                          "ORDER BY row LIMIT ?", (last_row, batch_size)).fetchall()
+            for last_row, chunk_id, document, metadata in batch:
+                yield chunk_id, document, json.loads(metadata)
+            if len(batch) < batch_size:
+                return
+
+    def query(self, embedding: list[float], n_results: int) -> list[tuple[str, float]]:
+        query = np.asarray(embedding, dtype=np.float32)
+        with self.lock:
+            if self.dim is None or self._get_live_count() == 0:
+                return []
+            # The maps are only replaced when growing, a snapshot of them stays valid for the whole query
+            size, codes, scales, vectors, live = self.size, self.codes, self.scales, self.vectors, self.live
+            centroids, lists = self.centroids, self.lists
+        candidates = n_results * RESCORE_FACTOR
+        rows = None
+        if centroids is not None:
+            probes = np.argsort(centroids @ query)[-IVF_PROBES:]
+            rows = np.flatnonzero(np.isin(lists[:size], probes) & (live[:size] == 1))
+            if len(rows) < n_results:
+                rows = None
+        if rows is None:
+            rows = _scan(codes, scales, live, size, query, candidates)
+        elif len(rows) > candidates:
+            scores = _approximate_scores(codes[rows], scales[rows], query)
+            rows = rows[np.argpartition(scores, -candidates)[-candidates:]]
+        if len(rows) == 0:
+            return []
+        # Rescore the candidates with the float vectors, read in row order
+        rows = np.sort(rows)
+        similarities = vectors[rows].astype(np.float32) @ query
+        best = np.argsort(similarities)[::-1][:n_results]
+        best_rows = rows[best].tolist()
+        chunk_ids = self._ids_of(best_rows)
+        return [(chunk_ids[row], float(similarity)) for row, similarity in zip(best_rows, similarities[best])
+                if row in chunk_ids]
+
+    def keyword_search(self, query: str, n_results: int) -> list[tuple[str, float]]:
+        with self.lock:
+            return search_keywords(self.conn, query, n_results)
+
+    def get_chunks(self, ids: list[str]) -> dict[str, tuple[str, dict[str, Any]]]:
+        chunks = {}
+        with self.lock:
+            for start in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                batch = ids[start:start + SQLITE_MAX_VARIABLES]
+                for chunk_id, document, metadata in self.conn.execute(
+                        f"SELECT chunk_id, document, metadata FROM chunks WHERE chunk_id IN "
+                        f"({','.join('?' * len(batch))})", batch):
+                    chunks[chunk_id] = (document, json.loads(metadata))
+        return chunks
+
+    def get_embeddings(self, ids: list[str]) -> dict[str, np.ndarray]:
+        with self.lock:
+            rows_by_id = self._rows_of(ids)
+            vectors = self.vectors
+        if not rows_by_id:
+            return {}
+        # The float16 copy, as exact as the rescoring
+        embeddings = vectors[list(rows_by_id.values())].astype(np.float32)
+        return dict(zip(rows_by_id, embeddings))
+
+    def drop(self) -> None:
+        with self.lock:
+            self.conn.close()
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def _map(self) -> None:
+        self.codes = self._open_map("codes.i8", np.int8, (self.capacity, self.dim))
+        self.scales = self._open_map("scales.f32", np.float32, (self.capacity,))
+        self.vectors = self._open_map("vectors.f16", np.float16, (self.capacity, self.dim))
+        self.live = self._open_map("live.u8", np.uint8, (self.capacity,))
+        self.lists = self._open_map("lists.i32", np.int32, (self.capacity,))
+
+    def _recover(self) -> None:
+        # The chunks table is the committed state. A crash between the writes to the maps, the meta and the chunks
+        # can leave a size too small for the committed rows, or rows flagged live without a committed chunk
+        max_row, chunk_count = self.conn.execute("SELECT MAX(row), COUNT(*) FROM chunks").fetchone()
+        if max_row is not None and max_row >= self.size:
+            self.size = max_row + 1
+            if self.size > self.capacity:
+                self._grow(self.size)
+            self._save_meta()
+        if int(np.count_nonzero(self.live[:self.size])) != chunk_count:
+            self.live[:self.size] = 0
+            for (row,) in self.conn.execute("SELECT row FROM chunks"):
+                self.live[row] = 1
+
+    def _open_map(self, file_name: str, dtype, shape: tuple) -> np.memmap:
+        return np.memmap(self.path.joinpath(file_name), dtype=dtype, mode="r+", shape=shape)
+
+    def _grow(self, capacity: int) -> None:
+        # The files are extended in place and mapped again, the previous maps stay valid for running queries
+        for file_name, row_bytes in (("codes.i8", self.dim), ("scales.f32", 4), ("vectors.f16", self.dim * 2),
+                                     ("live.u8", 1), ("lists.i32", 4)):
+            with open(self.path.joinpath(file_name), "ab") as f:
+                f.truncate(capacity * row_bytes)
+        self.capacity = capacity
+        self._map()
+        self._save_meta()
+
+    def _save_meta(self) -> None:
+        tmp_path = self.meta_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"dim": self.dim, "size": self.size, "capacity": self.capacity,
+                                        "trained_size": self.trained_size}))
+        os.replace(tmp_path, self.meta_path)
+
+    def _get_live_count(self) -> int:
+        if self.live_count is None:
+            self.live_count = int(np.count_nonzero(self.live[:self.size])) if self.dim is not None else 0
+        return self.live_count
+
+    def _get_free_rows(self) -> list[int]:
+        # Rows of deleted vectors, reused by the next upserts
+        if self.free_rows is None:
+            self.free_rows = (np.flatnonzero(self.live[:self.size] == 0).tolist()[::-1]
+                              if self.dim is not None else [])
+        return self.free_rows
+
+    def _rows_of(self, ids: list[str]) -> dict[str, int]:
+        rows = {}
+        for start in range(0, len(ids), SQLITE_MAX_VARIABLES):
+            batch = ids[start:start + SQLITE_MAX_VARIABLES]
+            rows.update(self.conn.execute(f"SELECT chunk_id, row FROM chunks WHERE chunk_id IN "
+                                          f"({','.join('?' * len(batch))})", batch).fetchall())
+        return rows
+
+    def _ids_of(self, rows: list[int]) -> dict[int, str]:
+        with self.lock:
+            return dict(self.conn.execute(f"SELECT row, chunk_id FROM chunks WHERE row IN ({','.join('?' * len(rows))})",
+                                          rows).fetchall())
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def _train_ivf(self) -> None:
+        """Spherical k-means over a sample of the vectors, then assign every vector to its nearest list."""
+        live_rows = np.flatnonzero(self.live[:self.size] == 1)
+        generator = np.random.default_rng(42)
+        sample = np.sort(generator.choice(live_rows, min(len(live_rows), IVF_TRAIN_SAMPLE), replace=False))
+        sample_vectors = self.vectors[sample].astype(np.float32)
+        centroids = sample_vectors[generator.choice(len(sample), IVF_LISTS, replace=False)]
+        for _ in range(IVF_TRAIN_ITERATIONS):
+            assignments = np.argmax(sample_vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample_vectors)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty lists keep their centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+        self.centroids = centroids.astype(np.float32)
+        for start in range(0, self.size, SCAN_BLOCK_ROWS):
+            end = min(start + SCAN_BLOCK_ROWS, self.size)
+            self.lists[start:end] = self._assign(self.vectors[start:end].astype(np.float32))
+        np.save(self.path.joinpath("centroids.npy"), self.centroids)
+        self.trained_size = self._get_live_count()
+
+
+def quantize(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Symmetric int8 codes and the scale of every row."""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _approximate_scores(codes: np.ndarray, scales: np.ndarray, query: np.ndarray) -> np.ndarray:
+    # The float32 product runs on BLAS, an int8 product would not
+    return (codes.astype(np.float32) @ query) * scales
+
+
+def _scan(codes: np.ndarray, scales: np.ndarray, live: np.ndarray, size: int, query: np.ndarray,
+          candidates: int) -> np.ndarray:
+    """Rows of the best approximate scores over all the live vectors, scored block by block."""
+    best_rows = np.empty(0, dtype=np.int64)
+    best_scores = np.empty(0, dtype=np.float32)
+    for start in range(0, size, SCAN_BLOCK_ROWS):
+        end = min(start + SCAN_BLOCK_ROWS, size)
+        scores = _approximate_scores(codes[start:end], scales[start:end], query)
+        scores[live[start:end] == 0] = -np.inf
+        rows = np.arange(start, end)
+        if len(scores) > candidates:
+            top = np.argpartition(scores, -candidates)[-candidates:]
+            rows, scores = rows[top], scores[top]
+        best_rows = np.concatenate([best_rows, rows])
+        best_scores = np.concatenate([best_scores, scores])
+        if len(best_scores) > candidates:
+            top = np.argpartition(best_scores, -candidates)[-candidates:]
+            best_rows, best_scores = best_rows[top], best_scores[top]
+    return best_rows[np.isfinite(best_scores)]
@@ -1,100 +1,667 @@
 from __future__ import annotations
-import chromadb
-from sentence_transformers import SentenceTransformer
 import glob
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Iterator
 import logfire
+from opentelemetry.metrics import CallbackOptions, Observation
 from util import Util
 from pathlib import Path
-from pypdf import PdfReader
+import rag.embedding_service as EmbeddingService
+from rag.ingest_manifest import IngestManifest
+from rag.pdf_extraction import extract_pages
+from rag.retrieval_engine import Retrieval, RetrievalEngine, RetrievalSession
+from rag.vector_store import READ_BATCH_SIZE, ChromaVectorStore, VectorStore
+
+if TYPE_CHECKING:
+    from chromadb.api import ClientAPI
+
+logger = logging.getLogger(__name__)
 
 EMPTY_STRING = ""
-# Initialize ChromaDB and model
-client = chromadb.PersistentClient(path=Path(__file__).resolve().parent.parent.joinpath('chroma'))
-collection = client.get_or_create_collection("knowledge-docs")
+CHROMA_PATH = Path(os.getenv("CHROMA_PATH", Path(__file__).resolve().parent.parent.joinpath('chroma')))
+DEFAULT_TENANT_ID = "default"
+DEFAULT_COLLECTION_NAME = "knowledge-docs"
+# Tracks the size, modification time and content hash of every ingested file and the ids of the chunks it
+# produced, one per collection (SQLite, the json manifests of earlier versions are imported on first use)
+MANIFEST_PATH = CHROMA_PATH.joinpath('ingest_manifest.db')
+MANIFESTS_PATH = CHROMA_PATH.joinpath('manifests')
+# Live collection of every tenant, switched atomically by a blue/green re-ingestion
+ALIASES_PATH = CHROMA_PATH.joinpath('collection_aliases.json')
+# Seconds a replaced collection is kept, so that the queries still running on it can complete
+RETIRED_COLLECTION_GRACE_SECONDS = 60.0
+# Replaced collections waiting for the end of their grace period, swept by the next process if this one exits
+RETIRED_COLLECTIONS_PATH = CHROMA_PATH.joinpath('retired_collections.json')
+# Minimum seconds between two manifest commits while a long ingestion is running, each one publishes a new version
+# of the collection to the other processes
+MANIFEST_SAVE_INTERVAL = 5.0
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+# Not fork, the process runs threads (blocking pool, exporters, torch, ingestion workers) and a forked worker
+# could inherit one of their locks held forever
+PDF_EXTRACT_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+# chroma, or quantized for large corpora (int8 vectors in memory mapped files, see rag/quantized_vector_store.py).
+# The collections of one backend are not visible to the other, switching it ingests the files again
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "chroma").lower()
+QUANTIZED_STORE_PATH = CHROMA_PATH.joinpath('quantized')
+# Keyword index of every chroma collection, the quantized stores keep theirs in their own sidecar
+KEYWORD_INDEX_PATH = CHROMA_PATH.joinpath('keyword')
+# Retrieval state of the active conversations, the least recently used ones are dropped
+MAX_RETRIEVAL_SESSIONS = int(os.getenv("MAX_RETRIEVAL_SESSIONS", "1000"))
+# Opened on first use, importing chromadb and opening the persistent client is slow
+_client: ClientAPI | None = None
+_client_lock = threading.Lock()
 
-def read_docs(path: str):
-    # Read content from the input file path or from content from all the file from the input folder path
-    docs = []
-    doc_paths = []
+
+def get_client() -> ClientAPI:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import chromadb
+                _client = chromadb.PersistentClient(path=CHROMA_PATH)
+    return _client
+
+
+def open_vector_store(name: str, backend: str = VECTOR_STORE_BACKEND) -> VectorStore:
+    if backend == "chroma":
+        return ChromaVectorStore(name, get_client(), KEYWORD_INDEX_PATH.joinpath(f"{name}.db"))
+    if backend == "quantized":
+        from rag.quantized_vector_store import QuantizedVectorStore
+        return QuantizedVectorStore(name, QUANTIZED_STORE_PATH.joinpath(name))
+    raise ValueError(f"Unknown vector store backend: {backend}")
+
+
+def _file_stamp(path: Path) -> tuple[int, int, int] | None:
+    # The files are replaced (os.replace) on every write, the inode changes even within the mtime resolution
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _manifest_path(name: str, backend: str) -> Path:
+    if backend != "chroma":
+        # The other backends have their own manifests, their collections are ingested separately
+        return MANIFESTS_PATH.joinpath(f"{name}.{backend}.db")
+    return MANIFEST_PATH if name == DEFAULT_COLLECTION_NAME else MANIFESTS_PATH.joinpath(f"{name}.db")
+
+
+class KnowledgeCollection:
+    """The vector store of a collection with its ingestion manifest and its retrieval engine."""
+
+    def __init__(self, name: str, backend: str = VECTOR_STORE_BACKEND):
+        self.name = name
+        self.store = open_vector_store(name, backend)
+        manifest_path = _manifest_path(name, self.store.backend)
+        self.manifest = IngestManifest(manifest_path, manifest_path.with_suffix(".json"))
+        self.retrieval_engine = RetrievalEngine()
+        # One ingestion at a time per collection
+        self.ingest_lock = threading.Lock()
+        # Changes whenever the content of the collection changes, lets caches built on top of it invalidate themselves
+        self.version: str | None = None
+        # Of the manifest when this process last checked it, a different one was committed by another process
+        self.manifest_data_version = self.manifest.get_data_version()
+
+    def save_manifest(self, files: dict[str, dict | None]) -> None:
+        """Record the entries of the given files (None for a removed file) with the current version."""
+        self.manifest.save(files, self.version)
+
+    def get_version(self) -> str:
+        if self.version is None:
+            self.version = self.manifest.get_version()
+        return self.version
+
+    def is_stale(self) -> bool:
+        """True when another process changed the collection since this one opened it.
+
+        Only the data version of the manifest is read while nothing changed. The collection is never stale while
+        this process ingests into it, it is the writer.
+        """
+        if self.ingest_lock.locked():
+            return False
+        manifest_data_version = self.manifest.get_data_version()
+        if manifest_data_version == self.manifest_data_version:
+            return False
+        if self.manifest.get_version() != self.get_version():
+            return True
+        self.manifest_data_version = manifest_data_version
+        return False
+
+    def changed(self) -> None:
+        # Called after the writes to the collection, moves to a new version and keeps the retrieval engine in sync.
+        # The engine has the changes before the version is published, so a query never finds the new version
+        # ahead of the engine
+        version = uuid.uuid4().hex
+        with self.retrieval_engine.lock:
+            self.retrieval_engine.apply_changes(version, self.store.count())
+            self.version = version
+
+    def drop(self) -> None:
+        self.store.drop()
+        self.manifest.drop()
+
+
+class IngestionCancelledError(Exception):
+    pass
+
+
+class IngestionProgress:
+    """Receives the progress of an ingestion, and can stop it by returning True from is_cancelled."""
+
+    def __init__(self):
+        self.files_total = 0
+        self.files_done = 0
+        self.chunks_done = 0
+
+    def update(self) -> None:
+        """Called after every change of the counters."""
+
+    def is_cancelled(self) -> bool:
+        return False
+
+    def check_cancelled(self) -> None:
+        if self.is_cancelled():
+            raise IngestionCancelledError("Ingestion was cancelled")
+
+
+_knowledge_collections: dict[str, KnowledgeCollection] = {}
+_knowledge_collections_lock = threading.Lock()
+# Aliases as of the last read of the file, read again whenever a process (this one included) switched a collection
+_aliases: dict[str, str] = {}
+_aliases_stamp: tuple[int, int, int] | None = None
+_retrieval_sessions: OrderedDict[tuple[str, str], RetrievalSession] = OrderedDict()
+_retrieval_sessions_lock = threading.Lock()
+_retired_collections_lock = threading.Lock()
+_retired_collections_swept = False
+
+
+def _observe_collection_sizes(options: CallbackOptions) -> list[Observation]:
+    # Called on every metrics export, off the request path
+    with _knowledge_collections_lock:
+        knowledge_collections = list(_knowledge_collections.values())
+    return [Observation(knowledge_collection.store.count(), {"collection": knowledge_collection.name})
+            for knowledge_collection in knowledge_collections]
+
+
+logfire.metric_gauge_callback("knowledge_collection_size", [_observe_collection_sizes], unit="1",
+                              description="Chunks in the live knowledge collection of every loaded tenant")
+
+
+def list_doc_paths(path: str) -> list[str]:
+    # Resolve the input file path or all the pdf files under the input folder path and its sub folders
     if path.endswith(".pdf"):
         final_path = path
     else:
-        final_path = path + "/*.pdf"
+        final_path = path + "/**/*.pdf"
     files = glob.glob(final_path, recursive=True)
-    files_count = len(files)
-    if files_count == 0:
+    if len(files) == 0:
         raise FileNotFoundError(Util.FILE_NOT_FOUND_ERROR)
-    for file_path in files:
-        reader = PdfReader(str(file_path))
-        text = ""
-        for page in reader.pages:
-            extracted = page.extract_text() or ""
-            text += extracted + "\n"
-        content = text.strip()
-        if content:  # Only add non-empty files
-            docs.append(content)
-            doc_paths.append(file_path)
+    return sorted(str(Path(file_path).resolve()) for file_path in files)
+
+
+def iter_pdf_pages(file_paths: list[str], max_workers: int = PDF_EXTRACT_WORKERS) -> Iterator[tuple[str, int, str]]:
+    """Yield (path, page, text) records of the given files, in file order.
+
+    Pages are extracted in a process pool. Only a bounded number of files are in flight at a time, so the
+    memory used does not grow with the number of files.
+    """
+    if len(file_paths) <= 1 or max_workers <= 1:
+        for file_path in file_paths:
+            for page_number, text in extract_pages(file_path):
+                yield file_path, page_number, text
+        return
+
+    executor = ProcessPoolExecutor(max_workers=max_workers,
+                                   mp_context=multiprocessing.get_context(PDF_EXTRACT_START_METHOD))
+    try:
+        pending = deque()
+        paths = iter(file_paths)
+        for file_path in itertools.islice(paths, max_workers * 2):
+            pending.append((file_path, executor.submit(extract_pages, file_path)))
+        while pending:
+            file_path, future = pending.popleft()
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append((next_path, executor.submit(extract_pages, next_path)))
+            for page_number, text in future.result():
+                yield file_path, page_number, text
+    finally:
+        # The consumer may stop early (cancelled ingestion), don't start the files still queued
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def read_docs(path: str):
+    # Read content from the input file path or from content from all the file from the input folder path
+    docs = []
+    doc_paths = []
+    for file_path, records in itertools.groupby(iter_pdf_pages(list_doc_paths(path)), key=lambda record: record[0]):
+        docs.append("\n".join(text for _, _, text in records))
+        doc_paths.append(file_path)
     return docs, doc_paths
 
 
+def _file_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _chunk_ids(file_path: str, page_number: int, chunks: list[str]) -> list[str]:
+    # Content derived ids, so an unchanged chunk keeps its id across re-ingestion
+    ids = []
+    seen: dict[str, int] = {}
+    for chunk in chunks:
+        occurrence = seen.get(chunk, 0)
+        seen[chunk] = occurrence + 1
+        key = f"{file_path}\x00{page_number}\x00{occurrence}\x00{chunk}"
+        ids.append(hashlib.sha256(key.encode("utf-8")).hexdigest())
+    return ids
+
+
+def _tenant_collection_name(tenant_id: str, new: bool = False) -> str:
+    # Chroma restricts the collection names, so the tenant id is hashed
+    if tenant_id == DEFAULT_TENANT_ID and not new:
+        return DEFAULT_COLLECTION_NAME
+    tenant_key = hashlib.sha256(tenant_id.encode("utf-8")).hexdigest()[:16]
+    name = f"{DEFAULT_COLLECTION_NAME}-{tenant_key}"
+    return f"{name}-{uuid.uuid4().hex[:8]}" if new else name
+
+
+def new_collection_name(tenant_id: str | None = None) -> str:
+    """Name of a new collection for the tenant, to re-ingest into."""
+    return _tenant_collection_name(tenant_id or DEFAULT_TENANT_ID, new=True)
+
+
+def _load_aliases() -> dict[str, str]:
+    if ALIASES_PATH.exists():
+        try:
+            return json.loads(ALIASES_PATH.read_text())
+        except json.decoder.JSONDecodeError:
+            pass
+    return {}
+
+
+def _save_aliases(aliases: dict[str, str]) -> None:
+    ALIASES_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = ALIASES_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(aliases))
+    os.replace(tmp_path, ALIASES_PATH)
+
+
+def _live_collection_name(tenant_id: str) -> str:
+    global _aliases, _aliases_stamp
+    aliases_stamp = _file_stamp(ALIASES_PATH)
+    if aliases_stamp != _aliases_stamp:
+        _aliases, _aliases_stamp = _load_aliases(), aliases_stamp
+    return _aliases.get(tenant_id) or _tenant_collection_name(tenant_id)
+
+
+def _is_current(knowledge_collection: KnowledgeCollection | None, name: str) -> bool:
+    return knowledge_collection is not None and knowledge_collection.name == name and not knowledge_collection.is_stale()
+
+
+def get_knowledge_collection(tenant_id: str | None = None) -> KnowledgeCollection:
+    """Live collection of the tenant, the shared default collection when no tenant is given.
+
+    The collection is opened again when another process switched the tenant to a new collection or changed
+    the live one, so that every process follows the re-ingestions and the response caches see the new version.
+    """
+    tenant_id = tenant_id or DEFAULT_TENANT_ID
+    knowledge_collection = _knowledge_collections.get(tenant_id)
+    if not _is_current(knowledge_collection, _live_collection_name(tenant_id)):
+        sweep_retired_collections()
+        with _knowledge_collections_lock:
+            name = _live_collection_name(tenant_id)
+            knowledge_collection = _knowledge_collections.get(tenant_id)
+            if not _is_current(knowledge_collection, name):
+                knowledge_collection = KnowledgeCollection(name)
+                _knowledge_collections[tenant_id] = knowledge_collection
+    return knowledge_collection
+
+
+def _switch_collection(tenant_id: str, knowledge_collection: KnowledgeCollection) -> None:
+    # Queries pick up the new collection from their next request, the previous one is dropped after a grace period
+    with _knowledge_collections_lock:
+        aliases = _load_aliases()
+        previous_name = aliases.get(tenant_id) or _tenant_collection_name(tenant_id)
+        aliases[tenant_id] = knowledge_collection.name
+        _save_aliases(aliases)
+        _knowledge_collections[tenant_id] = knowledge_collection
+    if previous_name != knowledge_collection.name:
+        _retire_collection(previous_name, knowledge_collection.store.backend)
+
+
+def _load_retired_collections() -> list[dict]:
+    if RETIRED_COLLECTIONS_PATH.exists():
+        try:
+            return json.loads(RETIRED_COLLECTIONS_PATH.read_text())
+        except json.decoder.JSONDecodeError:
+            pass
+    return []
+
+
+def _save_retired_collections(retired: list[dict]) -> None:
+    RETIRED_COLLECTIONS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = RETIRED_COLLECTIONS_PATH.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(retired))
+    os.replace(tmp_path, RETIRED_COLLECTIONS_PATH)
+
+
+def _retire_collection(name: str, backend: str) -> None:
+    # Recorded before the drop is scheduled, so that the collection is dropped even if this process exits first
+    sweep_retired_collections()
+    entry = {"name": name, "backend": backend, "drop_after": time.time() + RETIRED_COLLECTION_GRACE_SECONDS}
+    with _retired_collections_lock:
+        retired = _load_retired_collections()
+        retired.append(entry)
+        _save_retired_collections(retired)
+    _schedule_drop(entry)
+
+
+def sweep_retired_collections() -> None:
+    """Schedule the drop of the collections retired by a previous process, once per process."""
+    global _retired_collections_swept
+    with _retired_collections_lock:
+        if _retired_collections_swept:
+            return
+        _retired_collections_swept = True
+        retired = _load_retired_collections()
+    for entry in retired:
+        _schedule_drop(entry)
+
+
+def _schedule_drop(entry: dict) -> None:
+    timer = threading.Timer(max(0.0, entry["drop_after"] - time.time()), _drop_retired_collection, args=(entry,))
+    timer.daemon = True
+    timer.start()
+
+
+def _drop_retired_collection(entry: dict) -> None:
+    with _knowledge_collections_lock:
+        live_names = set(_load_aliases().values())
+        live_names.update(knowledge_collection.name for knowledge_collection in _knowledge_collections.values())
+    if entry["name"] not in live_names:
+        try:
+            KnowledgeCollection(entry["name"], entry["backend"]).drop()
+        except Exception:
+            # Kept on disk, the next process tries again
+            logger.exception("Could not drop the retired collection %s", entry["name"])
+            return
+        logger.info("Dropped the retired collection %s", entry["name"])
+    with _retired_collections_lock:
+        _save_retired_collections([retired for retired in _load_retired_collections()
+                                   if (retired["name"], retired["backend"]) != (entry["name"], entry["backend"])])
+
+
+def get_collection_version(tenant_id: str | None = None) -> str:
+    return get_knowledge_collection(tenant_id).get_version()
+
+
+def get_retrieval_session(session_id: str, tenant_id: str | None = None) -> RetrievalSession:
+    key = (tenant_id or DEFAULT_TENANT_ID, session_id)
+    with _retrieval_sessions_lock:
+        session = _retrieval_sessions.get(key)
+        if session is None:
+            session = RetrievalSession()
+            _retrieval_sessions[key] = session
+            while len(_retrieval_sessions) > MAX_RETRIEVAL_SESSIONS:
+                _retrieval_sessions.popitem(last=False)
+        else:
+            _retrieval_sessions.move_to_end(key)
+        return session
+
+
 @logfire.instrument("RagService.get_ingested_data")
-def get_ingested_data(user_input:str) -> str:
-    # Verify storage
-    count = collection.count()
-    print(f"   ✅ Vector database contains {count} documents")
+def get_ingested_data(user_input:str, tenant_id: str | None = None, session_id: str | None = None,
+                      history: list[str] | None = None) -> str:
+    """Context for the user input, from the live collection of the tenant.
+
+    With the previous user messages of the conversation (oldest first), follow-up questions are retrieved with
+    the topic of the conversation. With a session id, the candidates of a previous turn are rescored instead of
+    querying the vector store again while the topic does not change.
+    """
+    retrieval = retrieve_ingested_data(user_input, tenant_id, session_id, history)
+    retrieval.commit()
+    return retrieval.context
+
+
+# The input may still turn out to hold PII, it is not recorded on the span
+@logfire.instrument("RagService.retrieve_ingested_data", extract_args=False)
+def retrieve_ingested_data(user_input: str, tenant_id: str | None = None, session_id: str | None = None,
+                           history: list[str] | None = None) -> Retrieval:
+    """Same as get_ingested_data, but nothing derived from the input is kept until the retrieval is committed."""
+    knowledge_collection = get_knowledge_collection(tenant_id)
+    retrieval_engine = knowledge_collection.retrieval_engine
+    # Verify storage, the count is only recomputed when the collection changed
+    count = retrieval_engine.get_chunk_count(knowledge_collection.store, knowledge_collection.get_version())
+    logger.debug("Vector database contains %d documents", count)
     if count == 0:
-        return EMPTY_STRING
-    results = collection.query(
-        query_texts=[user_input],
-        n_results=3
-    )
-    context_docs = ""
-    for i, (doc, distance) in enumerate(zip(results['documents'][0], results['distances'][0])):
-        similarity = 1 - distance
-        context_docs += doc
-    if len(context_docs) > 0:
-        return context_docs
-    else:
-        return EMPTY_STRING
+        return Retrieval(EMPTY_STRING)
+    session = get_retrieval_session(session_id, tenant_id) if session_id else None
+    return retrieval_engine.retrieve(knowledge_collection.store, knowledge_collection.get_version(), user_input,
+                                     history=history, session=session)
 
 @logfire.instrument("RagService.delete_ingested_data")
-def delete_ingested_data() -> None:
-    print("delete_ingested_data")
-    client.delete_collection("knowledge-docs")
-    global collection
-    collection = client.get_or_create_collection("knowledge-docs")
+def delete_ingested_data(tenant_id: str | None = None) -> None:
+    # Switch to a new empty collection, queries never see a dropped collection
+    logger.info("Deleting the ingested data of tenant %s", tenant_id or DEFAULT_TENANT_ID)
+    tenant_id = tenant_id or DEFAULT_TENANT_ID
+    knowledge_collection = KnowledgeCollection(new_collection_name(tenant_id))
+    knowledge_collection.changed()
+    knowledge_collection.save_manifest({})
+    _switch_collection(tenant_id, knowledge_collection)
+
+@logfire.instrument("RagService.reingest_data_from_file_or_folder")
+def reingest_data_from_file_or_folder(path: str, tenant_id: str | None = None,
+                                      progress: IngestionProgress | None = None,
+                                      max_workers: int = PDF_EXTRACT_WORKERS,
+                                      collection_name: str | None = None) -> None:
+    """Rebuild the knowledge of the tenant from scratch with a blue/green swap.
+
+    The data is ingested into a new collection while the queries keep being served from the live one, then
+    the tenant is switched to the new collection in one step. With the name of a collection an interrupted
+    re-ingestion was building (see new_collection_name), it resumes from the files already in its manifest.
+    """
+    logger.info("Re-ingesting %s for tenant %s", path, tenant_id or DEFAULT_TENANT_ID)
+    tenant_id = tenant_id or DEFAULT_TENANT_ID
+    knowledge_collection = KnowledgeCollection(collection_name or new_collection_name(tenant_id))
+    try:
+        _ingest(knowledge_collection, path, progress, max_workers)
+    except BaseException:
+        knowledge_collection.drop()
+        raise
+    _switch_collection(tenant_id, knowledge_collection)
 
 @logfire.instrument("RagService.ingest_data_from_file_or_folder")
-def ingest_data_from_file_or_folder(path: str) -> None:
-    print("ingest_data_from_file_or_folder")
-    docs, doc_paths = read_docs(path)
+def ingest_data_from_file_or_folder(path: str, tenant_id: str | None = None,
+                                    progress: IngestionProgress | None = None,
+                                    max_workers: int = PDF_EXTRACT_WORKERS) -> None:
+    """Ingest the pdf file(s) incrementally into the live collection of the tenant, as a stream of pages.
+
+    Files whose size and modification time, or else content hash, match the manifest are skipped without being
+    parsed, only the files whose size or modification time changed are hashed. The pages of the changed
+    files are extracted in a process pool, chunked page by page and embedded and written to the collection in
+    bounded batches, so memory stays flat whatever the size of the corpus. Only the chunks that are new are
+    embedded, and the chunks that no longer exist are deleted.
+
+    The progress, when given, is updated per file and per written chunk and can cancel the ingestion. The
+    files completed before a cancellation stay ingested.
+    """
+    logger.info("Ingesting %s for tenant %s", path, tenant_id or DEFAULT_TENANT_ID)
+    _ingest(get_knowledge_collection(tenant_id), path, progress, max_workers)
+
+
+def _ingest(knowledge_collection: KnowledgeCollection, path: str, progress: IngestionProgress | None,
+            max_workers: int) -> None:
+    with knowledge_collection.ingest_lock:
+        _ingest_locked(knowledge_collection, path, progress or IngestionProgress(), max_workers)
+
+
+def _ingest_locked(knowledge_collection: KnowledgeCollection, path: str, progress: IngestionProgress,
+                   max_workers: int) -> None:
+    doc_paths = list_doc_paths(path)
+    files = knowledge_collection.manifest.get_files()
+    if not files and knowledge_collection.store.count() > 0:
+        _delete_untracked_chunks(knowledge_collection, files)
     # Split document into chunks
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=500,
         chunk_overlap=50,
         separators=["\n\n", "\n", " ", ""]
     )
-    total_chunks = 0
-    all_chunk_ids = []
-    all_embeddings = []
-    for doc_index, doc in enumerate(docs):
-        chunks = splitter.split_text(doc)
-
-        # Generate chunk IDs
-        chunk_ids = [f"chunk_{total_chunks + i + 1}" for i in range(len(chunks))]
-
-        # Create embeddings for all documents
-        model = SentenceTransformer('all-MiniLM-L6-v2')
-        embeddings = model.encode(chunks).tolist()
-
-        # Add documents to ChromaDB
-        collection.add(
-            ids=chunk_ids,
-            embeddings=embeddings,
-            documents=chunks,
-            metadatas=[{"source_doc": f"doc_{doc_index + 1}"} for _ in chunks]
-        )
-        total_chunks += len(chunk_ids)
-        all_chunk_ids.extend(chunk_ids)
-        all_embeddings.extend(embeddings)
\ No newline at end of file
+    batch = _ChunkBatch(knowledge_collection, files, progress)
+    file_states = {}
+    for file_path in doc_paths:
+        # Stat'ed before hashing, a file written while it is hashed is hashed again on the next run
+        stat = os.stat(file_path)
+        entry = files.get(file_path)
+        if entry and (entry["file_size"], entry["file_mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            continue
+        file_state = {"file_hash": _file_hash(file_path), "file_size": stat.st_size,
+                      "file_mtime_ns": stat.st_mtime_ns}
+        if entry and entry["file_hash"] == file_state["file_hash"]:
+            # Touched but unchanged, only its new size and modification time are recorded
+            batch.update_file(file_path, {**entry, **file_state})
+        else:
+            file_states[file_path] = file_state
+    changed_paths = list(file_states)
+    progress.files_total = len(doc_paths)
+    progress.files_done = len(doc_paths) - len(changed_paths)
+    progress.update()
+
+    try:
+        pages = iter_pdf_pages(changed_paths, max_workers)
+        for file_path, records in itertools.groupby(pages, key=lambda record: record[0]):
+            entry = files.get(file_path)
+            previous_ids = set(entry["chunk_ids"]) if entry else set()
+            chunk_ids = []
+            for _, page_number, text in records:
+                progress.check_cancelled()
+                chunks = splitter.split_text(text)
+                page_chunk_ids = _chunk_ids(file_path, page_number, chunks)
+                # Create embeddings only for the chunks which are not already stored
+                for chunk_index, (chunk_id, chunk) in enumerate(zip(page_chunk_ids, chunks)):
+                    if chunk_id not in previous_ids:
+                        batch.add(chunk_id, chunk, {"source_doc": file_path, "page": page_number,
+                                                    "chunk_index": chunk_index})
+                        if len(batch) >= EmbeddingService.EMBEDDING_BATCH_SIZE:
+                            batch.flush()
+                chunk_ids.extend(page_chunk_ids)
+            batch.complete_file(file_path, file_states.pop(file_path), chunk_ids, previous_ids)
+        # Files without any extractable text
+        for file_path, file_state in file_states.items():
+            entry = files.get(file_path)
+            batch.complete_file(file_path, file_state, [], set(entry["chunk_ids"]) if entry else set())
+    except IngestionCancelledError:
+        # Keep the files completed so far, the next ingestion resumes from them
+        batch.flush(final=True)
+        raise
+    batch.flush(final=True)
+
+    # Drop the chunks of files which were removed from the ingested folder
+    removed_files = []
+    if not path.endswith(".pdf"):
+        folder = str(Path(path).resolve()) + os.sep
+        current_paths = set(doc_paths)
+        removed_files = [file_path for file_path in files
+                         if file_path.startswith(folder) and file_path not in current_paths]
+        for file_path in removed_files:
+            stale_ids = files.pop(file_path)["chunk_ids"]
+            if stale_ids:
+                knowledge_collection.store.delete(stale_ids)
+        if removed_files:
+            knowledge_collection.changed()
+            knowledge_collection.save_manifest(dict.fromkeys(removed_files))
+    logger.info("%d of %d file(s) changed since last ingestion", len(changed_paths) + len(removed_files),
+                len(doc_paths))
+
+
+def _delete_untracked_chunks(knowledge_collection: KnowledgeCollection, files: dict[str, dict]) -> None:
+    # Chunks the manifest does not list can't be matched to their files, e.g. the chunk_N ids written before the
+    # manifest existed. They are deleted and their files ingested again, instead of being served next to the new ones
+    tracked_ids = {chunk_id for entry in files.values() for chunk_id in entry["chunk_ids"]}
+    untracked_ids = [chunk_id for chunk_id, _, _ in knowledge_collection.store.iter_chunks()
+                     if chunk_id not in tracked_ids]
+    for start in range(0, len(untracked_ids), READ_BATCH_SIZE):
+        knowledge_collection.store.delete(untracked_ids[start:start + READ_BATCH_SIZE])
+    if untracked_ids:
+        logger.info("Deleted %d chunk(s) of collection %s missing from its manifest", len(untracked_ids),
+                    knowledge_collection.name)
+        knowledge_collection.changed()
+        knowledge_collection.save_manifest({})
+
+
+class _ChunkBatch:
+    """Buffer of chunks waiting to be embedded and written to the vector store in one call.
+
+    A file is recorded in the manifest only once all of its chunks are written, so an interrupted ingestion
+    picks the file up again on the next run. Only the entries recorded since the last save are written to the
+    manifest.
+    """
+
+    def __init__(self, knowledge_collection: KnowledgeCollection, files: dict[str, dict],
+                 progress: IngestionProgress):
+        self.knowledge_collection = knowledge_collection
+        self.files = files
+        self.progress = progress
+        self.ids: list[str] = []
+        self.documents: list[str] = []
+        self.metadatas: list[dict] = []
+        self.completed_files: list[tuple[str, dict, list[str], set[str]]] = []
+        self.last_saved = time.monotonic()
+        self.unsaved_files: dict[str, dict] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, chunk_id: str, document: str, metadata: dict) -> None:
+        self.ids.append(chunk_id)
+        self.documents.append(document)
+        self.metadatas.append(metadata)
+
+    def complete_file(self, file_path: str, file_state: dict, chunk_ids: list[str], previous_ids: set[str]) -> None:
+        self.completed_files.append((file_path, file_state, chunk_ids, previous_ids))
+
+    def update_file(self, file_path: str, entry: dict) -> None:
+        """Record the entry of a file whose chunks did not change, saved with the next completed files."""
+        self.files[file_path] = entry
+        self.unsaved_files[file_path] = entry
+
+    def flush(self, final: bool = False) -> None:
+        upserted_count = len(self.ids)
+        if self.ids:
+            self.knowledge_collection.store.upsert(
+                ids=self.ids,
+                embeddings=EmbeddingService.encode_documents(self.documents),
+                documents=self.documents,
+                metadatas=self.metadatas
+            )
+            self.ids, self.documents, self.metadatas = [], [], []
+        for file_path, file_state, chunk_ids, previous_ids in self.completed_files:
+            stale_ids = list(previous_ids.difference(chunk_ids))
+            if stale_ids:
+                self.knowledge_collection.store.delete(stale_ids)
+            self.update_file(file_path, {**file_state, "chunk_ids": chunk_ids})
+        if upserted_count or self.completed_files:
+            self.knowledge_collection.changed()
+            self.progress.files_done += len(self.completed_files)
+            self.progress.chunks_done += upserted_count
+            self.progress.update()
+        self.completed_files = []
+        if self.unsaved_files and (final or time.monotonic() - self.last_saved >= MANIFEST_SAVE_INTERVAL):
+            self.knowledge_collection.save_manifest(self.unsaved_files)
+            self.last_saved = time.monotonic()
+            self.unsaved_files = {}
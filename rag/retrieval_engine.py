@@ -0,0 +1,311 @@
+from __future__ import annotations
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+import numpy as np
+import observability
+import rag.embedding_service as EmbeddingService
+from rag.vector_store import VectorStore
+from util import Util
+
+if TYPE_CHECKING:
+    from sentence_transformers import CrossEncoder
+
+DENSE_CANDIDATES = int(os.getenv("RETRIEVAL_DENSE_CANDIDATES", "10"))
+KEYWORD_CANDIDATES = int(os.getenv("RETRIEVAL_KEYWORD_CANDIDATES", "10"))
+# Dense results below this cosine similarity are dropped
+MIN_SIMILARITY = float(os.getenv("RETRIEVAL_MIN_SIMILARITY", "0.3"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_CONTEXT_TOKEN_BUDGET", "1500"))
+RERANK_ENABLED = os.getenv("RETRIEVAL_RERANK_ENABLED", "false").lower() == "true"
+RERANK_MODEL_NAME = os.getenv("RETRIEVAL_RERANK_MODEL_NAME", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# Reciprocal rank fusion constant
+RRF_K = 60
+# Previous user messages of the conversation folded into the query vector, the newest weighs HISTORY_WEIGHT and
+# every older one half as much as the next
+HISTORY_TURNS = int(os.getenv("RETRIEVAL_HISTORY_TURNS", "3"))
+HISTORY_WEIGHT = float(os.getenv("RETRIEVAL_HISTORY_WEIGHT", "0.5"))
+# A query whose folded vector stays this similar to its own embedding does not follow the conversation, it is
+# answered without the memory of the user
+STANDALONE_QUERY_SIMILARITY = float(os.getenv("RETRIEVAL_STANDALONE_QUERY_SIMILARITY", "0.97"))
+# Dense candidates kept by a conversation, rescored for its next turns instead of querying the vector store again
+# while the folded query vector stays this similar to the one they were retrieved for
+SESSION_CANDIDATES = int(os.getenv("RETRIEVAL_SESSION_CANDIDATES", "30"))
+SESSION_REUSE_SIMILARITY = float(os.getenv("RETRIEVAL_SESSION_REUSE_SIMILARITY", "0.8"))
+SESSION_MAX_REUSES = int(os.getenv("RETRIEVAL_SESSION_MAX_REUSES", "4"))
+# Longest overlap looked for when merging neighbouring chunks (the splitter overlaps chunks by 50 characters)
+MAX_CHUNK_OVERLAP = 100
+CHUNK_SEPARATOR = "\n\n"
+
+# One cross-encoder per process, shared by the engines of all the collections and loaded on first use
+_reranker: CrossEncoder | None = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> CrossEncoder:
+    global _reranker
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                from sentence_transformers import CrossEncoder
+                _reranker = CrossEncoder(RERANK_MODEL_NAME, device="cpu")
+    return _reranker
+
+
+@dataclass
+class RetrievedChunk:
+    chunk_id: str
+    document: str
+    metadata: dict[str, Any]
+    score: float = 0.0
+
+
+@dataclass(frozen=True)
+class SessionCandidates:
+    """Dense candidates retrieved for a query vector from one version of the collection, with their embeddings."""
+    collection_version: str
+    query_vector: np.ndarray
+    chunk_ids: list[str]
+    embeddings: np.ndarray
+
+
+@dataclass
+class RetrievalSession:
+    """Dense candidates of a conversation, rescored for its next turns while the topic does not change.
+
+    Only updated by Retrieval.commit, the candidates are only valid for the version of the collection they
+    were retrieved from.
+    """
+    candidates: SessionCandidates | None = None
+    reuses: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def get_candidates(self) -> tuple[SessionCandidates | None, int]:
+        with self.lock:
+            return self.candidates, self.reuses
+
+    def update(self, candidates: SessionCandidates, reused: bool) -> None:
+        with self.lock:
+            if not reused:
+                self.candidates = candidates
+                self.reuses = 0
+            elif candidates is self.candidates:
+                self.reuses += 1
+
+
+@dataclass
+class Retrieval:
+    """Context retrieved for a query, with the state the query leaves behind once committed.
+
+    Nothing derived from the query (its cached embedding, the candidates of the session) is kept before commit,
+    so a retrieval started before the input is known to be safe to keep, e.g. concurrently with the PII guard,
+    is dropped without a trace.
+    """
+    context: str
+    query: str = ""
+    query_embedding: list[float] | None = None
+    session: RetrievalSession | None = None
+    session_candidates: SessionCandidates | None = None
+    session_reused: bool = False
+    # The history of the conversation barely moved the query, the answer does not depend on it
+    standalone: bool = False
+
+    def commit(self) -> None:
+        if self.query_embedding is not None:
+            EmbeddingService.cache_query(self.query, self.query_embedding)
+        if self.session is not None and self.session_candidates is not None:
+            self.session.update(self.session_candidates, self.session_reused)
+
+
+class RetrievalEngine:
+    """Hybrid retrieval over the knowledge collection.
+
+    Dense results from the collection (above a similarity cutoff) and BM25 keyword results from the keyword
+    index of the store are fused with reciprocal rank fusion, optionally reranked with a cross-encoder, and then
+    packed greedily into a token budget, merging the overlapping neighbouring chunks of the same page.
+
+    Both searches run on disk, only the documents of the fused candidates are read from the store. The engine
+    only keeps the chunk count in memory, read from the store on first use and then kept up to date with the
+    changes made by the ingestion.
+    """
+
+    def __init__(self):
+        # Reentrant, the collection publishes its new version while holding it around apply_changes
+        self.lock = threading.RLock()
+        self.collection_version: str | None = None
+        self.chunk_count = 0
+
+    def retrieve(self, store: VectorStore, collection_version: str, query: str,
+                 token_budget: int = CONTEXT_TOKEN_BUDGET, history: list[str] | None = None,
+                 session: RetrievalSession | None = None) -> Retrieval:
+        """Context for the query, packed into the token budget, the caller commits the retrieval to keep it.
+
+        The previous user messages of the conversation (oldest first) are folded into the query vector, the
+        retrieval is standalone when they barely moved it. The session, when given, lets the next turns on the same topic rescore the candidates of this one instead
+        of querying the vector store.
+        """
+        self._sync(store, collection_version)
+        if self.chunk_count == 0:
+            return Retrieval("")
+        query_embedding = EmbeddingService.encode_query(query, cache=False)
+        query_vector = fold_query(query_embedding, history or [])
+        retrieval = Retrieval("", query, query_embedding, session, standalone=HISTORY_TURNS > 0 and float(
+            fold_query(query_embedding, []) @ query_vector) >= STANDALONE_QUERY_SIMILARITY)
+        if session is None:
+            dense = self._dense_search(store, query_vector)
+        else:
+            dense = self._session_dense_search(store, collection_version, query_vector, retrieval)
+        keyword = store.keyword_search(query, KEYWORD_CANDIDATES)
+        candidates = self._to_chunks(store, self._fuse(dense, keyword))
+        if RERANK_ENABLED and candidates:
+            candidates = self._rerank(query, candidates)
+        retrieval.context = self._pack(candidates, token_budget)
+        return retrieval
+
+    def get_chunk_count(self, store: VectorStore, collection_version: str) -> int:
+        self._sync(store, collection_version)
+        return self.chunk_count
+
+    def apply_changes(self, collection_version: str, chunk_count: int) -> None:
+        """Take the chunk count after a write to the collection, when not loaded yet it is read on first use."""
+        with self.lock:
+            if self.collection_version is None:
+                return
+            self.chunk_count = chunk_count
+            self.collection_version = collection_version
+
+    def reset(self) -> None:
+        """Forget the chunk count, it is read from the collection again on next use."""
+        with self.lock:
+            self.collection_version = None
+            self.chunk_count = 0
+
+    def _sync(self, store: VectorStore, collection_version: str) -> None:
+        # Once loaded, the count is kept up to date by apply_changes before the collection publishes a new version.
+        # A query still holding the version from before a change is served with the newer count
+        if self.collection_version is not None:
+            return
+        with self.lock:
+            if self.collection_version is not None:
+                return
+            self.chunk_count = store.count()
+            self.collection_version = collection_version
+
+    def _dense_search(self, store: VectorStore, query_vector: np.ndarray) -> list[tuple[str, float]]:
+        with observability.record_latency(observability.vector_query_latency, backend=store.backend):
+            results = store.query(query_vector.tolist(), min(DENSE_CANDIDATES, self.chunk_count))
+        return _above_cutoff(results)
+
+    def _session_dense_search(self, store: VectorStore, collection_version: str, query_vector: np.ndarray,
+                              retrieval: Retrieval) -> list[tuple[str, float]]:
+        candidates, reuses = retrieval.session.get_candidates()
+        reuse = (candidates is not None and candidates.collection_version == collection_version
+                 and reuses < SESSION_MAX_REUSES
+                 and float(candidates.query_vector @ query_vector) >= SESSION_REUSE_SIMILARITY)
+        observability.record_cache_lookup("retrieval_session", reuse)
+        if reuse:
+            retrieval.session_candidates, retrieval.session_reused = candidates, True
+            similarities = candidates.embeddings @ query_vector
+            best = np.argsort(similarities)[::-1][:DENSE_CANDIDATES]
+            return _above_cutoff([(candidates.chunk_ids[index], float(similarities[index])) for index in best])
+        with observability.record_latency(observability.vector_query_latency, backend=store.backend):
+            results = store.query(query_vector.tolist(), min(SESSION_CANDIDATES, self.chunk_count))
+        embeddings = store.get_embeddings([chunk_id for chunk_id, _ in results])
+        chunk_ids = [chunk_id for chunk_id, _ in results if chunk_id in embeddings]
+        if not chunk_ids:
+            # Nothing to rescore in the next turns, e.g. the chunk count was stale and the collection is now empty
+            return _above_cutoff(results[:DENSE_CANDIDATES])
+        candidate_embeddings = np.asarray([embeddings[chunk_id] for chunk_id in chunk_ids], dtype=np.float32)
+        retrieval.session_candidates = SessionCandidates(collection_version, query_vector, chunk_ids,
+                                                         candidate_embeddings.reshape(len(chunk_ids), -1))
+        return _above_cutoff(results[:DENSE_CANDIDATES])
+
+    @staticmethod
+    def _to_chunks(store: VectorStore, results: list[tuple[str, float]]) -> list[RetrievedChunk]:
+        # One read for the documents of all the candidates, the chunks deleted since the search are left out
+        chunks = store.get_chunks([chunk_id for chunk_id, _ in results])
+        return [RetrievedChunk(chunk_id, *chunks[chunk_id], score) for chunk_id, score in results
+                if chunk_id in chunks]
+
+    @staticmethod
+    def _fuse(*ranked_lists: list[tuple[str, float]]) -> list[tuple[str, float]]:
+        fused: dict[str, float] = {}
+        for ranked in ranked_lists:
+            for rank, (chunk_id, _) in enumerate(ranked):
+                fused[chunk_id] = fused.get(chunk_id, 0.0) + 1 / (RRF_K + rank + 1)
+        return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+    @staticmethod
+    def _rerank(query: str, candidates: list[RetrievedChunk]) -> list[RetrievedChunk]:
+        scores = get_reranker().predict([(query, chunk.document) for chunk in candidates])
+        for chunk, score in zip(candidates, scores):
+            chunk.score = float(score)
+        return sorted(candidates, key=lambda chunk: chunk.score, reverse=True)
+
+    @staticmethod
+    def _pack(candidates: list[RetrievedChunk], token_budget: int) -> str:
+        # Greedily take the best chunks that still fit the budget, skipping duplicated text
+        selected = []
+        seen_documents = set()
+        used_tokens = 0
+        for chunk in candidates:
+            if chunk.document in seen_documents:
+                continue
+            tokens = Util.estimate_tokens(chunk.document)
+            if used_tokens + tokens > token_budget:
+                continue
+            selected.append(chunk)
+            seen_documents.add(chunk.document)
+            used_tokens += tokens
+
+        # Merge neighbouring chunks of the same page, keeping the best ranked group first
+        groups: list[list[RetrievedChunk]] = []
+        for chunk in selected:
+            for group in groups:
+                if any(_are_neighbours(chunk, member) for member in group):
+                    group.append(chunk)
+                    break
+            else:
+                groups.append([chunk])
+        passages = []
+        for group in groups:
+            group.sort(key=lambda member: member.metadata.get("chunk_index", 0))
+            passage = group[0].document
+            for member in group[1:]:
+                passage = _merge_overlap(passage, member.document)
+            passages.append(passage)
+        return CHUNK_SEPARATOR.join(passages)
+
+
+def fold_query(query_embedding: list[float], history: list[str]) -> np.ndarray:
+    """Unit query vector of the message embedding with the previous user messages (oldest first) folded in.
+
+    Follow-ups like "what about teachers?" keep the topic of the conversation. The embeddings of the previous
+    messages come from the query embedding cache, they were embedded by their own turns.
+    """
+    vector = np.asarray(query_embedding, dtype=np.float32)
+    weight = HISTORY_WEIGHT
+    for message in reversed(history[-HISTORY_TURNS:] if HISTORY_TURNS > 0 else []):
+        vector = vector + weight * np.asarray(EmbeddingService.encode_query(message), dtype=np.float32)
+        weight /= 2
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+def _above_cutoff(results: list[tuple[str, float]]) -> list[tuple[str, float]]:
+    return [(chunk_id, similarity) for chunk_id, similarity in results if similarity >= MIN_SIMILARITY]
+
+
+def _are_neighbours(first: RetrievedChunk, second: RetrievedChunk) -> bool:
+    if "chunk_index" not in first.metadata or "chunk_index" not in second.metadata:
+        return False
+    return (first.metadata.get("source_doc") == second.metadata.get("source_doc")
+            and first.metadata.get("page") == second.metadata.get("page")
+            and abs(first.metadata["chunk_index"] - second.metadata["chunk_index"]) == 1)
+
+
+def _merge_overlap(first: str, second: str) -> str:
+    # Join two consecutive chunks, dropping the text the splitter repeated at the start of the second one
+    for size in range(min(len(first), len(second), MAX_CHUNK_OVERLAP), 0, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return f"{first}\n{second}"
@@ -0,0 +1,153 @@
+from __future__ import annotations
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator, Sequence
+from rag.keyword_index import create_keyword_index, search_keywords
+
+if TYPE_CHECKING:
+    from chromadb.api import ClientAPI
+
+READ_BATCH_SIZE = 1000
+SQLITE_MAX_VARIABLES = 900
+
+
+class VectorStore(ABC):
+    """Storage of the chunks of a knowledge collection, their embeddings, documents and metadata.
+
+    The embeddings are unit length, the similarity returned by query is their cosine similarity. The documents
+    are also indexed on disk for the keyword search, nothing of the collection has to be loaded in memory.
+    """
+
+    backend: str
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @abstractmethod
+    def upsert(self, ids: list[str], embeddings: list[list[float]], documents: list[str],
+               metadatas: list[dict[str, Any]]) -> None:
+        """Add the chunks, replacing the ones with the same id."""
+
+    @abstractmethod
+    def delete(self, ids: list[str]) -> None:
+        """Remove the chunks, unknown ids are ignored."""
+
+    @abstractmethod
+    def count(self) -> int:
+        pass
+
+    @abstractmethod
+    def iter_chunks(self, batch_size: int = READ_BATCH_SIZE) -> Iterator[tuple[str, str, dict[str, Any]]]:
+        """(id, document, metadata) of every chunk, read in batches."""
+
+    @abstractmethod
+    def query(self, embedding: list[float], n_results: int) -> list[tuple[str, float]]:
+        """(id, similarity) of the nearest chunks, the most similar first."""
+
+    @abstractmethod
+    def keyword_search(self, query: str, n_results: int) -> list[tuple[str, float]]:
+        """(id, BM25 score) of the chunks matching the words of the query, the best first."""
+
+    @abstractmethod
+    def get_chunks(self, ids: list[str]) -> dict[str, tuple[str, dict[str, Any]]]:
+        """(document, metadata) of the given chunks, unknown ids are left out."""
+
+    @abstractmethod
+    def get_embeddings(self, ids: list[str]) -> dict[str, Sequence[float]]:
+        """Embeddings of the given chunks, unknown ids are left out."""
+
+    @abstractmethod
+    def drop(self) -> None:
+        """Delete the stored chunks, the store is not usable afterwards."""
+
+
+class ChromaVectorStore(VectorStore):
+    """A chroma collection, embeddings are stored as float32 in its HNSW index.
+
+    Chroma has no ranked keyword search, the documents are also indexed in a SQLite FTS5 sidecar.
+    """
+
+    backend = "chroma"
+
+    def __init__(self, name: str, client: ClientAPI, keyword_index_path: Path):
+        super().__init__(name)
+        self.client = client
+        self.collection = client.get_or_create_collection(name)
+        self.keyword_index_path = keyword_index_path
+        self.keyword_index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(keyword_index_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL UNIQUE,"
+                          " document TEXT NOT NULL)")
+        create_keyword_index(self.conn)
+        if self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0] != self.collection.count():
+            # Collection ingested before the sidecar existed, or interrupted between the two writes, indexed again
+            self.conn.execute("DELETE FROM chunks")
+            batch = []
+            for chunk_id, document, _ in self.iter_chunks():
+                batch.append((chunk_id, document))
+                if len(batch) >= READ_BATCH_SIZE:
+                    self._index_documents(batch)
+                    batch = []
+            self._index_documents(batch)
+
+    def upsert(self, ids: list[str], embeddings: list[list[float]], documents: list[str],
+               metadatas: list[dict[str, Any]]) -> None:
+        self.collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+        self._index_documents(list(zip(ids, documents)))
+
+    def delete(self, ids: list[str]) -> None:
+        self.collection.delete(ids=ids)
+        with self.lock:
+            for start in range(0, len(ids), SQLITE_MAX_VARIABLES):
+                batch = ids[start:start + SQLITE_MAX_VARIABLES]
+                self.conn.execute(f"DELETE FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})", batch)
+            self.conn.commit()
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def iter_chunks(self, batch_size: int = READ_BATCH_SIZE) -> Iterator[tuple[str, str, dict[str, Any]]]:
+        offset = 0
+        while True:
+            batch = self.collection.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+            for chunk_id, document, metadata in zip(batch['ids'], batch['documents'], batch['metadatas']):
+                yield chunk_id, document, metadata or {}
+            if len(batch['ids']) < batch_size:
+                return
+            offset += batch_size
+
+    def query(self, embedding: list[float], n_results: int) -> list[tuple[str, float]]:
+        results = self.collection.query(query_embeddings=[embedding], n_results=n_results, include=["distances"])
+        # The collection uses squared L2 distance over normalized embeddings
+        return [(chunk_id, 1 - distance / 2) for chunk_id, distance in zip(results['ids'][0],
+                                                                           results['distances'][0])]
+
+    def keyword_search(self, query: str, n_results: int) -> list[tuple[str, float]]:
+        with self.lock:
+            return search_keywords(self.conn, query, n_results)
+
+    def get_chunks(self, ids: list[str]) -> dict[str, tuple[str, dict[str, Any]]]:
+        results = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        return {chunk_id: (document, metadata or {})
+                for chunk_id, document, metadata in zip(results['ids'], results['documents'], results['metadatas'])}
+
+    def get_embeddings(self, ids: list[str]) -> dict[str, Sequence[float]]:
+        results = self.collection.get(ids=ids, include=["embeddings"])
+        return dict(zip(results['ids'], results['embeddings']))
+
+    def drop(self) -> None:
+        self.client.delete_collection(self.name)
+        with self.lock:
+            self.conn.close()
+            for suffix in ("", "-wal", "-shm"):
+                Path(f"{self.keyword_index_path}{suffix}").unlink(missing_ok=True)
+
+    def _index_documents(self, documents: list[tuple[str, str]]) -> None:
+        with self.lock:
+            self.conn.executemany("INSERT INTO chunks (chunk_id, document) VALUES (?, ?) "
+                                  "ON CONFLICT (chunk_id) DO UPDATE SET document = excluded.document", documents)
+            self.conn.commit()
@@ -0,0 +1,60 @@
+import atexit
+import hashlib
+import os
+import shutil
+import tempfile
+import uuid
+from collections import OrderedDict
+import numpy as np
+import pytest
+from benchmarks import environment
+
+# The application stores are read at import time, the tests must never touch the real data
+_workdir = tempfile.mkdtemp(prefix="tests-")
+environment.isolate(_workdir)
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+# The application configures logfire on import of the coordinator, the tests of the other modules don't
+os.environ.setdefault("LOGFIRE_IGNORE_NO_CONFIG", "1")
+
+
+class FakeEncoder:
+    """Stands in for the sentence transformer, a normalized bag of hashed words: texts sharing words are similar."""
+
+    dimensions = 64
+
+    def encode(self, texts: list[str], batch_size: int = 32, normalize_embeddings: bool = True) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                digest = hashlib.sha256(word.encode("utf-8")).digest()
+                vectors[row, digest[0] % self.dimensions] += 1.0
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+@pytest.fixture
+def fake_embeddings(monkeypatch):
+    import rag.embedding_service as EmbeddingService
+    monkeypatch.setattr(EmbeddingService, "get_model", FakeEncoder)
+    EmbeddingService.clear_query_cache()
+    yield
+    EmbeddingService.clear_query_cache()
+
+
+@pytest.fixture
+def rag_service(tmp_path, monkeypatch, fake_embeddings):
+    """The rag service with its own collection and state files, under the test's directory."""
+    import rag.rag_service as RagService
+    chroma_path = tmp_path.joinpath("chroma")
+    monkeypatch.setattr(RagService, "DEFAULT_COLLECTION_NAME", f"knowledge-{uuid.uuid4().hex[:8]}")
+    monkeypatch.setattr(RagService, "MANIFEST_PATH", chroma_path.joinpath("ingest_manifest.db"))
+    monkeypatch.setattr(RagService, "MANIFESTS_PATH", chroma_path.joinpath("manifests"))
+    monkeypatch.setattr(RagService, "ALIASES_PATH", chroma_path.joinpath("collection_aliases.json"))
+    monkeypatch.setattr(RagService, "RETIRED_COLLECTIONS_PATH", chroma_path.joinpath("retired_collections.json"))
+    monkeypatch.setattr(RagService, "KEYWORD_INDEX_PATH", chroma_path.joinpath("keyword"))
+    monkeypatch.setattr(RagService, "QUANTIZED_STORE_PATH", chroma_path.joinpath("quantized"))
+    monkeypatch.setattr(RagService, "_knowledge_collections", {})
+    monkeypatch.setattr(RagService, "_aliases", {})
+    monkeypatch.setattr(RagService, "_aliases_stamp", None)
+    monkeypatch.setattr(RagService, "_retrieval_sessions", OrderedDict())
+    monkeypatch.setattr(RagService, "_retired_collections_swept", False)
+    return RagService
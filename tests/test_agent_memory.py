@@ -0,0 +1,34 @@
+import threading
+from agents.memory.agent_memory import AgentMemory
+from agents.memory.conversation_store import ConversationStore
+
+
+def test_context_holds_every_turn_once(tmp_path):
+    memory = AgentMemory(memory_size=10, store=ConversationStore(str(tmp_path / "conversations.db")))
+    for turn in range(5):
+        memory.add_conversation(f"question {turn}", f"answer {turn}")
+
+    lines = memory.generate_context_for_llm(token_budget=1000).splitlines()
+
+    for turn in range(5):
+        assert sum(f"question {turn}" in line for line in lines) == 1
+        assert sum(f"answer {turn}" in line for line in lines) == 1
+
+
+def test_context_generated_while_a_conversation_is_stored_holds_it_once(tmp_path):
+    store = ConversationStore(str(tmp_path / "conversations.db"))
+    memory = AgentMemory(memory_size=10, store=store)
+    append = store.append
+
+    def append_then_generate_context(*args, **kwargs):
+        conversation_id = append(*args, **kwargs)
+        # Another request of the same user renders the context right after the insert
+        thread = threading.Thread(target=memory.generate_context_for_llm)
+        thread.start()
+        thread.join(timeout=0.2)
+        return conversation_id
+
+    store.append = append_then_generate_context
+    memory.add_conversation("question", "answer")
+
+    assert memory.generate_context_for_llm().count("User: question") == 1
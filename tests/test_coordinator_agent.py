@@ -0,0 +1,40 @@
+import asyncio
+import json
+import agents.coordinatoragent.main as CoordinatorAgent
+import agents.synthesizeragent.main as SynthesizerAgent
+from agents.coordinatoragent.models.coordinator_agent_request import CoordinatorAgentRequest
+from agents.coordinatoragent.models.pii_scan_result import PiiScanResult
+from rag.retrieval_engine import Retrieval
+
+SENSITIVE_INPUT = "call me at 555-123-4567"
+
+
+def test_spans_do_not_record_the_input_before_the_guard(capfire, monkeypatch):
+    monkeypatch.setattr(CoordinatorAgent, "scan_sensitive_data",
+                        lambda user_input: PiiScanResult(is_sensitive_data_exists=True, masked_input="call me at <PII>"))
+    monkeypatch.setattr(CoordinatorAgent, "retrieve_ingested_data", lambda request: Retrieval("context"))
+    monkeypatch.setattr(SynthesizerAgent, "get_memory_context", lambda user_id: None)
+
+    synthesizer_request = asyncio.run(CoordinatorAgent.prepare_synthesizer_agent_request(
+        CoordinatorAgentRequest(user_input=SENSITIVE_INPUT, user_id="alice")))
+
+    assert synthesizer_request.user_query == "call me at <PII>"
+    spans = capfire.exporter.exported_spans_as_dict()
+    assert any(span["name"] == "CoordinatorAgent.prepare_synthesizer_agent_request" for span in spans)
+    assert "555-123-4567" not in json.dumps(spans)
+
+
+def test_standalone_questions_are_answered_without_the_memory(monkeypatch):
+    monkeypatch.setattr(CoordinatorAgent, "scan_sensitive_data",
+                        lambda user_input: PiiScanResult(is_sensitive_data_exists=False, masked_input=user_input))
+    monkeypatch.setattr(SynthesizerAgent, "get_memory_context", lambda user_id: "User: hello")
+    request = CoordinatorAgentRequest(user_input="what is EduTrack?", user_id="alice")
+
+    monkeypatch.setattr(CoordinatorAgent, "retrieve_ingested_data",
+                        lambda request: Retrieval("context", standalone=True))
+    standalone = asyncio.run(CoordinatorAgent.prepare_synthesizer_agent_request(request))
+    monkeypatch.setattr(CoordinatorAgent, "retrieve_ingested_data", lambda request: Retrieval("context"))
+    follow_up = asyncio.run(CoordinatorAgent.prepare_synthesizer_agent_request(request))
+
+    assert standalone.memory_context is None
+    assert follow_up.memory_context == "User: hello"
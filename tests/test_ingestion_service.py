@@ -0,0 +1,73 @@
+import json
+import threading
+import time
+from benchmarks.synthetic_pdf import write_corpus
+from rag.ingestion_service import IngestionService
+
+
+def wait_for_status(service: IngestionService, job_id: str, *statuses: str) -> str:
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        status = service.status(job_id).status
+        if status in statuses:
+            return status
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} is still {service.status(job_id).status}")
+
+
+def test_job_ingests_in_the_background(rag_service, tmp_path):
+    paths = write_corpus(str(tmp_path.joinpath("docs")), 2)
+    service = IngestionService(tmp_path.joinpath("jobs.json"), workers=1, max_pdf_workers=1)
+
+    job = service.submit(str(tmp_path.joinpath("docs")))
+
+    assert wait_for_status(service, job.job_id, "completed", "failed") == "completed"
+    job = service.status(job.job_id)
+    assert (job.files_done, job.files_total) == (2, 2)
+    assert set(rag_service.get_knowledge_collection().manifest.get_files()) == set(paths)
+
+
+def test_running_job_is_cancelled_after_its_current_page(rag_service, tmp_path, monkeypatch):
+    started = threading.Event()
+
+    def ingest(path, tenant_id, progress, max_workers):
+        started.set()
+        while True:
+            progress.check_cancelled()
+            time.sleep(0.01)
+
+    monkeypatch.setattr(rag_service, "ingest_data_from_file_or_folder", ingest)
+    service = IngestionService(tmp_path.joinpath("jobs.json"), workers=1)
+    running = service.submit(str(tmp_path.joinpath("docs")))
+    queued = service.submit(str(tmp_path.joinpath("other")))
+    assert started.wait(10)
+
+    assert service.cancel(queued.job_id)
+    assert service.cancel(running.job_id)
+
+    assert wait_for_status(service, running.job_id, "cancelled", "failed") == "cancelled"
+    assert service.status(queued.job_id).status == "cancelled"
+    assert not service.cancel(running.job_id)
+
+
+def test_interrupted_reingestion_resumes_into_its_collection(rag_service, tmp_path, monkeypatch):
+    paths = write_corpus(str(tmp_path.joinpath("docs")), 3)
+    target_collection = rag_service.new_collection_name()
+    # The first file was ingested into the new collection before the crash
+    rag_service._ingest(rag_service.KnowledgeCollection(target_collection), paths[0], None, 1)
+    now = time.time()
+    tmp_path.joinpath("jobs.json").write_text(json.dumps([{
+        "job_id": "interrupted", "path": str(tmp_path.joinpath("docs")), "reingest": True,
+        "target_collection": target_collection, "status": "running", "created_at": now, "updated_at": now}]))
+    extracted = []
+    iter_pdf_pages = rag_service.iter_pdf_pages
+    monkeypatch.setattr(rag_service, "iter_pdf_pages",
+                        lambda file_paths, max_workers: extracted.extend(file_paths) or iter_pdf_pages(file_paths, 1))
+
+    service = IngestionService(tmp_path.joinpath("jobs.json"), workers=1)
+
+    assert wait_for_status(service, "interrupted", "completed", "failed") == "completed"
+    assert extracted == paths[1:]
+    knowledge_collection = rag_service.get_knowledge_collection()
+    assert knowledge_collection.name == target_collection
+    assert set(knowledge_collection.manifest.get_files()) == set(paths)
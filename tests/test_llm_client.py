@@ -0,0 +1,171 @@
+import asyncio
+import random
+import time
+import pytest
+from pydantic_ai import Agent
+from pydantic_ai.exceptions import ModelHTTPError
+import agents.synthesizeragent.llm_client as LlmClient
+from agents.synthesizeragent.models.llm_policy import LlmPolicy
+from benchmarks.fake_model import build_fake_model
+
+PRIMARY_MODEL = "test-primary"
+FALLBACK_MODEL = "test-fallback"
+
+
+class FakeModel:
+    """Fake model stand-in with the number of requests it completed, failed ones included."""
+
+    def __init__(self, latency_seconds: float = 0.01, **faults):
+        self.requests = 0
+        self.model = build_fake_model(latency_seconds, tokens_per_second=0, response_tokens=5,
+                                      on_request=self._record, **faults)
+
+    def _record(self, seconds: float) -> None:
+        self.requests += 1
+
+
+def find_seed(*faults: bool, fault_rate: float = 0.5) -> int:
+    """Seed of a fake model whose successive requests get the fault of the given rate or not.
+
+    The fake model draws one roll per request, the request gets the fault when the roll is below the rate.
+    """
+    for seed in range(1000):
+        generator = random.Random(seed)
+        if all((generator.random() < fault_rate) == expected for expected in faults):
+            return seed
+    raise AssertionError(f"No seed for {faults}")
+
+
+@pytest.fixture
+def models(monkeypatch):
+    """Maps the model names of the policies to fake models, set by the test."""
+    models = {}
+    monkeypatch.setattr(LlmClient, "get_model", lambda name: models[name].model)
+    monkeypatch.setattr(LlmClient, "_limiter", LlmClient._ConcurrencyLimiter(4))
+    return models
+
+
+def policy(**overrides) -> LlmPolicy:
+    settings = dict(timeout_seconds=2.0, deadline_seconds=5.0, max_attempts=3, backoff_base_seconds=0.01,
+                    backoff_max_seconds=0.02, fallback_model=None)
+    return LlmPolicy(**{**settings, **overrides})
+
+
+def run(llm_policy: LlmPolicy) -> str:
+    return asyncio.run(LlmClient.run(Agent(), "question", None, llm_policy, PRIMARY_MODEL))
+
+
+def stream(llm_policy: LlmPolicy) -> str:
+    async def collect() -> str:
+        return "".join([delta async for delta in LlmClient.stream(Agent(), "question", None, llm_policy,
+                                                                  PRIMARY_MODEL)])
+    return asyncio.run(collect())
+
+
+def test_retries_server_errors(models):
+    models[PRIMARY_MODEL] = FakeModel(error_rate=1.0, error_status=503)
+
+    with pytest.raises(LlmClient.LlmUnavailableError):
+        run(policy(max_attempts=3))
+
+    assert models[PRIMARY_MODEL].requests == 3
+
+
+def test_does_not_retry_client_errors(models):
+    models[PRIMARY_MODEL] = FakeModel(error_rate=1.0, error_status=400)
+
+    with pytest.raises(ModelHTTPError) as error:
+        run(policy(max_attempts=3, fallback_model=FALLBACK_MODEL))
+
+    assert error.value.status_code == 400
+    assert models[PRIMARY_MODEL].requests == 1
+
+
+def test_retry_answers_after_a_server_error(models):
+    models[PRIMARY_MODEL] = FakeModel(error_rate=0.5, seed=find_seed(True, False))
+
+    assert run(policy(max_attempts=3))
+
+    assert models[PRIMARY_MODEL].requests == 2
+
+
+def test_deadline_bounds_the_attempts(models):
+    models[PRIMARY_MODEL] = FakeModel(slow_rate=1.0, slow_latency_seconds=5.0)
+
+    start = time.perf_counter()
+    with pytest.raises(LlmClient.LlmUnavailableError):
+        run(policy(timeout_seconds=2.0, deadline_seconds=0.3))
+
+    assert time.perf_counter() - start < 1.0
+
+
+def test_hedge_wins_and_cancels_the_slow_request(models):
+    models[PRIMARY_MODEL] = FakeModel(slow_rate=0.5, slow_latency_seconds=0.5, seed=find_seed(True, False))
+
+    start = time.perf_counter()
+    assert run(policy(hedge_after_seconds=0.05))
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < 0.4
+    # The slow request was cancelled, it never completes
+    time.sleep(0.6)
+    assert models[PRIMARY_MODEL].requests == 1
+    assert LlmClient._limiter.active == 0
+
+
+def test_falls_back_when_the_primary_fails(models):
+    models[PRIMARY_MODEL] = FakeModel(error_rate=1.0, error_status=503)
+    models[FALLBACK_MODEL] = FakeModel()
+
+    assert run(policy(max_attempts=2, fallback_model=FALLBACK_MODEL))
+
+    assert models[PRIMARY_MODEL].requests == 2
+    assert models[FALLBACK_MODEL].requests == 1
+
+
+def test_falls_back_when_the_primary_is_slow(models):
+    models[PRIMARY_MODEL] = FakeModel(slow_rate=1.0, slow_latency_seconds=0.5)
+    models[FALLBACK_MODEL] = FakeModel()
+
+    start = time.perf_counter()
+    assert run(policy(fallback_model=FALLBACK_MODEL, fallback_after_seconds=0.05))
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < 0.4
+    time.sleep(0.6)
+    assert models[PRIMARY_MODEL].requests == 0
+    assert models[FALLBACK_MODEL].requests == 1
+
+
+def test_stream_retries_then_falls_back(models):
+    models[PRIMARY_MODEL] = FakeModel(error_rate=1.0, error_status=503)
+    models[FALLBACK_MODEL] = FakeModel()
+
+    assert stream(policy(max_attempts=2, fallback_model=FALLBACK_MODEL))
+
+    assert models[PRIMARY_MODEL].requests == 2
+    assert models[FALLBACK_MODEL].requests == 1
+
+
+def test_cancelled_run_releases_its_slot(models, monkeypatch):
+    monkeypatch.setattr(LlmClient, "_limiter", LlmClient._ConcurrencyLimiter(1))
+    models[PRIMARY_MODEL] = FakeModel(slow_rate=1.0, slow_latency_seconds=5.0)
+
+    async def cancel_runs() -> None:
+        running = asyncio.create_task(LlmClient.run(Agent(), "question", None, policy(), PRIMARY_MODEL))
+        # Waits for the slot held by the first run
+        waiting = asyncio.create_task(LlmClient.run(Agent(), "question", None, policy(), PRIMARY_MODEL))
+        await asyncio.sleep(0.1)
+        assert LlmClient._limiter.active == 1
+        assert len(LlmClient._limiter.waiters) == 1
+        waiting.cancel()
+        running.cancel()
+        await asyncio.gather(running, waiting, return_exceptions=True)
+        await asyncio.sleep(0.05)
+
+    asyncio.run(cancel_runs())
+
+    assert LlmClient._limiter.active == 0
+    assert not LlmClient._limiter.waiters
+    models[PRIMARY_MODEL] = FakeModel()
+    assert run(policy())
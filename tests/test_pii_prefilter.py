@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+import pytest
+import agents.coordinatoragent.main as CoordinatorAgent
+from agents.coordinatoragent.main import PII_HINT_PATTERN
+
+
+class FakeGuard:
+    """Stands in for the presidio guard, masks the given text."""
+
+    def __init__(self, masked_text: str | None = None):
+        self.masked_text = masked_text
+        self.inputs = []
+
+    def validate(self, user_input: str) -> SimpleNamespace:
+        self.inputs.append(user_input)
+        if self.masked_text is None:
+            return SimpleNamespace(validated_output=None)
+        return SimpleNamespace(validated_output=user_input.replace(self.masked_text, "<PII>"))
+
+
+@pytest.mark.parametrize("user_input", [
+    "Call me at +1 (555) 123-4567",
+    "my number is 555-123-4567",
+    "555.123.4567",
+    "+44 20 7946 0958",
+    "0612345678",
+    "reach me on 555 1234",
+    "06/12/34/56/78",
+    "write to jane.doe@example.com",
+    "@handle",
+])
+def test_inputs_that_may_hold_pii_reach_the_analyzer(user_input):
+    assert PII_HINT_PATTERN.search(user_input) is not None
+
+
+@pytest.mark.parametrize("user_input", [
+    "",
+    "What is EduTrack used for?",
+    "How many students enrolled in 2023?",
+    "Explain chapter 12, section 4",
+    "Compare plan A and plan B",
+])
+def test_inputs_without_pii_hints_are_skipped(user_input):
+    assert PII_HINT_PATTERN.search(user_input) is None
+
+
+def test_skipped_inputs_never_reach_the_guard(monkeypatch):
+    guard = FakeGuard("555-123-4567")
+    monkeypatch.setattr(CoordinatorAgent, "get_pii_guard", lambda: guard)
+
+    result = CoordinatorAgent.scan_sensitive_data("What is EduTrack used for?")
+
+    assert not result.is_sensitive_data_exists
+    assert result.masked_input == "What is EduTrack used for?"
+    assert guard.inputs == []
+
+
+def test_phone_numbers_are_masked_by_the_guard(monkeypatch):
+    guard = FakeGuard("555-123-4567")
+    monkeypatch.setattr(CoordinatorAgent, "get_pii_guard", lambda: guard)
+
+    result = CoordinatorAgent.scan_sensitive_data("call me at 555-123-4567")
+
+    assert result.is_sensitive_data_exists
+    assert result.masked_input == "call me at <PII>"
+    assert guard.inputs == ["call me at 555-123-4567"]
+
+
+def test_guard_without_output_fails_closed(monkeypatch):
+    monkeypatch.setattr(CoordinatorAgent, "get_pii_guard", lambda: FakeGuard())
+
+    result = CoordinatorAgent.scan_sensitive_data("call me at 555-123-4567")
+
+    assert result.is_sensitive_data_exists
+    assert result.masked_input == ""
@@ -0,0 +1,111 @@
+import json
+import numpy as np
+import rag.quantized_vector_store as QuantizedVectorStoreModule
+from rag.quantized_vector_store import QuantizedVectorStore
+
+DIM = 32
+
+
+def random_vectors(count: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).normal(size=(count, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def upsert(store: QuantizedVectorStore, ids: list[str], vectors: np.ndarray) -> None:
+    store.upsert(ids, vectors.tolist(), [f"document {chunk_id}" for chunk_id in ids],
+                 [{"source": chunk_id} for chunk_id in ids])
+
+
+def test_upsert_then_query_and_read(tmp_path):
+    store = QuantizedVectorStore("test", tmp_path)
+    vectors = random_vectors(100)
+    upsert(store, [f"chunk-{index}" for index in range(100)], vectors)
+
+    results = store.query(vectors[42].tolist(), 5)
+
+    assert store.count() == 100
+    assert results[0][0] == "chunk-42"
+    assert results[0][1] > 0.99
+    assert store.get_chunks(["chunk-42"]) == {"chunk-42": ("document chunk-42", {"source": "chunk-42"})}
+
+
+def test_upsert_of_an_existing_id_replaces_it(tmp_path):
+    store = QuantizedVectorStore("test", tmp_path)
+    first, second = random_vectors(2)
+    upsert(store, ["chunk"], first[None])
+
+    store.upsert(["chunk"], [second.tolist()], ["updated document"], [{}])
+
+    assert store.count() == 1
+    assert store.query(second.tolist(), 1)[0][0] == "chunk"
+    assert store.get_chunks(["chunk"])["chunk"][0] == "updated document"
+    assert store.keyword_search("updated", 5)[0][0] == "chunk"
+
+
+def test_deleted_rows_are_reused(tmp_path):
+    store = QuantizedVectorStore("test", tmp_path)
+    vectors = random_vectors(12)
+    upsert(store, [f"chunk-{index}" for index in range(10)], vectors[:10])
+
+    store.delete(["chunk-3", "chunk-7"])
+    upsert(store, ["new-a", "new-b"], vectors[10:])
+
+    assert store.count() == 10
+    assert store.size == 10
+    assert store.get_chunks(["chunk-3", "chunk-7"]) == {}
+    assert {chunk_id for chunk_id, _ in store.query(vectors[3].tolist(), 10)}.isdisjoint({"chunk-3", "chunk-7"})
+    assert store.query(vectors[10].tolist(), 1)[0][0] == "new-a"
+
+
+def test_reopened_store_keeps_its_chunks(tmp_path):
+    vectors = random_vectors(1500)
+    store = QuantizedVectorStore("test", tmp_path)
+    # Grows past the initial capacity
+    upsert(store, [f"chunk-{index}" for index in range(1500)], vectors)
+    store.delete(["chunk-0"])
+
+    reopened = QuantizedVectorStore("test", tmp_path)
+    upsert(reopened, ["new"], random_vectors(1, seed=1))
+
+    assert reopened.count() == 1500
+    assert reopened.query(vectors[1499].tolist(), 1)[0][0] == "chunk-1499"
+    # The deleted row was free on reopening
+    assert reopened.size == 1500
+
+
+def test_reopened_store_recovers_a_size_saved_behind_the_chunks(tmp_path):
+    vectors = random_vectors(10)
+    store = QuantizedVectorStore("test", tmp_path)
+    upsert(store, [f"chunk-{index}" for index in range(10)], vectors)
+    # A crash after the chunks were committed, before the meta was saved
+    meta_path = tmp_path.joinpath("meta.json")
+    meta_path.write_text(json.dumps({**json.loads(meta_path.read_text()), "size": 8}))
+
+    reopened = QuantizedVectorStore("test", tmp_path)
+    upsert(reopened, ["new"], random_vectors(1, seed=1))
+
+    assert reopened.count() == 11
+    assert set(reopened.get_chunks(["chunk-8", "chunk-9", "new"])) == {"chunk-8", "chunk-9", "new"}
+
+
+def test_ivf_recall(tmp_path, monkeypatch):
+    monkeypatch.setattr(QuantizedVectorStoreModule, "IVF_LISTS", 16)
+    monkeypatch.setattr(QuantizedVectorStoreModule, "IVF_PROBES", 4)
+    generator = np.random.default_rng(0)
+    # Clustered like the embeddings of a corpus
+    centers = random_vectors(16, seed=1)
+    vectors = centers[generator.integers(0, 16, 4000)] + generator.normal(scale=0.1, size=(4000, DIM))
+    vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    store = QuantizedVectorStore("test", tmp_path)
+    for start in range(0, 4000, 500):
+        upsert(store, [f"chunk-{index}" for index in range(start, start + 500)], vectors[start:start + 500])
+    assert store.centroids is not None
+
+    queries = vectors[generator.choice(4000, 50, replace=False)] + generator.normal(scale=0.05, size=(50, DIM))
+    recall = []
+    for query in queries:
+        expected = {f"chunk-{index}" for index in np.argsort(vectors @ query)[-10:]}
+        found = {chunk_id for chunk_id, _ in store.query(query.tolist(), 10)}
+        recall.append(len(expected & found) / 10)
+
+    assert np.mean(recall) >= 0.9
@@ -0,0 +1,150 @@
+import itertools
+import json
+import os
+import logfire
+from benchmarks.synthetic_pdf import write_corpus
+from rag.ingest_manifest import IngestManifest
+
+
+def chunk_ids_by_file(knowledge_collection) -> dict[str, set[str]]:
+    files: dict[str, set[str]] = {}
+    for chunk_id, _, metadata in knowledge_collection.store.iter_chunks():
+        files.setdefault(metadata["source_doc"], set()).add(chunk_id)
+    return files
+
+
+def test_unchanged_files_are_neither_hashed_nor_embedded_again(rag_service, tmp_path, monkeypatch):
+    paths = write_corpus(str(tmp_path.joinpath("docs")), 3)
+    rag_service.ingest_data_from_file_or_folder(str(tmp_path.joinpath("docs")), max_workers=1)
+    knowledge_collection = rag_service.get_knowledge_collection()
+    ingested = chunk_ids_by_file(knowledge_collection)
+    version = knowledge_collection.get_version()
+    hashed = []
+    file_hash = rag_service._file_hash
+    monkeypatch.setattr(rag_service, "_file_hash", lambda file_path: hashed.append(file_path) or file_hash(file_path))
+
+    rag_service.ingest_data_from_file_or_folder(str(tmp_path.joinpath("docs")), max_workers=1)
+    # Touched, same content
+    os.utime(paths[0], ns=(1_000_000_000, 1_000_000_000))
+    rag_service.ingest_data_from_file_or_folder(str(tmp_path.joinpath("docs")), max_workers=1)
+    rag_service.ingest_data_from_file_or_folder(str(tmp_path.joinpath("docs")), max_workers=1)
+
+    assert set(ingested) == set(paths)
+    assert hashed == [paths[0]]
+    assert chunk_ids_by_file(knowledge_collection) == ingested
+    assert knowledge_collection.get_version() == version
+
+
+def test_chunks_of_changed_and_removed_files_are_deleted(rag_service, tmp_path):
+    paths = write_corpus(str(tmp_path.joinpath("docs")), 3)
+    rag_service.ingest_data_from_file_or_folder(str(tmp_path.joinpath("docs")), max_workers=1)
+    knowledge_collection = rag_service.get_knowledge_collection()
+    ingested = chunk_ids_by_file(knowledge_collection)
+
+    # Same paths, other content
+    changed = write_corpus(str(tmp_path.joinpath("docs")), 1, seed=7)[0]
+    os.remove(paths[2])
+    rag_service.ingest_data_from_file_or_folder(str(tmp_path.joinpath("docs")), max_workers=1)
+
+    reingested = chunk_ids_by_file(knowledge_collection)
+    files = knowledge_collection.manifest.get_files()
+    assert changed == paths[0]
+    assert set(reingested) == set(files) == {paths[0], paths[1]}
+    # Only the chunks of the new content are left
+    assert reingested[paths[0]] == set(files[paths[0]]["chunk_ids"]) != ingested[paths[0]]
+    assert reingested[paths[1]] == ingested[paths[1]]
+
+
+def test_chunks_ingested_before_the_manifest_are_replaced(rag_service, tmp_path):
+    paths = write_corpus(str(tmp_path.joinpath("docs")), 2)
+    knowledge_collection = rag_service.get_knowledge_collection()
+    knowledge_collection.store.upsert([f"chunk_{index}" for index in range(3)], [[1.0] + [0.0] * 63] * 3,
+                                      ["old"] * 3, [{"source_doc": paths[0]}] * 3)
+
+    rag_service.ingest_data_from_file_or_folder(str(tmp_path.joinpath("docs")), max_workers=1)
+
+    chunk_ids = [chunk_id for chunk_id, _, _ in knowledge_collection.store.iter_chunks()]
+    assert chunk_ids
+    assert not any(chunk_id.startswith("chunk_") for chunk_id in chunk_ids)
+
+
+def test_json_manifest_is_imported(rag_service, tmp_path):
+    manifest_path = rag_service.MANIFEST_PATH.with_suffix(".json")
+    manifest_path.parent.mkdir(parents=True)
+    manifest_path.write_text(json.dumps({"files": {"/docs/a.pdf": {"file_hash": "abc", "chunk_ids": ["1", "2"]}},
+                                         "version": "v1"}))
+
+    knowledge_collection = rag_service.get_knowledge_collection()
+
+    assert knowledge_collection.get_version() == "v1"
+    assert knowledge_collection.manifest.get_files() == {
+        "/docs/a.pdf": {"file_hash": "abc", "file_size": None, "file_mtime_ns": None, "chunk_ids": ["1", "2"]}}
+    assert not manifest_path.exists()
+
+
+def test_reingestion_switches_to_a_new_collection_and_drops_the_old_one(rag_service, tmp_path, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(rag_service, "_schedule_drop", scheduled.append)
+    write_corpus(str(tmp_path.joinpath("old")), 1, seed=1)
+    write_corpus(str(tmp_path.joinpath("new")), 2, seed=2)
+    rag_service.ingest_data_from_file_or_folder(str(tmp_path.joinpath("old")), max_workers=1)
+    old_collection = rag_service.get_knowledge_collection()
+
+    rag_service.reingest_data_from_file_or_folder(str(tmp_path.joinpath("new")), max_workers=1)
+    new_collection = rag_service.get_knowledge_collection()
+
+    assert new_collection.name != old_collection.name
+    assert {metadata["source_doc"] for _, _, metadata in new_collection.store.iter_chunks()} == set(
+        new_collection.manifest.get_files())
+    assert all("/new/" in file_path for file_path in new_collection.manifest.get_files())
+    # Still served to the queries that started before the switch, until the end of the grace period
+    assert old_collection.store.count() > 0
+    assert [entry["name"] for entry in scheduled] == [old_collection.name]
+
+    rag_service._drop_retired_collection(scheduled[0])
+
+    assert json.loads(rag_service.RETIRED_COLLECTIONS_PATH.read_text()) == []
+    assert rag_service.get_knowledge_collection() is new_collection
+
+
+def test_collection_switched_by_another_process_is_followed(rag_service, monkeypatch):
+    monkeypatch.setattr(rag_service, "_schedule_drop", lambda entry: None)
+    knowledge_collection = rag_service.get_knowledge_collection()
+    other_name = rag_service.new_collection_name()
+
+    # What the switch of another process leaves on disk
+    rag_service.ALIASES_PATH.write_text(json.dumps({rag_service.DEFAULT_TENANT_ID: other_name}))
+
+    assert rag_service.get_knowledge_collection().name == other_name
+    assert knowledge_collection.name != other_name
+
+
+def test_collection_changed_by_another_process_is_opened_again(rag_service):
+    knowledge_collection = rag_service.get_knowledge_collection()
+    version = knowledge_collection.get_version()
+
+    # Another process ingested into the live collection
+    IngestManifest(rag_service.MANIFEST_PATH).save({}, "other-version")
+
+    reopened = rag_service.get_knowledge_collection()
+    assert reopened is not knowledge_collection
+    assert reopened.get_version() == "other-version" != version
+    assert rag_service.get_knowledge_collection() is reopened
+
+
+def test_pages_extracted_by_the_process_pool_keep_the_file_order(rag_service, tmp_path):
+    # Configured like the application, logfire sends its configuration to the workers and the one of the capfire
+    # tests can't be pickled
+    logfire.configure(send_to_logfire=False, console=False)
+    paths = write_corpus(str(tmp_path.joinpath("docs")), 6, pages_per_file=3)
+    serial = list(rag_service.iter_pdf_pages(paths, max_workers=1))
+
+    pooled = list(rag_service.iter_pdf_pages(paths, max_workers=2))
+    # A consumer stopping early, e.g. a cancelled ingestion, does not wait for the queued files
+    pages = rag_service.iter_pdf_pages(paths, max_workers=2)
+    first_page = next(pages)
+    pages.close()
+
+    assert [file_path for file_path, _ in itertools.groupby(file_path for file_path, _, _ in serial)] == paths
+    assert pooled == serial
+    assert first_page == serial[0]
@@ -0,0 +1,24 @@
+from agents.synthesizeragent.response_cache import SemanticResponseCache
+
+
+def test_responses_written_with_a_user_memory_are_not_shared(tmp_path):
+    cache = SemanticResponseCache(str(tmp_path))
+    alice = SemanticResponseCache.get_context_key("context", "v1", user_id="alice")
+    bob = SemanticResponseCache.get_context_key("context", "v1", user_id="bob")
+
+    cache.put([1.0, 0.0], alice, "collection-v1", "answer for alice")
+
+    assert cache.get([1.0, 0.0], alice, "collection-v1") == "answer for alice"
+    assert cache.get([1.0, 0.0], bob, "collection-v1") is None
+
+
+def test_entries_survive_a_restart(tmp_path):
+    context_key = SemanticResponseCache.get_context_key("context", "v1")
+    cache = SemanticResponseCache(str(tmp_path), max_entries=2)
+    for index in range(3):
+        cache.put([1.0, float(index)], context_key, "collection-v1", f"answer {index}")
+
+    reloaded = SemanticResponseCache(str(tmp_path), max_entries=2)
+
+    assert reloaded.get([1.0, 0.0], context_key, "collection-v1") is None
+    assert reloaded.get([1.0, 2.0], context_key, "collection-v1") == "answer 2"
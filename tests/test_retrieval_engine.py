@@ -0,0 +1,76 @@
+from rag.quantized_vector_store import QuantizedVectorStore
+from rag.retrieval_engine import CHUNK_SEPARATOR, RetrievalEngine, RetrievalSession, RetrievedChunk, _merge_overlap
+import rag.embedding_service as EmbeddingService
+
+DOCUMENTS = {
+    "engagement": "EduTrack monitors student engagement and learning behavior",
+    "integrations": "EduTrack integrates with Moodle Canvas and Blackboard",
+    "alerts": "Instructors receive weekly alerts about disengaged students",
+}
+
+
+def build_store(tmp_path) -> QuantizedVectorStore:
+    store = QuantizedVectorStore("test", tmp_path)
+    ids = list(DOCUMENTS)
+    store.upsert(ids, EmbeddingService.encode_documents(list(DOCUMENTS.values())), list(DOCUMENTS.values()),
+                 [{"source_doc": chunk_id, "page": 1, "chunk_index": 0} for chunk_id in ids])
+    return store
+
+
+def test_session_retrieval_from_a_collection_emptied_since_the_count(tmp_path, fake_embeddings):
+    store = build_store(tmp_path)
+    engine = RetrievalEngine()
+    assert engine.get_chunk_count(store, "v1") == 3
+    # Emptied by another process, the engine still has the count of v1
+    store.delete(list(DOCUMENTS))
+    session = RetrievalSession()
+
+    retrieval = engine.retrieve(store, "v1", "student engagement", session=session)
+    retrieval.commit()
+
+    assert retrieval.context == ""
+    assert session.candidates is None
+
+
+def test_only_the_questions_moved_by_the_history_follow_the_conversation(tmp_path, fake_embeddings):
+    store = build_store(tmp_path)
+    engine = RetrievalEngine()
+
+    repeated = engine.retrieve(store, "v1", "student engagement", history=["student engagement"])
+    follow_up = engine.retrieve(store, "v1", "what about Moodle", history=["student engagement alerts"])
+    first_turn = engine.retrieve(store, "v1", "what about Moodle", history=[])
+
+    assert repeated.standalone
+    assert not follow_up.standalone
+    assert first_turn.standalone
+
+
+def test_fusion_ranks_the_chunks_found_by_both_searches_first():
+    dense = [("a", 0.9), ("b", 0.8), ("c", 0.7)]
+    keyword = [("c", 12.0), ("d", 8.0)]
+
+    fused = RetrievalEngine._fuse(dense, keyword)
+
+    assert [chunk_id for chunk_id, _ in fused] == ["c", "a", "b", "d"]
+
+
+def test_packing_keeps_the_budget_and_merges_neighbouring_chunks():
+    def chunk(chunk_id, document, chunk_index, page=1):
+        return RetrievedChunk(chunk_id, document, {"source_doc": "a.pdf", "page": page, "chunk_index": chunk_index})
+
+    candidates = [
+        chunk("second", "overlap then the end", 1),
+        chunk("other-page", "another page", 0, page=2),
+        chunk("first", "the start with overlap", 0),
+        chunk("duplicate", "another page", 5, page=3),
+        chunk("too-long", "word " * 400, 2, page=4),
+    ]
+
+    context = RetrievalEngine._pack(candidates, token_budget=30)
+
+    assert context == "the start with overlap then the end" + CHUNK_SEPARATOR + "another page"
+
+
+def test_merge_overlap_drops_the_repeated_text():
+    assert _merge_overlap("the start with overlap", "overlap then the end") == "the start with overlap then the end"
+    assert _merge_overlap("no common", "text") == "no common\ntext"
@@ -1,4 +1,16 @@
+import asyncio
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import AsyncIterator, Iterator
+
+# Shared pool for the blocking work (chroma, encoders, guard, memory writes) of the async request path
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "32"))
+_blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="blocking")
+
 class Util:
     PREFERENCE_INGESTION_RESPONSE = "Ok, I will save and remember that"
     FILE_NOT_FOUND_ERROR = "No txt file(s) found in the provided path"
@@ -10,4 +22,36 @@ class Util:
         if instructions_file.exists():
             return instructions_file.read_text().strip()
 
-        raise FileNotFoundError(f"Instructions file not found at: {file_path}")
\ No newline at end of file
+        raise FileNotFoundError(f"Instructions file not found at: {file_path}")
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        # Rough token count (about 4 characters per token), good enough for budgeting prompts
+        return max(1, len(text) // 4)
+
+    @staticmethod
+    async def run_blocking(func, *args, **kwargs):
+        # Run a blocking call on the shared thread pool without blocking the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_blocking_executor, partial(func, *args, **kwargs))
+
+    @staticmethod
+    def iterate_in_thread(async_iterator: AsyncIterator) -> Iterator:
+        # Consume an async iterator from sync code (e.g. streamlit), the event loop runs on a background thread
+        items = queue.Queue()
+        done = object()
+
+        async def consume():
+            try:
+                async for item in async_iterator:
+                    items.put(item)
+            except BaseException as ex:
+                items.put(ex)
+            finally:
+                items.put(done)
+
+        threading.Thread(target=asyncio.run, args=(consume(),), daemon=True).start()
+        while (item := items.get()) is not done:
+            if isinstance(item, BaseException):
+                raise item
+            yield item